@@ -0,0 +1,344 @@
+""" Load generator for 9P servers.
+
+Run ``python -m pyixp.bench --help`` for usage.
+"""
+import argparse
+import itertools
+import math
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from collections import defaultdict
+
+from pyixp import messages
+from pyixp import shm
+from pyixp.client import Client, dial
+from pyixp.requests import ServerError
+from pyixp.server import MemoryFS, Server
+
+__all__ = 'main',
+
+# preset mixes of operations, as maps from operation to relative weight
+WORKLOADS = {
+    "stat-heavy": {"stat": 8, "read": 1, "listdir": 1},
+    "small-read": {"read": 1},
+    "small-write": {"write": 1},
+    "bulk": {"bulk-read": 1, "bulk-write": 1},
+    "bulk-read": {"bulk-read": 1},
+    "listdir": {"listdir": 1},
+}
+
+_message_names = {
+    getattr(messages, name).type_id: name
+    for name in messages.__all__
+    if isinstance(getattr(messages, name), type) and
+    issubclass(getattr(messages, name), messages.Message) and
+    getattr(messages, name) is not messages.Message
+}
+
+
+class Recorder(object):
+    """ Collects latencies by message type and by operation
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.bytes = 0
+        # message size agreed with the server
+        self.msize = None
+
+    def record(self, name, latency, size=0):
+        with self._lock:
+            self.latencies[name].append(latency)
+            self.bytes += size
+
+
+def instrument(client, recorder):
+    """ Record the latency of every request made through ``client``
+    """
+    marshall = client._marshall
+    request_async = marshall.request_async
+
+    def timed(request_type, request, on_success, on_error=None,
+              *args, **kwargs):
+        start = time.perf_counter()
+
+        def timed_on_success(response_type, response, *rest):
+            size = len(request) + len(response)
+            if response_type == messages.RRead.type_id and \
+                    len(response) == messages.rread_count.size:
+                # the data was read straight into the caller's buffer, so
+                # only the count is left in the response
+                size += messages.rread_count.unpack(response)[0]
+            recorder.record(_message_names.get(request_type, request_type),
+                            time.perf_counter() - start, size)
+            on_success(response_type, response, *rest)
+
+        return request_async(request_type, request,
+                             timed_on_success, on_error, *args, **kwargs)
+
+    marshall.request_async = timed
+
+
+def percentile(values, fraction):
+    """ Nearest rank percentile of a sorted list
+    """
+    if not values:
+        return 0.0
+    index = math.ceil(fraction * len(values)) - 1
+    return values[max(0, min(len(values) - 1, index))]
+
+
+def parse_workload(spec):
+    if spec in WORKLOADS:
+        return WORKLOADS[spec]
+    mix = {}
+    for item in spec.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError("unknown operation %r" % name)
+        mix[name] = int(weight or 1)
+    return mix
+
+
+def int_list(spec):
+    return [int(value, 0) for value in spec.split(',')]
+
+
+class Fixture(object):
+    """ Files used by the benchmark operations, created under ``root`` on
+    the server
+    """
+    def __init__(self, root, files, file_size, bulk_size):
+        self.root = root.strip('/')
+        self.small = ["%s/small/%04i" % (self.root, i) for i in range(files)]
+        self.big = "%s/big" % self.root
+        self.file_size = file_size
+        self.bulk_size = bulk_size
+        self.payload = os.urandom(file_size)
+
+        self._tempdir = tempfile.TemporaryDirectory(prefix="pyixp-bench")
+        self.source = os.path.join(self._tempdir.name, "source")
+        with open(self.source, 'wb') as f:
+            f.write(os.urandom(bulk_size))
+
+    def local_path(self):
+        return os.path.join(self._tempdir.name,
+                            "download-%i" % threading.get_ident())
+
+    def create(self, client):
+        client.mkdir(self.root)
+        client.mkdir(self.root + "/small")
+        for path in self.small:
+            client.create_file(path, self.payload)
+        client.upload(self.source, self.big)
+
+    def remove(self, client):
+        for path in self.small + [self.big, self.root + "/small", self.root]:
+            try:
+                client.remove_path(path)
+            except ServerError:
+                pass
+
+    def cleanup(self):
+        self._tempdir.cleanup()
+
+
+def _op_stat(client, fixture, rng, depth):
+    client.stat_path(rng.choice(fixture.small))
+
+
+def _op_read(client, fixture, rng, depth):
+    client.read_file(rng.choice(fixture.small))
+
+
+def _op_write(client, fixture, rng, depth):
+    client.write_file(rng.choice(fixture.small), fixture.payload)
+
+
+def _op_bulk_read(client, fixture, rng, depth):
+    client.download(fixture.big, fixture.local_path(), depth=depth)
+
+
+def _op_bulk_write(client, fixture, rng, depth):
+    client.upload(fixture.source, fixture.big, depth=depth)
+
+
+def _op_listdir(client, fixture, rng, depth):
+    for entry in client.listdir(fixture.root + "/small"):
+        pass
+
+
+OPERATIONS = {
+    "stat": _op_stat,
+    "read": _op_read,
+    "write": _op_write,
+    "bulk-read": _op_bulk_read,
+    "bulk-write": _op_bulk_write,
+    "listdir": _op_listdir,
+}
+
+
+def run(connect, fixture, mix, concurrency, depth, msize, uname,
+        duration=None, ops=None, seed=0):
+    """ Run a single benchmark configuration.
+
+    :param connect: function returning a new connection to the server.
+
+    :param ops: number of operations to run in each thread.  Overrides
+        ``duration``.
+
+    :returns: ``(elapsed, Recorder)``
+    """
+    client = Client(connect(), msize, uname=uname)
+    recorder = Recorder()
+    recorder.msize = client.max_message_size
+    instrument(client, recorder)
+
+    names = sorted(mix)
+    weights = [mix[name] for name in names]
+    errors = []
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        if ops is not None:
+            counter = range(ops)
+            deadline = None
+        else:
+            counter = itertools.count()
+            deadline = start + duration
+        try:
+            for _ in counter:
+                if deadline is not None and time.perf_counter() > deadline:
+                    return
+                name = rng.choices(names, weights)[0]
+                op_start = time.perf_counter()
+                OPERATIONS[name](client, fixture, rng, depth)
+                recorder.record(name, time.perf_counter() - op_start)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True)
+               for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    client.close()
+    if errors:
+        raise errors[0]
+    return elapsed, recorder
+
+
+def report(out, elapsed, recorder, mix):
+    total_ops = sum(len(recorder.latencies[name]) for name in mix)
+    out.write("  negotiated msize=%i\n" % recorder.msize)
+    out.write("  %i ops in %.2fs: %.1f ops/s, %.2f MB/s\n" % (
+        total_ops, elapsed, total_ops / elapsed,
+        recorder.bytes / elapsed / 1e6))
+    out.write("  %-12s %8s %10s %10s %10s\n" % (
+        "", "count", "p50 ms", "p99 ms", "p999 ms"))
+    for name in sorted(recorder.latencies, key=str):
+        values = sorted(recorder.latencies[name])
+        out.write("  %-12s %8i %10.3f %10.3f %10.3f\n" % (
+            name, len(values),
+            percentile(values, 0.5) * 1e3,
+            percentile(values, 0.99) * 1e3,
+            percentile(values, 0.999) * 1e3))
+
+
+def main(argv=None, out=sys.stdout):
+    parser = argparse.ArgumentParser(
+        prog="pyixp-bench",
+        description="Generate load against a 9P server and report "
+                    "throughput and latency percentiles")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument(
+        "--address",
+        help="dial string of the server, eg. unix!/tmp/sock or tcp!host!564")
+    target.add_argument(
+        "--fake", action="store_true",
+        help="benchmark against an in-process server with a memory backend")
+    parser.add_argument(
+        "--workload", type=parse_workload, default="stat-heavy",
+        help="one of %s or a mix such as stat=3,read=1 of the operations %s"
+             % (", ".join(sorted(WORKLOADS)), ", ".join(sorted(OPERATIONS))))
+    parser.add_argument(
+        "--concurrency", type=int_list, default=[1],
+        help="comma separated numbers of threads issuing operations")
+    parser.add_argument(
+        "--depth", type=int_list, default=[16],
+        help="comma separated numbers of requests to pipeline in bulk "
+             "transfers")
+    parser.add_argument(
+        "--msize", type=int_list, default=[0x10000],
+        help="comma separated maximum message sizes to request, eg. "
+             "8192,65536,1048576 with --workload bulk to compare throughput")
+    parser.add_argument(
+        "--shm", action="store_true",
+        help="offer the shared memory transport on unix connections")
+    parser.add_argument("--duration", type=float, default=5.0,
+                        help="seconds to run each configuration for")
+    parser.add_argument("--ops", type=int,
+                        help="operations per thread, instead of a duration")
+    parser.add_argument("--uname", default=os.environ.get("USER", "none"))
+    parser.add_argument("--root", default="pyixp-bench",
+                        help="directory to create benchmark files in")
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--file-size", type=int, default=1024)
+    parser.add_argument("--bulk-size", type=int, default=8 << 20)
+    parser.add_argument("--keep", action="store_true",
+                        help="don't remove the benchmark files")
+    args = parser.parse_args(argv)
+
+    if args.fake:
+        # large enough not to cap any of the sizes being compared
+        server = Server(MemoryFS(), max_message_size=max(args.msize))
+
+        def dial_server():
+            client_socket, server_socket = socket.socketpair()
+            server.serve_connection(server_socket)
+            return client_socket
+    else:
+        server = None
+
+        def dial_server():
+            return dial(args.address)
+
+    def connect():
+        if args.shm:
+            return shm.connect(dial_server())
+        return dial_server()
+
+    fixture = Fixture(args.root, args.files, args.file_size, args.bulk_size)
+    setup_client = Client(connect(), uname=args.uname)
+    try:
+        fixture.create(setup_client)
+        for msize, concurrency, depth in itertools.product(
+                args.msize, args.concurrency, args.depth):
+            out.write("msize=%i concurrency=%i depth=%i\n" % (
+                msize, concurrency, depth))
+            elapsed, recorder = run(
+                connect, fixture, args.workload, concurrency, depth, msize,
+                args.uname, duration=args.duration, ops=args.ops)
+            report(out, elapsed, recorder, args.workload)
+    finally:
+        if not args.keep:
+            fixture.remove(setup_client)
+        setup_client.close()
+        fixture.cleanup()
+        if server is not None:
+            server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import logging
+
+from collections import OrderedDict
+from threading import Lock
+
+__all__ = 'PageCache',
+
+log = logging.getLogger(__name__)
+
+
+class PageCache(object):
+    """ Least recently used cache of file contents shared by all files opened
+    by a client.
+
+    Pages are keyed by ``(qid.path, qid.version, index)`` so a file that has
+    been modified on the server will have a different version and will not
+    match stale pages.  The last page of a file is stored short, which marks
+    the end of the file.
+    """
+
+    def __init__(self, max_bytes=0x4000000, page_size=0x10000):
+        """
+        :param max_bytes: upper limit on the total size of all cached pages.
+            Least recently used pages are evicted to stay under it.
+
+        :param page_size: number of bytes of file data stored per page.
+        """
+        self.max_bytes = max_bytes
+        self.page_size = page_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = Lock()
+        self._size = 0
+
+        # map from ``(path, version, index)`` to page data, in order of use
+        self._pages = OrderedDict()
+
+        # map from qid path to the set of keys for pages of that file so that
+        # a file can be invalidated without scanning the whole cache
+        self._files = {}
+
+    def get(self, path, version, index):
+        """
+        :returns: the data for the page, or None if it is not cached
+        """
+        key = (path, version, index)
+        with self._lock:
+            page = self._pages.get(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._pages.move_to_end(key)
+            return page
+
+    def put(self, path, version, index, data):
+        if len(data) > self.max_bytes:
+            return
+
+        key = (path, version, index)
+        with self._lock:
+            if key in self._pages:
+                self._discard(key)
+            self._pages[key] = data
+            self._files.setdefault(path, set()).add(key)
+            self._size += len(data)
+
+            while self._size > self.max_bytes:
+                self._discard(next(iter(self._pages)))
+                self.evictions += 1
+
+    def invalidate(self, path, version=None, first=0, last=None):
+        """ Drop cached pages for the file with qid path ``path``.
+
+        :param version: only drop pages cached for this version.
+
+        :param first: index of the first page to drop.
+
+        :param last: index of the last page to drop.  Defaults to the end of
+            the file.
+        """
+        with self._lock:
+            for key in list(self._files.get(path, ())):
+                _, page_version, index = key
+                if version is not None and page_version != version:
+                    continue
+                if index < first or (last is not None and index > last):
+                    continue
+                self._discard(key)
+
+    def retain_version(self, path, version):
+        """ Drop pages cached for all versions of a file other than
+        ``version``
+        """
+        with self._lock:
+            for key in list(self._files.get(path, ())):
+                if key[1] != version:
+                    self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._files.clear()
+            self._size = 0
+
+    def _discard(self, key):
+        page = self._pages.pop(key)
+        self._size -= len(page)
+        keys = self._files[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._files[key[0]]
+
+    @property
+    def size(self):
+        """ Total number of bytes of cached file data
+        """
+        return self._size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "pages": len(self._pages),
+                "size": self._size,
+            }
@@ -1,4 +1,19 @@
+import errno
+import io
+import mmap
+import os
+import socket
+import time
+
+from collections import deque
+from functools import partial
+from queue import Queue
+from threading import Condition, Lock
+
+from pyixp.dialects import BASE
+from pyixp.events import EventStream
 from pyixp.marshall import Marshall
+from pyixp import messages
 from pyixp import requests
 
 import logging
@@ -7,18 +22,393 @@ log = logging.getLogger(__name__)
 
 VERSION = "9P2000"
 
+# largest message size requested from servers by default.  The server may
+# answer with a smaller size, which is then used
+DEFAULT_MESSAGE_SIZE = 0x00100000
+
+
+def dial(address):
+    """ Connect to a server given a plan 9 style dial string such as
+    ``unix!/tmp/ns.user.:0/wmii`` or ``tcp!localhost!564``.
+
+    :returns: a connected socket
+    """
+    parts = address.split('!')
+    if parts[0] == 'unix' and len(parts) == 2:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(parts[1])
+        except:
+            sock.close()
+            raise
+        return sock
+    if parts[0] == 'tcp' and len(parts) == 3:
+        sock = socket.create_connection((parts[1], int(parts[2])))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+    raise ValueError("invalid address: %r" % address)
+
+
+def _split_path(path):
+    """ Convert a slash separated path, or a sequence of names, to a list of
+    names that can be passed to walk
+    """
+    if isinstance(path, str):
+        return [name for name in path.split('/') if name]
+    return list(path)
+
+
+class _FidPool(object):
+    """ Hands out fids that are not currently in use by the client.  Fids are
+    recycled once they have been clunked.
+    """
+    def __init__(self, first=1):
+        self._lock = Lock()
+        self._free = []
+        self._next = first
+
+    def get(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            fid = self._next
+            if fid >= messages.NOFID:
+                raise Exception("out of fids")
+            self._next += 1
+            return fid
+
+    def put(self, fid):
+        with self._lock:
+            self._free.append(fid)
+
+
+class _Transfer(object):
+    """ Keeps up to ``depth`` reads or writes in flight until every chunk of a
+    file has been transfered.
+
+    ``submit(offset, count, done, fail)`` should start transferring a chunk
+    without blocking and call ``done`` with the number of bytes actually
+    transfered, or ``fail`` with an exception.  Short transfers are
+    resubmitted for the remainder of the chunk.  A transfer of zero bytes marks
+    the end of the file.
+    """
+    def __init__(self, chunks, submit, depth, total,
+                 progress=None, interval=1.0):
+        self._chunks = deque(chunks)
+        self._submit = submit
+        self._depth = depth
+        self._progress = progress
+        self._interval = interval
+
+        self._cond = Condition()
+        self._in_flight = 0
+        self._error = None
+
+        self.total = total
+        self.transferred = 0
+        self.end = total
+
+    def _fill(self):
+        # must be called with the lock held
+        while self._chunks and self._in_flight < self._depth \
+                and self._error is None:
+            offset, count = self._chunks.popleft()
+            self._in_flight += 1
+            self._submit(offset, count,
+                         partial(self._done, offset, count), self._fail)
+
+    def _done(self, offset, count, transferred):
+        with self._cond:
+            self._in_flight -= 1
+            self.transferred += transferred
+            if transferred == 0:
+                self.end = min(self.end, offset)
+                self._chunks = deque(
+                    chunk for chunk in self._chunks if chunk[0] < self.end)
+            elif transferred < count:
+                self._chunks.appendleft(
+                    (offset + transferred, count - transferred))
+            self._fill()
+            self._cond.notify_all()
+
+    def _fail(self, error):
+        with self._cond:
+            self._in_flight -= 1
+            if self._error is None:
+                self._error = error
+            self._cond.notify_all()
+
+    def run(self):
+        """ Block until the transfer is complete, reporting progress every
+        ``interval`` seconds.  Any error is raised once all outstanding
+        requests have finished.
+        """
+        start = time.monotonic()
+        with self._cond:
+            self._fill()
+        while True:
+            with self._cond:
+                if not self._in_flight:
+                    break
+                self._cond.wait(self._interval)
+                finished = not self._in_flight
+            if not finished:
+                _report_progress(self._progress, self.transferred,
+                                 self.total, start)
+
+        if self._error is not None:
+            raise self._error
+        _report_progress(self._progress, self.transferred, self.total, start)
+        return self.transferred
+
+
+def _report_progress(progress, transferred, total, start):
+    if progress is not None:
+        elapsed = time.monotonic() - start
+        rate = transferred / elapsed if elapsed else 0.0
+        progress(transferred, total, rate)
+
+
+def _chunks(size, chunk_size):
+    return ((offset, min(chunk_size, size - offset))
+            for offset in range(0, size, chunk_size))
+
+
+def _cacheable(qid):
+    """ Returns true if the contents of the file identified by ``qid`` can be
+    cached.
+
+    Synthetic file servers such as wmii never change the version of their
+    files, so files with a version of zero are assumed to be uncachable.
+    """
+    if qid["type"] & (messages.QTDIR | messages.QTAPPEND | messages.QTEXCL):
+        return False
+    return qid["version"] != 0
+
+
+class File(io.RawIOBase):
+    """ File-like wrapper around an open fid.  Should be created using
+    ``Client.open_file``.
+    """
+
+    def __init__(self, client, fid, qid, iounit, mode):
+        super(File, self).__init__()
+        self._client = client
+        self._fid = fid
+        self._qid = qid
+        self._mode = mode
+        self._io_size = client._io_size(iounit)
+        self._position = 0
+
+        self._cache = client._page_cache
+        if self._cache is not None:
+            if _cacheable(qid):
+                self._cache.retain_version(qid["path"], qid["version"])
+                if mode & messages.OTRUNC:
+                    self._cache.invalidate(qid["path"])
+            else:
+                self._cache = None
+
+    @property
+    def fid(self):
+        return self._fid
+
+    @property
+    def qid(self):
+        return self._qid
+
+    def readable(self):
+        return self._mode & 0x03 in (messages.OREAD, messages.ORDWR,
+                                     messages.OEXEC)
+
+    def writable(self):
+        return self._mode & 0x03 in (messages.OWRITE, messages.ORDWR)
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.stat()["length"]
+        elif whence != io.SEEK_SET:
+            raise ValueError("invalid whence")
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._position = offset
+        return offset
+
+    def stat(self):
+        """ Fetch the stat record for the file from the server.  Cached pages
+        are dropped if the version of the file has changed.
+        """
+        stat = self._client._stat(self._fid)
+        if self._cache is not None and \
+                stat["qid"]["version"] != self._qid["version"]:
+            self._qid = stat["qid"]
+            self._cache.retain_version(self._qid["path"],
+                                       self._qid["version"])
+        return stat
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        if self._cache is not None:
+            data = self._read_cached(self._position, len(view))
+        else:
+            count = requests.ReadRequest(
+                self._fid, self._position, min(len(view), self._io_size)
+            ).submit_into(self._client._marshall, view)
+            self._position += count
+            return count
+        view[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def _read_cached(self, offset, count):
+        index, start = divmod(offset, self._cache.page_size)
+        path, version = self._qid["path"], self._qid["version"]
+
+        page = self._cache.get(path, version, index)
+        if page is None:
+            page = self._read_page(index)
+            self._cache.put(path, version, index, page)
+        return page[start:start + count]
+
+    def _read_page(self, index):
+        page_size = self._cache.page_size
+        offset = index * page_size
+        chunks = []
+        remaining = page_size
+        while remaining:
+            data = self._client.read(
+                self._fid, offset, min(remaining, self._io_size)
+            ).data
+            if not data:
+                break
+            chunks.append(data)
+            offset += len(data)
+            remaining -= len(data)
+        return b''.join(chunks)
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        start = self._position
+        written = 0
+        try:
+            while written < len(view):
+                chunk = bytes(view[written:written + self._io_size])
+                count = self._client.write(
+                    self._fid, start + written, chunk
+                ).count
+                if count == 0:
+                    break
+                written += count
+        finally:
+            self._position = start + written
+            if self._cache is not None and written:
+                page_size = self._cache.page_size
+                self._cache.invalidate(
+                    self._qid["path"], self._qid["version"],
+                    start // page_size, (start + written - 1) // page_size)
+        return written
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._client._clunk(self._fid)
+            finally:
+                super(File, self).close()
+
+
+class _FdFile(io.FileIO):
+    """ Descriptor received in an ``ROpenFD``, which clunks the fid it was
+    opened on once closed.  Should be created using ``Client.fdopen``.
+    """
+
+    def __init__(self, client, fid, fd, mode):
+        super(_FdFile, self).__init__(fd, mode)
+        self._client = client
+        self._fid = fid
+
+    def close(self):
+        fid, self._fid = self._fid, None
+        try:
+            super(_FdFile, self).close()
+        finally:
+            if fid is not None:
+                self._client._clunk(fid)
+
 
 class Client(object):
-    def __init__(self, connection, max_message_size=0x0000ffff):
-        self._marshall = Marshall(connection)
+    def __init__(self, connection, max_message_size=DEFAULT_MESSAGE_SIZE,
+                 uname=None, aname='', page_cache=None, dialects=None):
+        """
+        :param connection: socket connected to the server, or an object such
+            as a ``pyixp.reactor.Connection`` that provides the ``request`` and
+            ``request_async`` methods of a ``Marshall``.
+
+        :param max_message_size: the largest message size, including headers,
+            to ask the server for.  The size the server answers with, which
+            may be smaller, is used for the rest of the session and is
+            available as ``max_message_size``.
+
+        :param uname: if given, the client will attach to the server as this
+            user and the root of the attached tree will be used as the starting
+            point for all of the path based methods.
+
+        :param page_cache: a ``pyixp.cache.PageCache`` used to cache the
+            contents of files opened with ``open_file``.
+        :type page_cache: PageCache
+
+        :param dialects: sequence of ``pyixp.dialects.Dialect`` to offer to the
+            server, most preferred first.  Each is offered in turn until the
+            server accepts one.  A server may also answer with plain 9P2000,
+            which is accepted even if it wasn't offered.  Defaults to plain
+            9P2000.
+        """
+        if hasattr(connection, 'request_async'):
+            self._marshall = connection
+        else:
+            self._marshall = Marshall(connection)
+        self._page_cache = page_cache
 
-        resp = self.version(max_message_size, VERSION)
+        if dialects is None:
+            dialects = (BASE,)
+        offered = {dialect.version: dialect for dialect in dialects}
+        # every server can fall back to the base protocol
+        offered.setdefault(BASE.version, BASE)
+        for dialect in dialects:
+            resp = self.version(max_message_size, dialect.version)
+            # servers reply with "unknown", or with an older version they do
+            # understand
+            if resp.version != "unknown":
+                break
+        if resp.version not in offered:
+            raise Exception("unsupported version")
+        # the server may only lower the size, and must leave room for the
+        # data of reads and writes
         if resp.msize > max_message_size:
             raise Exception("invalid message size requested by server")
-        if resp.version != VERSION:
-            raise Exception("unsupported version")
+        if resp.msize <= messages.IOHDRSZ:
+            raise Exception("message size too small: %i" % resp.msize)
+        self.dialect = offered[resp.version]
         self._max_message_size = self._marshall.max_message_size = resp.msize
 
+        self._fids = _FidPool()
+        self._root = None
+        if uname is not None:
+            self.attach_root(uname, aname)
+
+    @property
+    def max_message_size(self):
+        """ the message size negotiated with the server
+        """
+        return self._max_message_size
+
     def version(self, *args, **kwargs):
         return requests.VersionRequest(*args, **kwargs).submit(self._marshall)
 
@@ -61,6 +451,661 @@ class Client(object):
     def openfd(self, *args, **kwargs):
         return requests.OpenFDRequest(*args, **kwargs).submit(self._marshall)
 
+    def attach_root(self, uname, aname=''):
+        """ Attach to the file tree ``aname`` on the server and use it as the
+        root for all path based methods
+        """
+        fid = self._fids.get()
+        try:
+            self.dialect.attach(fid, messages.NOFID, uname, aname).submit(
+                self._marshall)
+        except:
+            self._fids.put(fid)
+            raise
+        if self._root is not None:
+            self._clunk(self._root)
+        self._root = fid
+
+    def _open(self, fid, mode):
+        return self.dialect.open(fid, mode).submit(self._marshall)
+
+    def _stat(self, fid, name=''):
+        """ :returns: stat dictionary for ``fid``, whichever dialect is in use
+        """
+        return self.dialect.stat(fid, name).submit(self._marshall)
+
+    def _io_size(self, iounit=0):
+        """ Returns the maximum number of bytes that can be transfered by a
+        single read or write
+        """
+        size = self._max_message_size - messages.IOHDRSZ
+        if iounit and iounit < size:
+            return iounit
+        return size
+
+    def _walk(self, path):
+        """ Walk from the root to ``path`` and return a new fid pointing at the
+        result.  The caller is responsible for clunking the returned fid.
+        """
+        if self._root is None:
+            raise Exception("not attached")
+
+        names = _split_path(path)
+        newfid = self._fids.get()
+        bound = False
+        try:
+            fid = self._root
+            while True:
+                step, names = names[:messages.MAXWELEM], \
+                    names[messages.MAXWELEM:]
+                resp = self.walk(fid, newfid, step)
+                if len(resp.qid) != len(step):
+                    raise requests.ServerError("file does not exist",
+                                               errno.ENOENT)
+                bound = True
+                fid = newfid
+                if not names:
+                    return newfid
+        except:
+            if bound:
+                self._clunk(newfid)
+            else:
+                self._fids.put(newfid)
+            raise
+
+    def _clunk(self, fid):
+        try:
+            self.clunk(fid)
+        finally:
+            self._fids.put(fid)
+
+    def _read_chunks(self, fid, count, offset=0):
+        """ Generator that reads from an open fid until the end of the file,
+        yielding data as it is received
+        """
+        while True:
+            data = self.read(fid, offset, count).data
+            if not data:
+                return
+            yield data
+            offset += len(data)
+
+    def _create(self, path, perm, mode):
+        """ Create a new file at ``path``.
+
+        :returns: ``(fid, response)`` where fid refers to the new file, opened
+            with ``mode``.
+        """
+        names = _split_path(path)
+        if not names:
+            raise ValueError("invalid path")
+        fid = self._walk(names[:-1])
+        try:
+            resp = self.dialect.create(fid, names[-1], perm, mode).submit(
+                self._marshall)
+        except:
+            self._clunk(fid)
+            raise
+        return fid, resp
+
+    def mkdir(self, path, perm=0o755):
+        names = _split_path(path)
+        if not names:
+            raise ValueError("invalid path")
+        fid = self._walk(names[:-1])
+        try:
+            self.dialect.mkdir(fid, names[-1], perm).submit(self._marshall)
+        finally:
+            self._clunk(fid)
+
+    def create_file(self, path, data=b'', perm=0o644):
+        """ Create a new file at ``path`` containing ``data``
+        """
+        fid, resp = self._create(path, perm, messages.OWRITE)
+        try:
+            count = self._io_size(resp.iounit)
+            for offset in range(0, len(data), count):
+                chunk = data[offset:offset + count]
+                if self.write(fid, offset, chunk).count != len(chunk):
+                    raise Exception("short write")
+        finally:
+            self._clunk(fid)
+
+    def open_file(self, path, mode=messages.OREAD):
+        """ Open the file at ``path`` and wrap it in a file-like object.  The
+        fid is clunked when the file is closed.
+
+        :param mode: 9P open mode, for example ``messages.ORDWR``.
+
+        :rtype: File
+        """
+        fid = self._walk(path)
+        try:
+            resp = self._open(fid, mode)
+        except:
+            self._clunk(fid)
+            raise
+        return File(self, fid, resp.qid, resp.iounit, mode)
+
+    def events(self, path, depth=4, separator=b'\n', callback=None):
+        """ Open a stream of events from a file that blocks until there is
+        something to read, such as wmii's ``/event``.  See ``EventStream``.
+
+        :rtype: EventStream
+        """
+        return EventStream(self, path, depth, separator, callback)
+
+    def fdopen(self, path, mode=messages.OREAD, buffering=-1):
+        """ Open the file at ``path`` using ``TOpenFD``.  Servers on the same
+        host hand back a file descriptor over the unix socket, so subsequent
+        reads and writes go straight to the kernel rather than through 9P.
+
+        The server may tie the descriptor to the open fid, so the fid is kept
+        until the returned file is closed.
+
+        :returns: a python file object wrapping the received descriptor.
+        """
+        fid = self._walk(path)
+        try:
+            resp = self.openfd(fid, mode)
+        except:
+            self._clunk(fid)
+            raise
+
+        access = mode & 0x03
+        if access == messages.OWRITE:
+            raw_mode, buffered = 'w', io.BufferedWriter
+        elif access == messages.ORDWR:
+            raw_mode, buffered = 'r+', io.BufferedRandom
+        else:
+            raw_mode, buffered = 'r', io.BufferedReader
+
+        try:
+            raw = _FdFile(self, fid, resp.unixfd, raw_mode)
+        except:
+            os.close(resp.unixfd)
+            self._clunk(fid)
+            raise
+        if buffering == 0:
+            return raw
+        try:
+            if buffering < 0:
+                buffering = io.DEFAULT_BUFFER_SIZE
+            return buffered(raw, buffering)
+        except:
+            raw.close()
+            raise
+
+    def download(self, path, local_path, depth=16, use_mmap=True,
+                 progress=None, interval=1.0):
+        """ Copy the file at ``path`` to ``local_path``.
+
+        The local file is preallocated and up to ``depth`` reads are kept in
+        flight at once.  Responses may arrive in any order and each is copied
+        directly to its offset in the local file, either through an ``mmap``
+        of the file or using ``os.pwrite``.
+
+        :param progress: ``(transferred, total, bytes_per_second) -> None``
+            called every ``interval`` seconds and once the transfer completes.
+
+        :returns: the number of bytes copied.
+        """
+        fid = self._walk(path)
+        try:
+            resp = self._open(fid, messages.OREAD)
+            count = self._io_size(resp.iounit)
+            size = self._stat(fid)["length"]
+
+            fd = os.open(local_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                         0o666)
+            try:
+                if not size:
+                    # synthetic files often report a length of zero, so the
+                    # only option is to read until the end of file
+                    start = time.monotonic()
+                    transferred = 0
+                    for data in self._read_chunks(fid, count):
+                        os.write(fd, data)
+                        transferred += len(data)
+                    _report_progress(progress, transferred, transferred,
+                                     start)
+                    return transferred
+
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except (AttributeError, OSError):
+                    os.ftruncate(fd, size)
+
+                target = mmap.mmap(fd, size) if use_mmap else None
+                view = memoryview(target) if use_mmap else None
+
+                def submit(offset, count, done, fail):
+                    if view is not None:
+                        # responses are received straight into the mapping
+                        requests.ReadRequest(fid, offset, count) \
+                            .submit_into_async(
+                                self._marshall,
+                                view[offset:offset + count], done, fail)
+                        return
+
+                    def received(resp):
+                        data = resp.data
+                        try:
+                            os.pwrite(fd, data, offset)
+                        except Exception as error:
+                            fail(error)
+                            return
+                        done(len(data))
+
+                    requests.ReadRequest(fid, offset, count).submit_async(
+                        self._marshall, received, fail)
+
+                transfer = _Transfer(_chunks(size, count), submit, depth,
+                                     size, progress, interval)
+                try:
+                    transferred = transfer.run()
+                finally:
+                    if target is not None:
+                        view.release()
+                        target.close()
+
+                if transfer.end < size:
+                    # the file shrank while it was being copied
+                    os.ftruncate(fd, transfer.end)
+                return transferred
+            finally:
+                os.close(fd)
+        finally:
+            self._clunk(fid)
+
+    def upload(self, local_path, path, depth=16, perm=0o644,
+               progress=None, interval=1.0):
+        """ Copy ``local_path`` to the file at ``path``, creating it with
+        permissions ``perm`` if it does not exist.  Up to ``depth`` writes are
+        kept in flight at once.
+
+        :returns: the number of bytes copied.
+        """
+        try:
+            fid = self._walk(path)
+        except requests.ServerError:
+            fid, resp = self._create(path, perm, messages.OWRITE)
+        else:
+            try:
+                resp = self._open(fid, messages.OWRITE | messages.OTRUNC)
+            except:
+                self._clunk(fid)
+                raise
+
+        try:
+            fd = os.open(local_path, os.O_RDONLY)
+            try:
+                size = os.fstat(fd).st_size
+
+                def submit(offset, count, done, fail):
+                    data = os.pread(fd, count, offset)
+                    if not data:
+                        done(0)
+                        return
+                    requests.WriteRequest(fid, offset, data).submit_async(
+                        self._marshall, lambda resp: done(resp.count), fail)
+
+                transfer = _Transfer(_chunks(size, self._io_size(resp.iounit)),
+                                     submit, depth, size, progress, interval)
+                return transfer.run()
+            finally:
+                os.close(fd)
+        finally:
+            self._clunk(fid)
+
+    def _compound(self, path, steps, final=requests.ClunkRequest):
+        """ Walk to ``path`` and run a chain of requests on the resulting fid
+        in a single round trip.
+
+        As the client chooses the fid, the walk, each request returned by
+        calling ``steps`` with the new fid, and a final request that releases
+        the fid (``TClunk`` or ``TRemove``) are all sent without waiting for
+        the previous reply.  Servers process requests for a fid in order, so
+        if a step fails every step after it will fail as a consequence.  The
+        first error is raised and the rest are ignored.
+
+        :returns: list of the responses to each of ``steps``
+        """
+        if self._root is None:
+            raise Exception("not attached")
+
+        names = _split_path(path)
+        start = self._root
+        if len(names) > messages.MAXWELEM:
+            # a single walk either succeeds completely or leaves the new fid
+            # unbound.  Walking the prefix first means that requests can never
+            # be applied to an intermediate directory by mistake
+            start = self._walk(names[:-messages.MAXWELEM])
+            names = names[-messages.MAXWELEM:]
+
+        fid = self._fids.get()
+        try:
+            chain = [requests.WalkRequest(start, fid, names)]
+            chain.extend(step(fid) for step in steps)
+            chain.append(final(fid))
+
+            cond = Condition()
+            results = [None] * len(chain)
+            remaining = [len(chain)]
+
+            def store(index, success, value):
+                with cond:
+                    results[index] = (success, value)
+                    remaining[0] -= 1
+                    if not remaining[0]:
+                        cond.notify()
+
+            with cond:
+                for index, request in enumerate(chain):
+                    try:
+                        request.submit_async(self._marshall,
+                                             partial(store, index, True),
+                                             partial(store, index, False))
+                    except Exception as error:
+                        # nothing will arrive for the requests that were
+                        # never sent, so they fail with the same error
+                        for unsent in range(index, len(chain)):
+                            results[unsent] = (False, error)
+                        remaining[0] -= len(chain) - index
+                        last = len(chain) - 1
+                        if 0 < index < last:
+                            # the fid may be bound, so still try to release
+                            # it before it goes back to the pool
+                            try:
+                                chain[last].submit_async(
+                                    self._marshall,
+                                    partial(store, last, True),
+                                    partial(store, last, False))
+                                remaining[0] += 1
+                            except Exception:
+                                pass
+                        break
+                while remaining[0]:
+                    cond.wait()
+        finally:
+            # the final request releases the fid on the server whether or not
+            # it succeeds, or the walk failed and the fid was never bound
+            self._fids.put(fid)
+            if start != self._root:
+                self._clunk(start)
+
+        success, value = results[0]
+        if not success:
+            raise value
+        if len(value.qid) != len(names):
+            raise requests.ServerError("file does not exist", errno.ENOENT)
+        for success, value in results[1:]:
+            if not success:
+                raise value
+        return [value for success, value in results[1:-1]]
+
+    def read_file(self, path):
+        """ Read the entire contents of the file at ``path``.
+
+        Files that fit in a single message are read in one round trip.
+        """
+        count = self._io_size()
+        open_resp, read_resp = self._compound(path, [
+            lambda fid: self.dialect.open(fid, messages.OREAD),
+            lambda fid: requests.ReadRequest(fid, 0, count),
+        ])
+        data = read_resp.data
+        # servers may shorten reads to the iounit of the fid
+        if len(data) < self._io_size(open_resp.iounit):
+            return data
+
+        fid = self._walk(path)
+        try:
+            self._open(fid, messages.OREAD)
+            chunks = [data]
+            chunks.extend(self._read_chunks(
+                fid, self._io_size(open_resp.iounit), len(data)))
+            return b''.join(chunks)
+        finally:
+            self._clunk(fid)
+
+    def write_file(self, path, data, mode=messages.OWRITE | messages.OTRUNC):
+        """ Replace the contents of the existing file at ``path`` with
+        ``data`` in a single round trip.  All writes are sent at once so this
+        is best suited to small files.  If the server shortens any of them,
+        for example to the iounit of the fid, the rest is written afterwards.
+
+        :param mode: mode used to open the file.  Pass ``messages.OWRITE`` to
+            overwrite the start of the file without truncating it.
+        """
+        count = self._io_size()
+        steps = [lambda fid: self.dialect.open(fid, mode)]
+        for offset in range(0, len(data), count):
+            steps.append(partial(
+                lambda offset, fid: requests.WriteRequest(
+                    fid, offset, data[offset:offset + count]), offset))
+
+        responses = self._compound(path, steps)
+        gaps = []
+        for offset, resp in zip(range(0, len(data), count), responses[1:]):
+            end = min(offset + count, len(data))
+            if offset + resp.count < end:
+                gaps.append((offset + resp.count, end))
+        if gaps:
+            self._write_ranges(path, data, gaps, mode & ~messages.OTRUNC,
+                               responses[0].iounit)
+        return len(data)
+
+    def _write_ranges(self, path, data, ranges, mode, iounit):
+        """ Write the ``(start, end)`` ranges of ``data`` to the file at
+        ``path`` in pieces no bigger than ``iounit``
+        """
+        fid = self._walk(path)
+        try:
+            self._open(fid, mode)
+            size = self._io_size(iounit)
+            for start, end in ranges:
+                while start < end:
+                    written = self.write(
+                        fid, start, data[start:min(end, start + size)]).count
+                    if written == 0:
+                        raise Exception("short write")
+                    start += written
+        finally:
+            self._clunk(fid)
+
+    def stat_path(self, path):
+        """ Return the stat record for the file at ``path`` in a single round
+        trip
+        """
+        names = _split_path(path)
+        stat, = self._compound(path, [
+            lambda fid: self.dialect.stat(fid, names[-1] if names else ''),
+        ])
+        return stat
+
+    def remove_path(self, path):
+        """ Remove the file at ``path`` in a single round trip
+        """
+        self._compound(path, [], final=requests.RemoveRequest)
+
+    def listdir(self, path=''):
+        """ Generator yielding the stat of each entry in the directory at
+        ``path``.
+
+        The directory is read one message at a time and entries are decoded as
+        soon as they are received, so memory use does not depend on the size
+        of the directory.  The directory is clunked once the generator is
+        exhausted or closed.
+        """
+        fid = self._walk(path)
+        try:
+            resp = self._open(fid, messages.OREAD)
+            count = self._io_size(resp.iounit)
+            cursor = None
+            while True:
+                entries, cursor = self.dialect.readdir_request(
+                    fid, cursor, count).submit(self._marshall)
+                for entry in entries:
+                    # skip the . and .. entries returned by TReadDir
+                    if entry["name"] not in ('.', '..'):
+                        yield entry
+                if cursor is None:
+                    return
+        finally:
+            self._clunk(fid)
+
+    def _clunk_async(self, fid, on_done=None):
+        """ Clunk ``fid`` without waiting for a response.  The fid is returned
+        to the pool whether or not the clunk succeeds.
+        """
+        def done(result):
+            self._fids.put(fid)
+            if on_done is not None:
+                on_done()
+
+        requests.ClunkRequest(fid).submit_async(self._marshall, done, done)
+
+    def _walk_async(self, path, on_success, on_error):
+        """ Asynchronous version of ``_walk``.  ``on_success`` is called with
+        the new fid, ``on_error`` with the exception if the walk fails.
+        Callbacks are run on the marshall's receive thread.
+        """
+        if self._root is None:
+            raise Exception("not attached")
+
+        newfid = self._fids.get()
+
+        def fail(error, bound):
+            if bound:
+                self._clunk_async(newfid)
+            else:
+                self._fids.put(newfid)
+            on_error(error)
+
+        def step(fid, names, bound):
+            current, rest = names[:messages.MAXWELEM], \
+                names[messages.MAXWELEM:]
+
+            def walked(resp):
+                if len(resp.qid) != len(current):
+                    fail(requests.ServerError("file does not exist",
+                                              errno.ENOENT), bound)
+                elif rest:
+                    step(newfid, rest, True)
+                else:
+                    on_success(newfid)
+
+            requests.WalkRequest(fid, newfid, current).submit_async(
+                self._marshall, walked, lambda error: fail(error, bound))
+
+        step(self._root, _split_path(path), False)
+
+    def _listdir_async(self, path, on_success, on_error):
+        """ Read the entire directory at ``path`` without blocking and pass the
+        list of stat records, or directory entries if the dialect lists
+        directories with ``TReadDir``, to ``on_success``
+        """
+        def walked(fid):
+            entries = []
+
+            def fail(error):
+                self._clunk_async(fid)
+                on_error(error)
+
+            def readdir(cursor, count):
+                def received(resp):
+                    listed, next_cursor = resp
+                    entries.extend(entry for entry in listed
+                                   if entry["name"] not in ('.', '..'))
+                    if next_cursor is None:
+                        self._clunk_async(fid)
+                        on_success(entries)
+                    else:
+                        readdir(next_cursor, count)
+
+                self.dialect.readdir_request(fid, cursor, count).submit_async(
+                    self._marshall, received, fail)
+
+            def opened(resp):
+                readdir(None, self._io_size(resp.iounit))
+
+            self.dialect.open(fid, messages.OREAD).submit_async(
+                self._marshall, opened, fail)
+
+        self._walk_async(path, walked, on_error)
+
+    def walk_tree(self, path='', concurrency=8, maxdepth=None,
+                  filter_dirs=None, breadth_first=False, onerror=None):
+        """ Generate ``(dirpath, dirnames, filenames)`` tuples for each
+        directory in the tree rooted at ``path``, in the manner of
+        ``os.walk``.
+
+        Up to ``concurrency`` directories are listed at once.  As results can
+        arrive in any order, ``breadth_first`` only controls the order in which
+        directories are queued to be listed.  Subdirectories are only queued
+        once their parent has been yielded, so, as with ``os.walk``, removing
+        names from ``dirnames`` will prevent them from being visited.
+
+        :param maxdepth: if set, directories more than ``maxdepth`` levels
+            below ``path`` will not be listed.
+
+        :param filter_dirs: ``(dirpath, stat) -> bool`` called for each
+            subdirectory.  Subdirectories for which it returns false are left
+            out of ``dirnames`` and will not be visited.
+
+        :param onerror: called with the exception if a directory can not be
+            listed.  Errors are ignored by default.
+        """
+        root = _split_path(path)
+
+        # directories waiting to be listed as ``(names, depth)`` pairs
+        waiting = deque([(root, 0)])
+        results = Queue()
+        in_flight = 0
+
+        def submit(names, depth):
+            self._listdir_async(
+                names,
+                lambda entries: results.put((names, depth, entries, None)),
+                lambda error: results.put((names, depth, None, error)))
+
+        while waiting or in_flight:
+            while waiting and in_flight < concurrency:
+                if breadth_first:
+                    submit(*waiting.popleft())
+                else:
+                    submit(*waiting.pop())
+                in_flight += 1
+
+            names, depth, entries, error = results.get()
+            in_flight -= 1
+
+            if error is not None:
+                if onerror is not None:
+                    onerror(error)
+                continue
+
+            dirpath = '/'.join(names)
+            dirnames = []
+            filenames = []
+            for entry in entries:
+                if entry["qid"]["type"] & messages.QTDIR:
+                    if filter_dirs is None or filter_dirs(dirpath, entry):
+                        dirnames.append(entry["name"])
+                else:
+                    filenames.append(entry["name"])
+
+            yield dirpath, dirnames, filenames
+
+            if maxdepth is not None and depth >= maxdepth:
+                continue
+            children = [(names + [name], depth + 1) for name in dirnames]
+            if not breadth_first:
+                # the last directory pushed is the first popped
+                children.reverse()
+            waiting.extend(children)
+
     def shutdown(self):
         self._marshall.shutdown()
 
@@ -0,0 +1,461 @@
+""" Extensions to 9P2000 spoken by unix oriented servers.
+
+Each dialect provides its own messages and builds the requests used by the
+path based methods of ``Client``, so that the faster messages of a dialect are
+used once it has been negotiated.
+"""
+import stat as stat_module
+
+from pyixp import fields, messages, requests
+from pyixp.messages import RLError, message_type, qid, string
+
+__all__ = [
+    "Dialect", "UnixDialect", "LinuxDialect",
+    "BASE", "UNIX", "LINUX", "DIALECTS",
+    "stat_u", "dirent",
+    "TAuthU", "TAttachU", "RErrorU", "TCreateU", "RStatU", "TWStatU",
+    "RLError",
+    "TLOpen", "RLOpen",
+    "TLCreate", "RLCreate",
+    "TGetAttr", "RGetAttr",
+    "TReadDir", "RReadDir",
+    "TMkDir", "RMkDir",
+]
+
+# value of n_uname used when the numeric id of the user is not known
+NONUNAME = 0xffffffff
+
+
+# 9P2000.u
+
+stat_u = fields.Struct(
+    ("size", fields.uint16l),
+    ("type", fields.uint16l),
+    ("dev", fields.uint32l),
+    ("qid", qid),
+    ("mode", fields.uint32l),
+    ("atime", messages.timestamp),
+    ("mtime", messages.timestamp),
+    ("length", fields.uint64l),
+    ("name", string),
+    ("uid", string),
+    ("gid", string),
+    ("muid", string),
+    ("extension", string),
+    ("n_uid", fields.uint32l),
+    ("n_gid", fields.uint32l),
+    ("n_muid", fields.uint32l))
+
+TAuthU = message_type(
+    "TAuthU", 102,
+    ("afid", fields.uint32l),
+    ("uname", string),
+    ("aname", string),
+    ("n_uname", fields.uint32l)
+)
+
+TAttachU = message_type(
+    "TAttachU", 104,
+    ("fid", fields.uint32l),
+    ("afid", fields.uint32l),
+    ("uname", string),
+    ("aname", string),
+    ("n_uname", fields.uint32l)
+)
+
+RErrorU = message_type(
+    "RErrorU", 107,
+    ("ename", string),
+    ("errno", fields.uint32l)
+)
+
+# ``extension`` describes special files such as symlinks and devices, and is
+# empty for plain files and directories
+TCreateU = message_type(
+    "TCreateU", 114,
+    ("fid", fields.uint32l),
+    ("name", string),
+    ("perm", fields.uint32l),
+    ("mode", fields.uint8),
+    ("extension", string)
+)
+
+RStatU = message_type(
+    "RStatU", 125,
+    ("stat", fields.Sized(fields.uint16l, stat_u))
+)
+
+TWStatU = message_type(
+    "TWStatU", 126,
+    ("fid", fields.uint32l),
+    ("stat", fields.Sized(fields.uint16l, stat_u))
+)
+
+
+# 9P2000.L
+
+TLOpen = message_type(
+    "TLOpen", 12,
+    ("fid", fields.uint32l),
+    ("flags", fields.uint32l)
+)
+
+RLOpen = message_type(
+    "RLOpen", 13,
+    ("qid", qid),
+    ("iounit", fields.uint32l)
+)
+
+TLCreate = message_type(
+    "TLCreate", 14,
+    ("fid", fields.uint32l),
+    ("name", string),
+    ("flags", fields.uint32l),
+    ("mode", fields.uint32l),
+    ("gid", fields.uint32l)
+)
+
+RLCreate = message_type(
+    "RLCreate", 15,
+    ("qid", qid),
+    ("iounit", fields.uint32l)
+)
+
+TGetAttr = message_type(
+    "TGetAttr", 24,
+    ("fid", fields.uint32l),
+    ("request_mask", fields.uint64l)
+)
+
+RGetAttr = message_type(
+    "RGetAttr", 25,
+    ("valid", fields.uint64l),
+    ("qid", qid),
+    ("mode", fields.uint32l),
+    ("uid", fields.uint32l),
+    ("gid", fields.uint32l),
+    ("nlink", fields.uint64l),
+    ("rdev", fields.uint64l),
+    ("size", fields.uint64l),
+    ("blksize", fields.uint64l),
+    ("blocks", fields.uint64l),
+    ("atime_sec", fields.uint64l),
+    ("atime_nsec", fields.uint64l),
+    ("mtime_sec", fields.uint64l),
+    ("mtime_nsec", fields.uint64l),
+    ("ctime_sec", fields.uint64l),
+    ("ctime_nsec", fields.uint64l),
+    ("btime_sec", fields.uint64l),
+    ("btime_nsec", fields.uint64l),
+    ("gen", fields.uint64l),
+    ("data_version", fields.uint64l)
+)
+
+TReadDir = message_type(
+    "TReadDir", 40,
+    ("fid", fields.uint32l),
+    ("offset", fields.uint64l),
+    ("count", fields.uint32l)
+)
+
+RReadDir = message_type(
+    "RReadDir", 41,
+    ("data", fields.Data(fields.uint32l))
+)
+
+TMkDir = message_type(
+    "TMkDir", 72,
+    ("dfid", fields.uint32l),
+    ("name", string),
+    ("mode", fields.uint32l),
+    ("gid", fields.uint32l)
+)
+
+RMkDir = message_type(
+    "RMkDir", 73,
+    ("qid", qid)
+)
+
+# entries in the data of an RReadDir.  ``offset`` is the offset to pass to the
+# next TReadDir to continue after the entry
+dirent = fields.Struct(
+    ("qid", qid),
+    ("offset", fields.uint64l),
+    ("type", fields.uint8),
+    ("name", string))
+
+# bits of the request mask of TGetAttr
+GETATTR_MODE = 0x00000001
+GETATTR_NLINK = 0x00000002
+GETATTR_UID = 0x00000004
+GETATTR_GID = 0x00000008
+GETATTR_RDEV = 0x00000010
+GETATTR_ATIME = 0x00000020
+GETATTR_MTIME = 0x00000040
+GETATTR_CTIME = 0x00000080
+GETATTR_INO = 0x00000100
+GETATTR_SIZE = 0x00000200
+GETATTR_BLOCKS = 0x00000400
+GETATTR_BASIC = 0x000007ff
+
+# linux open flags, which are not necessarily the same as those of the host
+L_O_RDONLY = 0o0
+L_O_WRONLY = 0o1
+L_O_RDWR = 0o2
+L_O_TRUNC = 0o1000
+
+
+def linux_flags(mode):
+    """ Convert a 9P open mode to the linux flags used by TLOpen
+    """
+    flags = {
+        messages.OREAD: L_O_RDONLY,
+        messages.OWRITE: L_O_WRONLY,
+        messages.ORDWR: L_O_RDWR,
+        messages.OEXEC: L_O_RDONLY,
+    }[mode & 0x03]
+    if mode & messages.OTRUNC:
+        flags |= L_O_TRUNC
+    return flags
+
+
+def stat_from_attr(attr, name=''):
+    """ Build a 9P2000 style stat dictionary from an RGetAttr so that callers
+    don't need to care which dialect is in use.  The name of the file is not
+    part of the response and must be supplied by the caller.
+    """
+    mode = attr.mode & 0o777
+    if stat_module.S_ISDIR(attr.mode):
+        mode |= messages.DMDIR
+    return {
+        "size": 0,
+        "type": 0,
+        "dev": 0,
+        "qid": attr.qid,
+        "mode": mode,
+        "atime": attr.atime_sec,
+        "mtime": attr.mtime_sec,
+        "length": attr.size,
+        "name": name,
+        "uid": str(attr.uid),
+        "gid": str(attr.gid),
+        "muid": "",
+    }
+
+
+def iter_dirents(data):
+    """ Decode the entries in the data of an RReadDir
+    """
+    offset = 0
+    while offset < len(data):
+        entry, size = dirent.unpack(data, offset)
+        yield entry
+        offset += size
+
+
+class AttachURequest(requests.Request):
+    request_type = TAttachU
+    response_type = messages.RAttach
+
+
+class CreateURequest(requests.Request):
+    request_type = TCreateU
+    response_type = messages.RCreate
+
+
+class StatURequest(requests.Request):
+    request_type = messages.TStat
+    response_type = RStatU
+
+    def _parse_response(self, type_id, response):
+        return super(StatURequest, self)._parse_response(
+            type_id, response).stat
+
+
+class StatRecordRequest(requests.StatRequest):
+    """ As ``StatRequest`` but returns only the stat dictionary
+    """
+    def _parse_response(self, type_id, response):
+        return super(StatRecordRequest, self)._parse_response(
+            type_id, response).stat
+
+
+class LOpenRequest(requests.Request):
+    request_type = TLOpen
+    response_type = RLOpen
+
+
+class LCreateRequest(requests.Request):
+    request_type = TLCreate
+    response_type = RLCreate
+
+
+class MkDirRequest(requests.Request):
+    request_type = TMkDir
+    response_type = RMkDir
+
+
+class GetAttrRequest(requests.Request):
+    request_type = TGetAttr
+    response_type = RGetAttr
+
+
+class GetStatRequest(GetAttrRequest):
+    """ ``TGetAttr`` for the basic attributes, with the response converted to
+    a stat dictionary
+    """
+    def __init__(self, fid, name=''):
+        super(GetStatRequest, self).__init__(fid, GETATTR_BASIC)
+        self._name = name
+
+    def _parse_response(self, type_id, response):
+        return stat_from_attr(super(GetStatRequest, self)._parse_response(
+            type_id, response), self._name)
+
+
+class DirReadRequest(requests.ReadRequest):
+    """ ``TRead`` of a directory.  Returns the stat records completed by the
+    response and the cursor of the next read, or None at the end of the
+    directory.  Records split between reads are carried over by ``decoder``.
+    """
+    def __init__(self, fid, offset, count, decoder):
+        super(DirReadRequest, self).__init__(fid, offset, count)
+        self._offset = offset
+        self._decoder = decoder
+
+    def _parse_response(self, type_id, response):
+        data = super(DirReadRequest, self)._parse_response(
+            type_id, response).data
+        if not data:
+            self._decoder.finish()
+            return [], None
+        return (self._decoder.feed(data),
+                (self._offset + len(data), self._decoder))
+
+
+class ReadDirRequest(requests.Request):
+    """ Returns the list of entries in the response and the cursor of the
+    next request, or None at the end of the directory
+    """
+    request_type = TReadDir
+    response_type = RReadDir
+
+    def _parse_response(self, type_id, response):
+        entries = list(iter_dirents(super(
+            ReadDirRequest, self)._parse_response(type_id, response).data))
+        if not entries:
+            return entries, None
+        return entries, entries[-1]["offset"]
+
+
+class Dialect(object):
+    """ 9P2000 itself.  Subclasses override the requests that differ in their
+    version of the protocol.
+    """
+    version = "9P2000"
+
+    # layout of the stat records read from directories
+    stat_layout = messages.stat
+
+    def attach(self, fid, afid, uname, aname):
+        return requests.AttachRequest(fid, afid, uname, aname)
+
+    def open(self, fid, mode):
+        """ :returns: request whose response has ``qid`` and ``iounit``
+        """
+        return requests.OpenRequest(fid, mode)
+
+    def create(self, fid, name, perm, mode):
+        """ :returns: request whose response has ``qid`` and ``iounit``.
+            Leaves ``fid`` open on the new file.
+        """
+        return requests.CreateRequest(fid, name, perm, mode)
+
+    def mkdir(self, fid, name, perm):
+        """ :returns: request that creates a directory in ``fid``.  ``fid``
+            must be clunked afterwards.
+        """
+        return requests.CreateRequest(fid, name, perm | messages.DMDIR,
+                                      messages.OREAD)
+
+    def stat(self, fid, name=''):
+        """ :returns: request whose response is a stat dictionary.
+
+        :param name: name of the file, for dialects that don't return it.
+        """
+        return StatRecordRequest(fid)
+
+    def readdir_request(self, fid, cursor, count):
+        """ :param cursor: None to start from the beginning of the open
+            directory ``fid``, otherwise the cursor returned by the previous
+            request.
+
+        :returns: request whose response is a ``(entries, cursor)`` pair.
+            ``cursor`` is None once the end of the directory has been reached.
+            Entries are stat dictionaries, or for dialects that list
+            directories with ``TReadDir``, directory entries with at least
+            ``qid`` and ``name`` keys.
+        """
+        if cursor is None:
+            cursor = (0, messages.StatDecoder(self.stat_layout))
+        offset, decoder = cursor
+        return DirReadRequest(fid, offset, count, decoder)
+
+    def __repr__(self):
+        return "<Dialect %s>" % self.version
+
+
+class UnixDialect(Dialect):
+    """ 9P2000.u, which adds numeric ids and an extension string to stat
+    records
+    """
+    version = "9P2000.u"
+    stat_layout = stat_u
+
+    def attach(self, fid, afid, uname, aname):
+        return AttachURequest(fid, afid, uname, aname, NONUNAME)
+
+    def create(self, fid, name, perm, mode):
+        return CreateURequest(fid, name, perm, mode, "")
+
+    def mkdir(self, fid, name, perm):
+        return CreateURequest(fid, name, perm | messages.DMDIR,
+                              messages.OREAD, "")
+
+    def stat(self, fid, name=''):
+        return StatURequest(fid)
+
+
+class LinuxDialect(Dialect):
+    """ 9P2000.L, as spoken by the linux kernel client and servers such as
+    diod.  Directories are listed with compact TReadDir entries and files are
+    opened and examined with linux semantics.
+    """
+    version = "9P2000.L"
+
+    def attach(self, fid, afid, uname, aname):
+        return AttachURequest(fid, afid, uname, aname, NONUNAME)
+
+    def open(self, fid, mode):
+        return LOpenRequest(fid, linux_flags(mode))
+
+    def create(self, fid, name, perm, mode):
+        return LCreateRequest(fid, name, linux_flags(mode), perm & 0o777,
+                              NONUNAME)
+
+    def mkdir(self, fid, name, perm):
+        return MkDirRequest(fid, name, perm & 0o777, NONUNAME)
+
+    def stat(self, fid, name=''):
+        return GetStatRequest(fid, name)
+
+    def readdir_request(self, fid, cursor, count):
+        return ReadDirRequest(fid, cursor or 0, count)
+
+
+BASE = Dialect()
+UNIX = UnixDialect()
+LINUX = LinuxDialect()
+
+# map from version string to dialect
+DIALECTS = {dialect.version: dialect for dialect in (BASE, UNIX, LINUX)}
@@ -0,0 +1,226 @@
+import asyncio
+import logging
+
+from queue import Queue
+from threading import Condition, RLock
+
+from pyixp import messages, requests
+from pyixp.protocol import FlushedError
+
+__all__ = 'EventStream',
+
+log = logging.getLogger(__name__)
+
+# placed on the queues of iterators once the stream has ended
+_END = object()
+
+
+class EventStream(object):
+    """ Reads a file that blocks until there is something to report, such as
+    wmii's ``/event``, with several reads kept outstanding so that there is
+    never a gap between one event and the server being able to send the next.
+    Should be created using ``Client.events``.
+
+    The data is split into events on ``separator`` and delivered to
+    ``callback`` if one is given, or otherwise by iterating over the stream,
+    either with ``for`` or ``async for``.  Responses are taken in the order
+    they arrive as servers of stream files answer outstanding reads in turn.
+
+    The stream ends when the server returns end of file or when it is closed.
+    Closing the stream flushes the outstanding reads.
+    """
+
+    def __init__(self, client, path, depth=4, separator=b'\n',
+                 callback=None):
+        """
+        :param depth: number of reads to keep outstanding.
+
+        :param separator: bytes that end each event.  Events are delivered
+            without the separator.  If None, the data from each read is
+            delivered as it is.
+
+        :param callback: ``event -> None`` called with each event.  It is run
+            on the thread receiving responses so must not block, or make
+            blocking requests.
+        """
+        self._client = client
+        self._marshall = client._marshall
+        self._depth = depth
+        self._separator = separator
+
+        # reentrant so that callbacks can close the stream
+        self._cond = Condition(RLock())
+        self._handles = set()
+        self._partial = b''
+        self._offset = 0
+        self._closing = False
+        self._finished = False
+        self.error = None
+
+        # events are passed to ``_deliver``, which is replaced by
+        # ``__aiter__`` to hand them to the event loop instead
+        self._queue = None
+        if callback is not None:
+            self._deliver = callback
+        else:
+            self._queue = Queue()
+            self._deliver = self._queue.put
+
+        self._fid = client._walk(path)
+        try:
+            resp = client._open(self._fid, messages.OREAD)
+        except:
+            client._clunk(self._fid)
+            raise
+        self._count = client._io_size(resp.iounit)
+
+        with self._cond:
+            for _ in range(depth):
+                self._submit()
+
+    def _submit(self):
+        # must be called with the lock held
+        handle = []
+        request = requests.ReadRequest(self._fid, self._offset, self._count)
+        handle.append(request.submit_async(
+            self._marshall,
+            lambda resp: self._received(handle[0], resp.data),
+            lambda error: self._failed(handle[0], error)))
+        self._handles.add(handle[0])
+
+    def _split(self, data):
+        if self._separator is None:
+            return [data] if data else []
+        events = (self._partial + data).split(self._separator)
+        self._partial = events.pop()
+        return events
+
+    def _received(self, handle, data):
+        with self._cond:
+            self._handles.discard(handle)
+            if self._closing:
+                events = []
+            elif data:
+                self._offset += len(data)
+                self._submit()
+                events = self._split(data)
+            else:
+                # end of file
+                self._closing = True
+                self._flush_all()
+                events = [self._partial] if self._partial else []
+                self._partial = b''
+
+            # delivered with the lock held so that events from different
+            # responses can't be reordered
+            for event in events:
+                self._dispatch(event)
+        self._check_finished()
+
+    def _failed(self, handle, error):
+        with self._cond:
+            self._handles.discard(handle)
+            if not isinstance(error, FlushedError) and not self._closing:
+                log.info("error reading event stream", exc_info=error)
+                self.error = error
+                self._closing = True
+                self._flush_all()
+        self._check_finished()
+
+    def _dispatch(self, event):
+        try:
+            self._deliver(event)
+        except:
+            log.exception("exception in user callback", stack_info=True)
+
+    def _flush_all(self):
+        # must be called with the lock held
+        for handle in self._handles:
+            self._marshall.flush(handle)
+
+    def _check_finished(self):
+        with self._cond:
+            if self._finished or not self._closing or self._handles:
+                return
+            self._finished = True
+            self._cond.notify_all()
+            if self._queue is not None:
+                self._dispatch(_END)
+        self._client._clunk_async(self._fid)
+
+    @property
+    def closed(self):
+        return self._finished
+
+    def close(self, wait=True):
+        """ Flush the outstanding reads and clunk the fid.
+
+        :param wait: block until the server has answered the flushes.  Must
+            be false if called from a callback.
+        """
+        with self._cond:
+            if not self._closing:
+                self._closing = True
+                self._flush_all()
+        self._check_finished()
+        if wait:
+            with self._cond:
+                while not self._finished:
+                    self._cond.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        if self._queue is None:
+            raise Exception("events are being passed to a callback")
+        return self
+
+    def __next__(self):
+        if self._queue is None:
+            raise Exception("events are being passed to a callback")
+        event = self._queue.get()
+        if event is _END:
+            # let other iterators see the end as well
+            self._queue.put(_END)
+            if self.error is not None:
+                raise self.error
+            raise StopIteration
+        return event
+
+    def __aiter__(self):
+        if self._queue is None:
+            raise Exception("events are being passed to a callback")
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def deliver(event):
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+        # hand over anything already received then switch to the event loop
+        with self._cond:
+            while not self._queue.empty():
+                queue.put_nowait(self._queue.get_nowait())
+            self._deliver = deliver
+        return _AsyncEvents(self, queue)
+
+
+class _AsyncEvents(object):
+    def __init__(self, stream, queue):
+        self._stream = stream
+        self._queue = queue
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self._queue.get()
+        if event is _END:
+            self._queue.put_nowait(_END)
+            if self._stream.error is not None:
+                raise self._stream.error
+            raise StopAsyncIteration
+        return event
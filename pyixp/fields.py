@@ -1,7 +1,36 @@
+import array
+import collections.abc
 import struct
+import sys
+
+# struct format codes of integers, which can be held in an ``array.array``
+_INTEGER_CODES = "bBhHiIlLqQ"
+
+# number of items from which arrays of fixed width structs are decoded by
+# column.  Below it, building the columns costs more than decoding each item
+# in turn, so shorter arrays, including the at most 16 qids of an RWalk, are
+# decoded item by item into a plain list
+COLUMN_THRESHOLD = 24
+
+
+def _typecode(code):
+    """ :returns: the ``array.array`` typecode able to hold values of the
+        little endian struct format ``code``
+    """
+    size = struct.calcsize("<" + code)
+    candidates = "bhilq" if code.islower() else "BHILQ"
+    for typecode in candidates:
+        if array.array(typecode).itemsize >= size:
+            return typecode
+    raise ValueError("no array type for %r" % code)
 
 
 class Field(object):
+    # struct format codes, little endian and without the byte order prefix,
+    # of fields that always pack to the same number of bytes and so can be
+    # decoded in bulk.  None for other fields
+    fixed_format = None
+
     def pack(self, values):
         """
         :returns: byte array
@@ -26,6 +55,10 @@ class Field(object):
 class StructField(Field):
     def __init__(self, format):
         self._struct = struct.Struct(format)
+        code = format.lstrip("<")
+        if code in _INTEGER_CODES and (
+                format.startswith("<") or self._struct.size == 1):
+            self.fixed_format = code
 
     def pack(self, value):
         return self._struct.pack(value)
@@ -94,6 +127,16 @@ class Array(Field):
         self._size = size
         self._item = item
 
+        # fixed width items are decoded with ``iter_unpack``, or if they are
+        # structs and there are at least ``COLUMN_THRESHOLD`` of them, each
+        # field is copied straight into a column of the matching typecode
+        self._item_struct = None
+        self._columns = None
+        if item.fixed_format is not None:
+            self._item_struct = struct.Struct("<" + item.fixed_format)
+            if len(item.fixed_format) > 1:
+                self._columns = _column_layouts(item.fixed_format)
+
     def pack(self, values):
         result = b''
         if not isinstance(self._size, int):
@@ -109,6 +152,11 @@ class Array(Field):
         else:
             item_count, size = self._size.unpack(data, offset)
             offset += size
+        if self._item_struct is not None and (
+                self._columns is None or item_count >= COLUMN_THRESHOLD):
+            result, size = self._unpack_fixed(item_count, data, offset)
+            return result, offset + size - start
+
         result = []
         for i in range(0, item_count):
             value, size = self._item.unpack(data, offset)
@@ -116,6 +164,82 @@ class Array(Field):
             offset += size
         return result, offset - start
 
+    def _unpack_fixed(self, item_count, data, offset):
+        width = self._item_struct.size
+        size = width * item_count
+        if offset + size > len(data):
+            raise struct.error("array too long to unpack")
+        with memoryview(data) as view, view[offset:offset + size] as items:
+            if self._columns is None:
+                values = [value for value,
+                          in self._item_struct.iter_unpack(items)]
+                return values, size
+            columns = [_unpack_column(items, width, item_count, layout)
+                       for layout in self._columns]
+        return Columns(self._item.names, columns, item_count), size
+
+
+def _column_layouts(fixed_format):
+    """ :returns: a list of ``(typecode, offset, size, column_struct)`` tuples
+        describing where each field of a fixed width struct item is found.
+        ``column_struct`` is None if the field can be copied byte for byte
+        into an array of ``typecode``, otherwise it is a struct that skips
+        the other fields of the item.
+    """
+    width = struct.calcsize("<" + fixed_format)
+    layouts = []
+    offset = 0
+    for code in fixed_format:
+        size = struct.calcsize("<" + code)
+        typecode = _typecode(code)
+        column_struct = None
+        if array.array(typecode).itemsize != size:
+            column_struct = struct.Struct(
+                "<%ix%s%ix" % (offset, code, width - offset - size))
+        layouts.append((typecode, offset, size, column_struct))
+        offset += size
+    return layouts
+
+
+def _unpack_column(items, width, item_count, layout):
+    """ Decode a single field from every item in ``items`` into an
+    ``array.array``
+    """
+    typecode, offset, size, column_struct = layout
+    column = array.array(typecode)
+    if column_struct is not None:
+        column.extend(value for value, in column_struct.iter_unpack(items))
+        return column
+
+    # gather the bytes of the field from each item with strided copies, one
+    # for each byte of the field
+    buffer = bytearray(size * item_count)
+    for i in range(size):
+        buffer[i::size] = items[offset + i::width]
+    column.frombytes(buffer)
+    if size > 1 and sys.byteorder != "little":
+        column.byteswap()
+    return column
+
+
+class Sized(Field):
+    """ Wraps another field, prefixing it with the length of its packed form
+    """
+    def __init__(self, size, field):
+        super(Sized, self).__init__()
+        self._size = size
+        self._field = field
+
+    def pack(self, value):
+        body = self._field.pack(value)
+        return self._size.pack(len(body)) + body
+
+    def unpack(self, data, offset=0):
+        body_size, header_size = self._size.unpack(data, offset)
+        value, size = self._field.unpack(data, offset + header_size)
+        assert size == body_size, "Sized field length mismatch"
+        return value, header_size + body_size
+
 
 class Sequence(Field):
     """ Pack and unpack tuples of elements with different types
@@ -142,6 +266,15 @@ class Struct(Field):
     """
     def __init__(self, *fields):
         self._fields = fields
+        self.names = tuple(name for name, type_ in fields)
+
+        # only flat structs of integers are decoded in bulk, so that the
+        # columns can be held in arrays
+        if fields and all(isinstance(type_, StructField) and
+                          type_.fixed_format is not None
+                          for name, type_ in fields):
+            self.fixed_format = "".join(type_.fixed_format
+                                        for name, type_ in fields)
 
     def pack(self, values):
         return b''.join(type_.pack(values[name])
@@ -156,3 +289,34 @@ class Struct(Field):
             offset += size
 
         return values, offset - start
+
+
+class Columns(collections.abc.Sequence):
+    """ Sequence of the dictionaries in an array of fixed width ``Struct``
+    items, stored by column.
+
+    :ivar columns: map from field name to an ``array.array`` holding the value
+        of that field for every item.  The dictionaries are only built as
+        items are accessed.
+    """
+    def __init__(self, names, columns, length):
+        self.columns = dict(zip(names, columns))
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if not -self._length <= index < self._length:
+            raise IndexError("index out of range")
+        return {name: column[index] for name, column in self.columns.items()}
+
+    def __eq__(self, other):
+        if isinstance(other, (Columns, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return "Columns(%r)" % list(self)
@@ -1,40 +1,103 @@
+import array
 import logging
 import socket
-import struct
 
-from threading import Thread, Condition
-from queue import Queue, LifoQueue
+from functools import partial
+from threading import Thread, RLock
+from queue import Empty, Queue
+
+from pyixp.messages import header as _header, rread_count as _count
+from pyixp.protocol import (
+    Protocol, BlockingRequestMixin, RequestHandle, close_fds,
+)
 
 __all__ = 'Marshall',
 
 log = logging.getLogger(__name__)
 
-_header = struct.Struct("<IbH")
+# maximum number of file descriptors that can be received alongside a single
+# call to recvmsg
+_MAXFDS = 16
+
+_AF_UNIX = getattr(socket, 'AF_UNIX', None)
+
+
+def _raise_marshall_closed_error(*args, **kwargs):
+    raise Exception("marshall closed")
 
 
 def recvall(socket, n):
     """ Read exactly n bytes from a socket
     """
     data = bytearray(n)
-    window = memoryview(data)
+    recvall_into(socket, data)
+    # TODO would be nice if this could be done without a copy (not that it
+    # makes any real difference)
+    return bytes(data)
+
+
+def recvall_into(socket, buffer, fds=None):
+    """ Fill ``buffer`` with bytes read from a socket.  If ``fds`` is given,
+    the socket must be a unix socket and any file descriptors passed with
+    ``SCM_RIGHTS`` are appended to it.
+    """
+    window = memoryview(buffer).cast('B')
+    ancbufsize = fds_bufsize() if fds is not None else 0
     while len(window):
         try:
-            read = socket.recv_into(window)
-            if read == 0:
-                raise EOFError('unexpected end of file')
-            window = window[read:]
+            if fds is None:
+                read = socket.recv_into(window)
+            else:
+                read, ancdata, flags, address = socket.recvmsg_into(
+                    [window], ancbufsize)
+                unpack_fds(ancdata, fds)
         except InterruptedError:
             continue
-    # TODO would be nice if this could be done without a copy (not that it
-    # makes any real difference)
+        if read == 0:
+            raise EOFError('unexpected end of file')
+        window = window[read:]
+
+
+def fds_bufsize():
+    """ :returns: size of the ancillary data buffer needed to receive the
+        maximum number of file descriptors accepted alongside one ``recvmsg``
+    """
+    return socket.CMSG_SPACE(_MAXFDS * array.array('i').itemsize)
+
+
+def unpack_fds(ancdata, fds):
+    """ Append the file descriptors passed with ``SCM_RIGHTS`` in the ancillary
+    data returned by ``recvmsg`` to ``fds``
+    """
+    for level, type_, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            received = array.array('i')
+            received.frombytes(cmsg_data[:len(cmsg_data) -
+                               len(cmsg_data) % received.itemsize])
+            fds.extend(received)
+
+
+def recvall_fds(sock, n, fds):
+    """ Read exactly n bytes from a unix socket, appending any file descriptors
+    passed with ``SCM_RIGHTS`` to ``fds``
+    """
+    data = bytearray(n)
+    recvall_into(sock, data, fds)
     return bytes(data)
 
 
-class Marshall(object):
+# placed on the send queue by the receive thread when a response has freed a
+# tag for a request that was waiting for one
+_WAKE = object()
+
+
+class Marshall(BlockingRequestMixin):
     """ Serialises sending of packets and associates them with their
     corresponding responses.
+
+    Framing, tags and dispatch are handled by a ``Protocol``.  The marshall
+    adds a thread each for blocking sends and receives.
     """
-    _NOTAG = 0xffff
 
     def __init__(self, socket, maxrequests=1024):
         """
@@ -47,66 +110,60 @@ class Marshall(object):
             an earlier request to finish.  Maximum possible value is 65535.
         :type maxrequests: unsigned 16bit integer (0 <= maxtag <= 65535)
         """
-        # the maximum length of a packet, including headers, that can be sent
-        # by the marshall.  Should be set after receiving a version response
-        self.max_message_size = 0xffffffff
-
         self._socket = socket
 
-        # queue of ``(type, request, on_error, on_success, sequential)`` tuples
-        # for passing requests to the send thread.  Adding false to the queue
-        # will cause the send loop to exit
+        # file descriptors can only be passed over unix sockets.  Other
+        # connections, and transports that only behave like sockets, are read
+        # using plain ``recv_into``
+        self._unix = _AF_UNIX is not None and \
+            getattr(socket, 'family', None) == _AF_UNIX and \
+            hasattr(socket, 'recvmsg_into')
+
+        # protocol state is shared by both threads and guarded by the lock
+        self._protocol = Protocol(maxrequests)
+        self._lock = RLock()
+
+        # queue of functions to be applied to the protocol, for passing
+        # requests to the send thread.  Adding false to the queue will cause
+        # the send loop to exit
         self._send_queue = Queue()
 
-        # queue of booleans used as a counter for the number of remaining
-        # responses and stop the receive loop blocking on recv if no message is
-        # expected
-        # True indicates that a request has been sent and to expect a reply
+        # queue of booleans used to stop the receive loop blocking on recv if
+        # no message is expected
+        # True indicates that requests have been sent and to expect replies
         # False indicates that the receive loop should quit immediately
         self._recv_queue = Queue()
 
-        # stack of available transaction tags that can be assigned to new
-        # requests.
-        # tags are used to identify the request that a response corresponds to.
-        self._tags = LifoQueue(maxsize=maxrequests)
-        for tag in range(1, maxrequests):
-            self._tags.put(tag)
-
-        # map from transaction tags (uint16) to completion callbacks
-        self._callbacks = {}
-
-        # responses to callbacks without tags are dispatched in the same order
-        # the as the requests were submitted
-        self._sequential_callbacks = Queue()
-
         self._send_thread = Thread(target=self._send_loop, daemon=True)
         self._send_thread.start()
 
         self._recv_thread = Thread(target=self._recv_loop, daemon=True)
         self._recv_thread.start()
 
-    def _do_send(self, request_type, request,
-                 on_success, on_error,
-                 sequential):
-
-        if not sequential:
-            # bind the callback to a new tag.
-            # self._tags.get() should block until a tag becomes available.
-            tag = self._tags.get()
-            assert tag not in self._callbacks
-            self._callbacks[tag] = (on_success, on_error,)
-        else:
-            tag = self._NOTAG
-            self._sequential_callbacks.put((on_success, on_error,))
+    @property
+    def max_message_size(self):
+        """ the maximum length of a packet, including headers, that can be sent
+        or received by the marshall.  Should be set after receiving a version
+        response
+        """
+        return self._protocol.max_message_size
 
-        length = len(request) + _header.size
-        if length > self.max_message_size:
-            raise Exception("packet size exceeds maximum")
+    @max_message_size.setter
+    def max_message_size(self, value):
+        self._protocol.max_message_size = value
 
-        header = _header.pack(length, request_type, tag)
+    def _do_send(self, task):
+        with self._lock:
+            if task is not _WAKE:
+                task()
+            return self._protocol.frames_to_send()
 
-        self._socket.sendall(header)
-        self._socket.sendall(request)
+    def _send_frames(self, frames):
+        for frame in frames:
+            self._socket.sendall(frame)
+        if frames:
+            # notify the recv loop that more response messages are expected
+            self._recv_queue.put(True)
 
     def _send_loop(self):
         """ loop for sending packets
@@ -120,11 +177,12 @@ class Marshall(object):
                     log.info("quiting send loop")
                     return
 
-                self._do_send(*task)
-
-                # if nothing went wrong, notify the recv loop that another
-                # response message is expected
-                self._recv_queue.put(True)
+                frames = self._do_send(task)
+                # the task may reference a buffer that the caller releases as
+                # soon as the response arrives, which can be before the frames
+                # have been sent
+                del task
+                self._send_frames(frames)
 
                 self._send_queue.task_done()
 
@@ -133,25 +191,52 @@ class Marshall(object):
                 self.close(error)
                 return
 
+    def _recv(self, n, fds):
+        if self._unix:
+            return recvall_fds(self._socket, n, fds)
+        return recvall(self._socket, n)
+
     def _do_recv(self):
-        header = recvall(self._socket, _header.size)
-        length, type_, tag = _header.unpack(header)
-        if length < _header.size:
+        fds = []
+        length, type_, tag = _header.unpack(self._recv(_header.size, fds))
+        if not _header.size <= length <= self._protocol.max_message_size:
+            close_fds(fds)
             raise Exception("invalid frame length: %i" % length)
 
-        body = recvall(self._socket, length - _header.size)
-
-        if tag == self._NOTAG:
-            on_success, on_error = self._sequential_callbacks.get()
+        with self._lock:
+            buffer = self._protocol.response_buffer(type_, tag)
+
+        if buffer is not None and length >= _header.size + _count.size:
+            # read the count then receive the data straight into the buffer
+            # registered by the caller
+            body = self._recv(_count.size, fds)
+            count, = _count.unpack(body)
+            if length != _header.size + _count.size + count:
+                close_fds(fds)
+                raise Exception("invalid read response")
+            with memoryview(buffer) as base, base.cast('B') as view:
+                if count <= len(view):
+                    with view[:count] as window:
+                        recvall_into(self._socket, window,
+                                     fds if self._unix else None)
+                else:
+                    # too big.  passed on whole so that the protocol can fail
+                    # the request
+                    body += self._recv(count, fds)
         else:
-            # retrieve callback and return tag to free list
-            on_success, on_error = self._callbacks.pop(tag)
-            self._tags.put(tag)
-
-        try:
-            on_success(type_, body)
-        except:
-            log.exception("exception in user callback", stack_info=True)
+            body = self._recv(length - _header.size, fds)
+        # the callback may release the buffer, which fails while any view of
+        # it is still referenced
+        del buffer
+
+        # callbacks are run with the lock held so that they can not race with
+        # ``close``, but they may still submit new requests as these are only
+        # queued for the send thread
+        with self._lock:
+            self._protocol.receive_frame(type_, tag, body, fds)
+            wake = self._protocol.pending
+        if wake:
+            self._send_queue.put(_WAKE)
 
     def _recv_loop(self):
         """ loop for receiving packets
@@ -162,7 +247,14 @@ class Marshall(object):
                     log.info("quiting receive loop")
                     return
 
-                self._do_recv()
+                # flushed requests never receive a response so the number of
+                # responses to wait for is taken from the protocol rather than
+                # from the number of requests sent
+                while True:
+                    with self._lock:
+                        if not self._protocol.outstanding:
+                            break
+                    self._do_recv()
 
                 self._recv_queue.task_done()
 
@@ -171,45 +263,9 @@ class Marshall(object):
                 self.close(e)
                 return
 
-    def request(self, request_type, request, sequential=False):
-        """
-        """
-        cond = Condition()
-        # dict is used as reference type to allow result to be returned from
-        # seperate thread
-        response_cont = {}
-
-        def on_success(response_type, response):
-            response_cont.update({
-                "success": True,
-                "type": response_type,
-                "response": response,
-            })
-            with cond:
-                cond.notify()
-
-        def on_error(exception):
-            response_cont.update({
-                "success": False,
-                "exception": exception,
-            })
-            with cond:
-                cond.notify()
-
-        with cond:
-            self.request_async(request_type, request,
-                               on_success, on_error,
-                               sequential)
-            cond.wait()
-
-        if not response_cont["success"]:
-            raise response_cont["exception"]
-
-        return response_cont["type"], response_cont["response"]
-
     def request_async(self, request_type, request,
                       on_success, on_error=None,
-                      sequential=False):
+                      sequential=False, ancillary=False, buffer=None):
         """ Send a 9p request to the server and wait for a response
 
         :param packet: the contents of the packet to send to the server.
@@ -221,14 +277,30 @@ class Marshall(object):
         :sequential: send request with no tag.  responses to untagged requests
             are sent in the order that the requests were received
 
-        :returns: bytestring -- The reply recieved from the server or nothing
-            if a callback was provided.
+        :ancillary: pass a list of any file descriptors received alongside the
+            response as a third argument to ``on_success``.  The callback is
+            responsible for closing them.  Otherwise received descriptors are
+            closed immediately.
+
+        :buffer: writable buffer that the data of an RRead response is read
+            into directly.  ``on_success`` is then passed only the count field
+            of the response body.
+
+        :returns: a ``RequestHandle`` that can be passed to ``flush``
         """
         log.info("request")
 
-        self._send_queue.put((request_type, request,
-                              on_success, on_error,
-                              sequential,))
+        handle = RequestHandle()
+        self._send_queue.put(partial(
+            self._protocol.request, request_type, request,
+            on_success, on_error, sequential, ancillary, buffer, handle))
+        return handle
+
+    def flush(self, handle):
+        """ Cancel a request made with ``request_async`` by sending a TFlush.
+        See ``Protocol.flush``.
+        """
+        self._send_queue.put(partial(self._protocol.flush, handle))
 
     def shutdown(self):
         """ Attempt to gracefully shut down the server
@@ -238,11 +310,8 @@ class Marshall(object):
         # stop anything else from adding requests to the send queue.  sorry.
         # a reference to the put method is kept so that a quit signal can be
         # sent after all requests are handled.
-        def raise_marshall_closed_error(*args, **kwargs):
-            raise Exception("marshall closed")
-
         send_queue_put = self._send_queue.put
-        self._send_queue.put = raise_marshall_closed_error
+        self._send_queue.put = _raise_marshall_closed_error
 
         # wait for send queue to empty
         self._send_queue.join()
@@ -259,11 +328,8 @@ class Marshall(object):
         self._socket.shutdown(socket.SHUT_RDWR)
         self._socket.close()
 
-        for on_success, on_error in self._callbacks.values():
-            try:
-                on_error(Exception("shutdown"))
-            except:
-                log.exception("exception in user callback", stack_info=True)
+        with self._lock:
+            self._protocol.connection_lost(Exception("shutdown"))
 
         log.info("successfully shut down multiplexer")
 
@@ -278,15 +344,29 @@ class Marshall(object):
 
         self._socket.close()
 
+        # requests made from now on would never be sent, so fail them
+        # straight away rather than leaving their callers waiting
+        self._send_queue.put = _raise_marshall_closed_error
+
+        with self._lock:
+            # requests that were queued but not yet sent are handed to the
+            # protocol so that they are failed along with the rest
+            while True:
+                try:
+                    task = self._send_queue.get_nowait()
+                except Empty:
+                    break
+                self._send_queue.task_done()
+                if task and task is not _WAKE:
+                    try:
+                        task()
+                    except Exception:
+                        log.exception("error in queued request")
+            self._protocol.connection_lost(Exception("close"))
+
         # neither loop will notice that the socket is closed unless it is
         # working on something so it is still necessary to send quit signals
-        self._send_queue.put(False)
+        Queue.put(self._send_queue, False)
         self._recv_queue.put(False)
 
-        for on_success, on_error in self._callbacks.values():
-            try:
-                on_error(Exception("close"))
-            except:
-                log.exception("exception in user callback", stack_info=True)
-
         log.info("successfully terminated multiplexer")
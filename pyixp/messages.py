@@ -1,3 +1,5 @@
+import struct
+
 from collections import namedtuple
 
 from pyixp import fields
@@ -6,10 +8,11 @@ from pyixp import fields
 __all__ = [
     "Message",
     "message_type",
+    "StatDecoder", "iter_stats",
     "TVersion", "RVersion",
     "TAuth", "RAuth",
     "TAttach", "RAttach",
-    "RError",
+    "RError", "RLError",
     "TFlush", "RFlush",
     "TWalk", "RWalk",
     "TOpen", "ROpen",
@@ -47,6 +50,99 @@ stat = fields.Struct(
     ("muid", string))
 
 
+# size, type id and tag at the start of every message
+header = struct.Struct("<IBH")
+
+# count field at the start of the body of an RRead
+rread_count = struct.Struct("<I")
+
+NOTAG = 0xffff
+NOFID = 0xffffffff
+
+# maximum number of path elements that can be walked by a single TWalk
+MAXWELEM = 16
+
+# size of the header of an RRead or TWrite message.  The maximum amount of data
+# that can be transfered by one message is ``msize - IOHDRSZ``
+IOHDRSZ = 24
+
+# open modes
+OREAD = 0x00
+OWRITE = 0x01
+ORDWR = 0x02
+OEXEC = 0x03
+OTRUNC = 0x10
+ORCLOSE = 0x40
+
+# bits in qid.type
+QTDIR = 0x80
+QTAPPEND = 0x40
+QTEXCL = 0x20
+QTAUTH = 0x08
+QTTMP = 0x04
+QTFILE = 0x00
+
+# bits in stat.mode
+DMDIR = 0x80000000
+DMAPPEND = 0x40000000
+DMEXCL = 0x20000000
+DMTMP = 0x04000000
+
+
+class StatDecoder(object):
+    """ Incremental decoder for the concatenated stat records returned when
+    reading from a directory.
+
+    A record that is split across a chunk boundary is carried over and
+    completed by the next chunk so only a single partial record is ever
+    buffered.
+
+    :param layout: field used to decode each record.  Dialects such as
+        9P2000.u extend the stat record.
+    """
+    def __init__(self, layout=stat):
+        self._layout = layout
+        self._pending = b''
+
+    def feed(self, chunk):
+        """ Decode as many complete records as possible.
+
+        :returns: list of the stat records completed by ``chunk``
+        """
+        data = self._pending + chunk if self._pending else chunk
+        entries = []
+        offset = 0
+        while offset + 2 <= len(data):
+            size, header_size = fields.uint16l.unpack(data, offset)
+            end = offset + header_size + size
+            if end > len(data):
+                break
+            value, consumed = self._layout.unpack(data, offset)
+            if consumed != end - offset:
+                raise Exception("invalid stat record")
+            entries.append(value)
+            offset = end
+        self._pending = bytes(data[offset:])
+        return entries
+
+    def finish(self):
+        """ Check that the end of the stream does not fall within a record
+        """
+        if self._pending:
+            raise Exception("truncated stat record")
+
+
+def iter_stats(chunks, layout=stat):
+    """ Decode the stat records in an iterable of chunks read from a
+    directory, yielding them as soon as they are complete.
+    """
+    decoder = StatDecoder(layout)
+    for chunk in chunks:
+        for entry in decoder.feed(chunk):
+            yield entry
+    decoder.finish()
+
+
 class Message(object):
     def pack(self):
         return self._layout.pack(self)
@@ -94,7 +190,7 @@ TAuth = message_type(
 
 RAuth = message_type(
     "RAuth", 103,
-    ("aqid", fields.Array(fields.uint16l, string))  # TODO
+    ("aqid", qid)
 )
 
 
@@ -108,7 +204,7 @@ TAttach = message_type(
 
 RAttach = message_type(
     "RAttach", 105,
-    ("qid", fields.Array(fields.uint16l, string))  # TODO
+    ("qid", qid)
 )
 
 
@@ -117,6 +213,14 @@ RError = message_type(
     ("ename", string)
 )
 
+# 9P2000.L servers reply with an RLError carrying only an errno.  It is defined
+# here rather than with the rest of the dialect messages as any request can
+# fail with it
+RLError = message_type(
+    "RLError", 7,
+    ("ecode", fields.uint32l)
+)
+
 
 TFlush = message_type(
     "TFlush", 108,
@@ -211,7 +315,7 @@ TRemove = message_type(
 )
 
 RRemove = message_type(
-    "RRemove", 122
+    "RRemove", 123
 )
 
 
@@ -220,16 +324,18 @@ TStat = message_type(
     ("fid", fields.uint32l),
 )
 
+# stat records in RStat and TWStat messages are preceded by a second copy of
+# their size
 RStat = message_type(
     "RStat", 125,
-    ("stat", stat)
+    ("stat", fields.Sized(fields.uint16l, stat))
 )
 
 
 TWStat = message_type(
     "TWStat", 126,
     ("fid", fields.uint32l),
-    ("stat", stat)
+    ("stat", fields.Sized(fields.uint16l, stat))
 )
 
 RWStat = message_type(
@@ -0,0 +1,378 @@
+import logging
+import os
+import struct
+
+from collections import deque
+from threading import Condition
+
+from pyixp import messages
+from pyixp.messages import NOTAG, header as _header, rread_count as _count
+
+__all__ = ('Protocol', 'BlockingRequestMixin', 'RequestHandle',
+           'FlushedError')
+
+log = logging.getLogger(__name__)
+
+# body of a TFlush
+_oldtag = struct.Struct("<H")
+
+
+class FlushedError(Exception):
+    """ Passed to the error callback of a request that was cancelled with
+    ``flush``
+    """
+
+
+class RequestHandle(object):
+    """ Identifies a request submitted to a ``Protocol`` so that it can be
+    flushed
+    """
+    __slots__ = 'callback', 'tag', 'flushing'
+
+    def __init__(self):
+        # ``(on_success, on_error, ancillary, buffer)``, cleared once the
+        # response has been dispatched
+        self.callback = None
+        # tag the request was sent with, or None if it hasn't been sent or
+        # has finished
+        self.tag = None
+        self.flushing = False
+
+
+def close_fds(fds):
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+class Protocol(object):
+    """ Client side 9P protocol state with no IO of its own: framing of
+    requests and responses, allocation of tags and dispatch of responses to
+    their callbacks.
+
+    Requests are submitted with ``request``, and the frames ready to be sent
+    are collected with ``frames_to_send``.  Incoming data is passed to either
+    ``receive_data``, for a raw byte stream, or ``receive_frame``, if the
+    caller has already split the stream into frames.  Callbacks are run
+    synchronously from those methods.
+
+    Instances are not thread safe.
+    """
+
+    def __init__(self, maxrequests=1024):
+        """
+        :param maxrequests: upper limit on the number of requests that can be
+            sent to the server without receiving a response.  Requests beyond
+            the limit are held back until an earlier request finishes.
+        """
+        # the maximum length of a packet, including headers, that can be sent
+        # or received.  Should be set to the negotiated msize after receiving
+        # a version response
+        self.max_message_size = 0xffffffff
+
+        # stack of available transaction tags that can be assigned to new
+        # requests
+        self._tags = list(range(maxrequests - 1, 0, -1))
+
+        # map from transaction tags (uint16) to the ``RequestHandle`` of the
+        # request waiting for a response
+        self._callbacks = {}
+
+        # responses to requests without tags are dispatched in the same order
+        # the as the requests were submitted
+        self._sequential_callbacks = deque()
+
+        # requests waiting for a tag
+        self._waiting = deque()
+
+        # encoded frames waiting to be sent
+        self._outgoing = []
+
+        # partial frame data passed to ``receive_data``
+        self._buffer = bytearray()
+
+        # file descriptors received alongside data that has not yet been
+        # dispatched.  They are attached to the next complete frame
+        self._fds = []
+
+    def request(self, request_type, request,
+                on_success, on_error=None,
+                sequential=False, ancillary=False, buffer=None,
+                handle=None):
+        """ Queue a request to be sent.  Arguments are the same as for
+        ``Marshall.request_async``.
+
+        :param handle: ``RequestHandle`` to use for the request.  A new one is
+            created if not given.
+
+        :returns: a ``RequestHandle`` that can be passed to ``flush``
+        """
+        length = len(request) + _header.size
+        if length > self.max_message_size:
+            raise Exception("packet size exceeds maximum")
+
+        if handle is None:
+            handle = RequestHandle()
+        handle.callback = (on_success, on_error, ancillary, buffer)
+
+        if sequential:
+            self._sequential_callbacks.append(handle)
+            self._outgoing.append(
+                _header.pack(length, request_type, NOTAG) + request)
+        elif self._tags and not self._waiting:
+            self._send_tagged(request_type, request, handle)
+        else:
+            self._waiting.append((request_type, request, handle))
+        return handle
+
+    def _send_tagged(self, request_type, request, handle):
+        tag = self._tags.pop()
+        assert tag not in self._callbacks
+        self._callbacks[tag] = handle
+        handle.tag = tag
+        self._outgoing.append(
+            _header.pack(len(request) + _header.size, request_type, tag) +
+            request)
+
+    def _release_tag(self, tag):
+        handle = self._callbacks.pop(tag)
+        handle.tag = None
+        if not handle.flushing:
+            self._free_tag(tag)
+        # otherwise the tag stays reserved until the flush is acknowledged, so
+        # that it can't be reused while the TFlush naming it is outstanding
+        return handle
+
+    def _free_tag(self, tag):
+        self._tags.append(tag)
+        while self._waiting and self._tags:
+            self._send_tagged(*self._waiting.popleft())
+
+    def flush(self, handle):
+        """ Cancel a request.  If the request has already been sent a TFlush
+        is sent for it, otherwise it is dropped.  Unless a response arrives
+        first, the error callback of the request is called with a
+        ``FlushedError`` once the server has acknowledged the flush.
+
+        Untagged requests can't be flushed.
+        """
+        for index, waiting in enumerate(self._waiting):
+            if waiting[2] is handle:
+                del self._waiting[index]
+                self._fail(handle, FlushedError("flushed"))
+                return
+
+        tag = handle.tag
+        if tag is None or handle.flushing or \
+                self._callbacks.get(tag) is not handle:
+            # already finished or being flushed
+            return
+        handle.flushing = True
+
+        def flushed(type_, body):
+            # the tag of the flushed request can only be reused once the
+            # flush has been acknowledged
+            if self._callbacks.get(tag) is handle:
+                self._callbacks.pop(tag)
+                handle.tag = None
+                self._fail(handle, FlushedError("flushed"))
+            self._free_tag(tag)
+
+        self.request(messages.TFlush.type_id, _oldtag.pack(tag), flushed)
+
+    @staticmethod
+    def _fail(handle, error):
+        on_error = handle.callback[1]
+        if on_error is None:
+            return
+        try:
+            on_error(error)
+        except:
+            log.exception("exception in user callback", stack_info=True)
+
+    @property
+    def pending(self):
+        """ True if there are frames waiting to be sent
+        """
+        return bool(self._outgoing)
+
+    @property
+    def outstanding(self):
+        """ Number of requests that have been sent and are waiting for a
+        response
+        """
+        return len(self._callbacks) + len(self._sequential_callbacks)
+
+    def frames_to_send(self):
+        """ :returns: list of encoded frames that are ready to be sent
+        """
+        frames, self._outgoing = self._outgoing, []
+        return frames
+
+    def response_buffer(self, type_, tag):
+        """ :returns: the buffer that the data of a response with the given
+            type and tag should be read into, or None if the response should
+            be passed to ``receive_frame`` whole.
+        """
+        if type_ != messages.RRead.type_id:
+            return None
+        if tag == NOTAG:
+            if not self._sequential_callbacks:
+                return None
+            return self._sequential_callbacks[0].callback[3]
+        handle = self._callbacks.get(tag)
+        return handle.callback[3] if handle is not None else None
+
+    def receive_data(self, data, fds=()):
+        """ Feed bytes received from the server.  Every complete frame is
+        dispatched to its callback.
+        """
+        self._fds.extend(fds)
+        self._buffer += data
+
+        view = memoryview(self._buffer)
+        offset = 0
+        try:
+            while len(view) - offset >= _header.size:
+                length, type_, tag = _header.unpack_from(view, offset)
+                if not _header.size <= length <= self.max_message_size:
+                    raise Exception("invalid frame length: %i" % length)
+                if len(view) - offset < length:
+                    break
+                body = bytes(view[offset + _header.size:offset + length])
+                offset += length
+                self.receive_frame(type_, tag, body)
+        finally:
+            view.release()
+            del self._buffer[:offset]
+
+    def receive_frame(self, type_, tag, body, fds=()):
+        """ Dispatch a single response frame to its callback.
+
+        If a buffer was registered for the response, ``body`` may be either the
+        whole RRead body, in which case the data is copied into the buffer, or
+        only its count field if the caller has already read the data into the
+        buffer returned by ``response_buffer``.
+        """
+        fds = self._fds + list(fds)
+        self._fds = []
+
+        if tag == NOTAG:
+            if not self._sequential_callbacks:
+                close_fds(fds)
+                raise Exception("unexpected untagged response")
+            handle = self._sequential_callbacks.popleft()
+        else:
+            if tag not in self._callbacks:
+                close_fds(fds)
+                raise Exception("unexpected tag: %i" % tag)
+            # retrieve callback and return tag to free list
+            handle = self._release_tag(tag)
+        on_success, on_error, ancillary, buffer = handle.callback
+        handle.callback = None
+
+        if buffer is not None and type_ == messages.RRead.type_id and \
+                len(body) != _count.size:
+            try:
+                body = self._copy_into(buffer, body)
+            except Exception as error:
+                close_fds(fds)
+                if on_error is not None:
+                    on_error(error)
+                return
+        # callbacks may release the buffer, which fails while any view of it
+        # is still referenced
+        del buffer
+
+        try:
+            if ancillary:
+                # ownership of the file descriptors passes to the callback
+                on_success(type_, body, fds)
+            else:
+                close_fds(fds)
+                on_success(type_, body)
+        except:
+            log.exception("exception in user callback", stack_info=True)
+
+    @staticmethod
+    def _copy_into(buffer, body):
+        if len(body) < _count.size:
+            raise Exception("invalid read response")
+        count, = _count.unpack_from(body)
+        if len(body) != _count.size + count:
+            raise Exception("invalid read response")
+        view = memoryview(buffer).cast('B')
+        if count > len(view):
+            raise Exception("read response larger than buffer")
+        view[:count] = memoryview(body)[_count.size:]
+        return body[:_count.size]
+
+    def connection_lost(self, error):
+        """ Fail every outstanding request with ``error``
+        """
+        handles = list(self._callbacks.values())
+        handles.extend(self._sequential_callbacks)
+        handles.extend(waiting[2] for waiting in self._waiting)
+        self._callbacks = {}
+        self._sequential_callbacks = deque()
+        self._waiting = deque()
+        self._outgoing = []
+        close_fds(self._fds)
+        self._fds = []
+
+        for handle in handles:
+            handle.tag = None
+            self._fail(handle, error)
+
+
+class BlockingRequestMixin(object):
+    """ Provides a blocking ``request`` method on top of ``request_async``
+    """
+
+    def request(self, request_type, request, sequential=False,
+                ancillary=False, buffer=None):
+        """ Send a 9p request to the server and block until a response is
+        received.
+
+        :returns: ``(type, response)`` or, if ``ancillary`` is set,
+            ``(type, response, fds)``
+        """
+        cond = Condition()
+        # dict is used as reference type to allow result to be returned from
+        # seperate thread
+        response_cont = {}
+
+        def on_success(response_type, response, fds=None):
+            with cond:
+                response_cont.update({
+                    "success": True,
+                    "type": response_type,
+                    "response": response,
+                    "fds": fds,
+                })
+                cond.notify()
+
+        def on_error(exception):
+            with cond:
+                response_cont.update({
+                    "success": False,
+                    "exception": exception,
+                })
+                cond.notify()
+
+        with cond:
+            self.request_async(request_type, request,
+                               on_success, on_error,
+                               sequential, ancillary, buffer)
+            while not response_cont:
+                cond.wait()
+
+        if not response_cont["success"]:
+            raise response_cont["exception"]
+
+        if ancillary:
+            return (response_cont["type"], response_cont["response"],
+                    response_cont["fds"])
+        return response_cont["type"], response_cont["response"]
@@ -0,0 +1,307 @@
+import logging
+import selectors
+import socket
+import threading
+
+from collections import deque
+
+from pyixp.marshall import fds_bufsize, unpack_fds
+from pyixp.protocol import Protocol, BlockingRequestMixin, RequestHandle
+
+__all__ = 'Reactor', 'Connection'
+
+log = logging.getLogger(__name__)
+
+_AF_UNIX = getattr(socket, 'AF_UNIX', None)
+
+# number of bytes to ask for on each call to recv
+_RECV_SIZE = 0x10000
+
+
+class Reactor(object):
+    """ Drives any number of 9P connections from a single thread using
+    ``selectors``.
+
+    Callbacks for requests made through the connections of a reactor are run
+    on the reactor thread and so must not block.  In particular they must not
+    make blocking requests.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+
+        # writing to the wakeup socket interrupts ``select`` so that calls
+        # scheduled from other threads are run promptly
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+
+        # functions to be run on the reactor thread
+        self._calls = deque()
+
+        self._connections = set()
+        self._thread = None
+        self._running = False
+        self._stopped = threading.Event()
+
+    def call_soon_threadsafe(self, function, *args):
+        """ Schedule ``function`` to be called with ``args`` on the reactor
+        thread.  Calls are made in the order they are scheduled.
+        """
+        self._calls.append((function, args))
+        if not self.in_reactor_thread():
+            try:
+                self._wakeup_send.send(b'\0')
+            except (BlockingIOError, OSError):
+                # already full, so the reactor is awake anyway
+                pass
+
+    def in_reactor_thread(self):
+        return threading.current_thread() is self._thread
+
+    def _run_calls(self):
+        # only run the calls that were scheduled before starting so that a
+        # call that reschedules itself can not starve the selector
+        for _ in range(len(self._calls)):
+            function, args = self._calls.popleft()
+            try:
+                function(*args)
+            except:
+                log.exception("exception in reactor call", stack_info=True)
+            # the arguments may include a buffer that the caller will release
+            # once its request finishes
+            del function, args
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def run(self):
+        """ Run the reactor on the calling thread until ``stop`` is called
+        """
+        self._thread = threading.current_thread()
+        self._running = True
+        self._stopped.clear()
+        try:
+            while self._running:
+                timeout = 0 if self._calls else None
+                for key, mask in self._selector.select(timeout):
+                    if key.data is None:
+                        self._drain_wakeup()
+                    else:
+                        key.data._handle_events(mask)
+                self._run_calls()
+        finally:
+            self._stopped.set()
+
+    def start(self):
+        """ Run the reactor on a new daemon thread
+
+        :returns: the reactor
+        """
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._running = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the reactor.  Open connections are left open.
+        """
+        def stop():
+            self._running = False
+        self.call_soon_threadsafe(stop)
+        if self._thread is not None and not self.in_reactor_thread():
+            self._stopped.wait()
+
+    def close(self):
+        """ Close every connection and stop the reactor
+        """
+        def close():
+            for connection in list(self._connections):
+                connection._lost(Exception("close"))
+            self._running = False
+        self.call_soon_threadsafe(close)
+        if self._thread is not None and not self.in_reactor_thread():
+            self._stopped.wait()
+        self._selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+
+    def connect(self, sock, maxrequests=1024):
+        """ Start driving the connection to a server
+
+        :param sock: socket connected to the server.  It is switched to non
+            blocking mode and will be closed with the connection.
+
+        :returns: a ``Connection`` that can be passed to ``Client`` in place of
+            the socket.
+        """
+        return Connection(self, sock, maxrequests)
+
+
+class Connection(BlockingRequestMixin):
+    """ 9P connection driven by a ``Reactor``.  Provides the same request
+    interface as a ``Marshall``.
+    """
+
+    def __init__(self, reactor, sock, maxrequests=1024):
+        self._reactor = reactor
+        self._socket = sock
+        self._protocol = Protocol(maxrequests)
+
+        self._unix = _AF_UNIX is not None and sock.family == _AF_UNIX
+
+        # encoded frames that have not yet been accepted by the socket
+        self._outgoing = bytearray()
+
+        self._events = 0
+        self._closed = False
+        self._closed_event = threading.Event()
+
+        sock.setblocking(False)
+        reactor.call_soon_threadsafe(self._register)
+
+    @property
+    def max_message_size(self):
+        return self._protocol.max_message_size
+
+    @max_message_size.setter
+    def max_message_size(self, value):
+        self._protocol.max_message_size = value
+
+    def _register(self):
+        if self._closed:
+            return
+        self._reactor._connections.add(self)
+        self._events = selectors.EVENT_READ
+        self._reactor._selector.register(self._socket, self._events, self)
+
+    def _update_events(self):
+        # only ask to be told about write readiness while there is something
+        # waiting to be written
+        events = selectors.EVENT_READ
+        if self._outgoing:
+            events |= selectors.EVENT_WRITE
+        if events != self._events:
+            self._events = events
+            self._reactor._selector.modify(self._socket, events, self)
+
+    def _send_pending(self):
+        self._outgoing += b''.join(self._protocol.frames_to_send())
+        while self._outgoing:
+            try:
+                sent = self._socket.send(self._outgoing)
+            except (BlockingIOError, InterruptedError):
+                break
+            del self._outgoing[:sent]
+        self._update_events()
+
+    def _receive(self):
+        fds = []
+        try:
+            if self._unix:
+                data, ancdata, flags, address = self._socket.recvmsg(
+                    _RECV_SIZE, fds_bufsize())
+                unpack_fds(ancdata, fds)
+            else:
+                data = self._socket.recv(_RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            raise EOFError('unexpected end of file')
+        self._protocol.receive_data(data, fds)
+
+    def _handle_events(self, mask):
+        try:
+            if mask & selectors.EVENT_READ:
+                self._receive()
+            if mask & selectors.EVENT_WRITE or self._protocol.pending:
+                self._send_pending()
+        except Exception as error:
+            log.info("connection lost", exc_info=True)
+            self._lost(error)
+
+    def _lost(self, error):
+        if self._closed:
+            return
+        self._closed = True
+        self._reactor._connections.discard(self)
+        if self._events:
+            self._reactor._selector.unregister(self._socket)
+        self._socket.close()
+        self._protocol.connection_lost(error)
+        self._closed_event.set()
+
+    def _request(self, request_type, request,
+                 on_success, on_error, sequential, ancillary, buffer, handle):
+        if self._closed:
+            error = Exception("connection closed")
+        else:
+            try:
+                self._protocol.request(request_type, request,
+                                       on_success, on_error,
+                                       sequential, ancillary, buffer,
+                                       handle)
+                self._send_pending()
+                return
+            except Exception as e:
+                error = e
+        if on_error is not None:
+            on_error(error)
+
+    def request_async(self, request_type, request,
+                      on_success, on_error=None,
+                      sequential=False, ancillary=False, buffer=None):
+        """ Send a 9p request to the server.  Arguments are the same as for
+        ``Marshall.request_async``.  Callbacks are run on the reactor thread.
+
+        Data for a ``buffer`` is copied in from the receive buffer rather than
+        read into it directly.
+
+        :returns: a ``RequestHandle`` that can be passed to ``flush``
+        """
+        handle = RequestHandle()
+        self._reactor.call_soon_threadsafe(
+            self._request, request_type, request,
+            on_success, on_error, sequential, ancillary, buffer, handle)
+        return handle
+
+    def _flush_request(self, handle):
+        if not self._closed:
+            self._protocol.flush(handle)
+            self._send_pending()
+
+    def flush(self, handle):
+        """ Cancel a request made with ``request_async`` by sending a TFlush.
+        See ``Protocol.flush``.
+        """
+        self._reactor.call_soon_threadsafe(self._flush_request, handle)
+
+    def _close(self, error):
+        if not self._closed:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._lost(error)
+
+    def shutdown(self):
+        """ Close the connection after any requests already made through it
+        have been passed to the protocol.  Requests still waiting for a
+        response fail.
+        """
+        self._reactor.call_soon_threadsafe(self._close, Exception("shutdown"))
+        if not self._reactor.in_reactor_thread():
+            self._closed_event.wait()
+
+    def close(self, error=None):
+        """ Close the connection and fail all outstanding requests
+        """
+        self._reactor.call_soon_threadsafe(
+            self._close, error or Exception("close"))
+        if not self._reactor.in_reactor_thread():
+            self._closed_event.wait()
@@ -1,8 +1,42 @@
+import os
+import struct
+
 from pyixp import messages
+from pyixp.messages import rread_count as _count
+
+# errno appended to the RError of 9P2000.u servers
+_ecode = struct.Struct("<I")
+
+
+class ServerError(Exception):
+    """ Raised when the server responds to a request with an ``RError``
+
+    :ivar errno: error number sent by 9P2000.u and 9P2000.L servers, or None.
+    """
+    def __init__(self, ename, errno=None):
+        super(ServerError, self).__init__(ename)
+        self.ename = ename
+        self.errno = errno
+
+
+def _parse_error(type_id, response):
+    if type_id == messages.RLError.type_id:
+        ecode = messages.RLError.unpack(response).ecode
+        return ServerError(os.strerror(ecode), ecode)
+
+    # 9P2000.u servers append an errno to the error string
+    ename, size = messages.string.unpack(response)
+    errno = None
+    if len(response) == size + _ecode.size:
+        errno, = _ecode.unpack_from(response, size)
+    elif len(response) != size:
+        raise Exception("invalid length")
+    return ServerError(ename, errno)
 
 
 class Request(object):
     serialize = False
+    ancillary = False
     request_type = None
     response_type = None
 
@@ -13,8 +47,8 @@ class Request(object):
         if type_id == self.response_type.type_id:
             return self.response_type.unpack(response)
 
-        elif type_id == messages.RError.type_id:
-            raise messages.RError.unpack(response)
+        elif type_id in (messages.RError.type_id, messages.RLError.type_id):
+            raise _parse_error(type_id, response)
 
         else:
             raise Exception("unrecognized type id")
@@ -22,23 +56,25 @@ class Request(object):
     def submit(self, marshall):
         response = marshall.request(self.request_type.type_id,
                                     self._request,
-                                    self.serialize)
+                                    self.serialize,
+                                    self.ancillary)
 
         return self._parse_response(*response)
 
     def submit_async(self, marshall, on_success, on_error):
-        def _on_success(type_id, response):
+        def _on_success(type_id, response, *args):
             try:
-                response = self._parse_response(type_id, response)
+                response = self._parse_response(type_id, response, *args)
             except Exception as e:
                 on_error(e)
                 return
             on_success(response)
 
-        marshall.request_async(self.request_type.type_id,
-                               self._request,
-                               _on_success, on_error,
-                               self.serialize)
+        return marshall.request_async(self.request_type.type_id,
+                                      self._request,
+                                      _on_success, on_error,
+                                      self.serialize,
+                                      self.ancillary)
 
 
 class VersionRequest(Request):
@@ -81,6 +117,43 @@ class ReadRequest(Request):
     request_type = messages.TRead
     response_type = messages.RRead
 
+    def _parse_count(self, type_id, response):
+        if type_id == self.response_type.type_id:
+            count, = _count.unpack(response)
+            return count
+        return self._parse_response(type_id, response)
+
+    def submit_into(self, marshall, buffer):
+        """ Read directly into ``buffer``, which can be any writable object
+        supporting the buffer protocol and must be at least as large as the
+        count requested.
+
+        :returns: the number of bytes read
+        """
+        response = marshall.request(self.request_type.type_id,
+                                    self._request,
+                                    self.serialize,
+                                    buffer=buffer)
+        return self._parse_count(*response)
+
+    def submit_into_async(self, marshall, buffer, on_success, on_error):
+        """ As ``submit_into`` but calls ``on_success`` with the number of
+        bytes read.  ``buffer`` must not be touched until a callback is made.
+        """
+        def _on_success(type_id, response):
+            try:
+                count = self._parse_count(type_id, response)
+            except Exception as e:
+                on_error(e)
+                return
+            on_success(count)
+
+        return marshall.request_async(self.request_type.type_id,
+                                      self._request,
+                                      _on_success, on_error,
+                                      self.serialize,
+                                      buffer=buffer)
+
 
 class WriteRequest(Request):
     request_type = messages.TWrite
@@ -108,5 +181,25 @@ class WStatRequest(Request):
 
 
 class OpenFDRequest(Request):
+    """ Open a fid and receive a file descriptor for it from the server.  The
+    ``unixfd`` field of the response is replaced with the descriptor received
+    by this process, which the caller is responsible for closing.
+    """
     request_type = messages.TOpenFD
     response_type = messages.ROpenFD
+    ancillary = True
+
+    def _parse_response(self, type_id, response, fds=()):
+        fds = list(fds)
+        try:
+            response = super(OpenFDRequest, self)._parse_response(
+                type_id, response)
+            if not fds:
+                raise Exception("no file descriptor received")
+        except:
+            for fd in fds:
+                os.close(fd)
+            raise
+        for fd in fds[1:]:
+            os.close(fd)
+        return response._replace(unixfd=fds[0])
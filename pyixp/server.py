@@ -0,0 +1,1291 @@
+import asyncio
+import contextlib
+import errno
+import itertools
+import logging
+import os
+import socket
+import stat as stat_module
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Event, Lock, Thread, current_thread
+
+from pyixp import dialects
+from pyixp import messages
+from pyixp import shm
+from pyixp.marshall import close_fds, recvall, recvall_fds
+from pyixp.messages import header as _header
+from pyixp.requests import ServerError
+
+__all__ = [
+    "Backend", "MemoryFS", "MemoryFile", "MemoryDirectory", "LocalFS",
+    "Session", "Server", "AsyncServer",
+]
+
+log = logging.getLogger(__name__)
+
+VERSION = "9P2000"
+
+# versions of the dialects of 9P2000 accepted by default
+DIALECT_VERSIONS = (dialects.UNIX.version, dialects.LINUX.version)
+
+DEFAULT_MESSAGE_SIZE = 0x00100000
+
+# value used in a TWStat to indicate that a field should not be changed
+_DONTTOUCH32 = 0xffffffff
+_DONTTOUCH64 = 0xffffffffffffffff
+
+
+# errno sent to 9P2000.L clients for errors raised without one
+_ERRNOS = {
+    "permission denied": errno.EACCES,
+    "file exists": errno.EEXIST,
+    "file does not exist": errno.ENOENT,
+    "not a directory": errno.ENOTDIR,
+    "is a directory": errno.EISDIR,
+    "directory not empty": errno.ENOTEMPTY,
+    "invalid file name": errno.EINVAL,
+    "unknown fid": errno.EBADF,
+    "fid in use": errno.EBADF,
+    "unsupported message": errno.EOPNOTSUPP,
+}
+
+
+def _stat_record(value, layout=messages.stat):
+    """ Return a copy of the stat dictionary ``value`` with its size field
+    filled in
+    """
+    value = dict(value)
+    value["size"] = 0
+    value["size"] = len(layout.pack(value)) - 2
+    return value
+
+
+def _stat_u_record(value):
+    """ As ``_stat_record``, but also fills in the fields added by 9P2000.u
+    if the backend left them out
+    """
+    value = dict(value)
+    value.setdefault("extension", "")
+    for name in ("uid", "gid", "muid"):
+        value.setdefault("n_" + name, _numeric_id(value[name]))
+    return _stat_record(value, dialects.stat_u)
+
+
+class Backend(object):
+    """ Interface between the server and the file tree that it exports.
+
+    Nodes and handles are opaque to the server.  Methods should raise
+    ``ServerError`` to return an error to the client.  Methods may be called
+    concurrently from multiple threads.
+    """
+
+    def attach(self, uname, aname):
+        """ :returns: the root node of the tree named ``aname``
+        """
+        raise NotImplementedError()
+
+    def walk(self, node, name):
+        """ :returns: the child of ``node`` called ``name``
+        """
+        raise NotImplementedError()
+
+    def qid(self, node):
+        raise NotImplementedError()
+
+    def stat(self, node):
+        """ :returns: stat dictionary for ``node``.  The size field is filled
+            in by the server.
+        """
+        raise NotImplementedError()
+
+    def listdir(self, node):
+        """ :returns: list of stat dictionaries for the children of ``node``
+        """
+        raise NotImplementedError()
+
+    def open(self, node, mode):
+        """ :returns: handle passed to ``read``, ``write`` and ``clunk``
+        """
+        raise NotImplementedError()
+
+    def create(self, node, name, perm, mode):
+        """ :returns: ``(node, handle)`` for the newly created child of
+            ``node``
+        """
+        raise ServerError("permission denied")
+
+    def read(self, handle, offset, count, cancelled):
+        """ :param cancelled: ``threading.Event`` that is set if the client
+            flushes the request.  Implementations that block should return as
+            soon as possible once it is set.  The response is only discarded
+            if the implementation saw it set, otherwise the request is assumed
+            to have taken effect.
+        """
+        raise ServerError("permission denied")
+
+    def write(self, handle, offset, data, cancelled):
+        """ :returns: the number of bytes written
+        """
+        raise ServerError("permission denied")
+
+    def clunk(self, node, handle):
+        """ Release the handle returned by ``open`` or ``create``
+        """
+
+    def remove(self, node):
+        raise ServerError("permission denied")
+
+    def wstat(self, node, stat):
+        raise ServerError("permission denied")
+
+
+_next_qid_path = itertools.count(1)
+
+
+class MemoryFile(object):
+    """ File in a ``MemoryFS``.  Subclasses can override ``read`` and
+    ``write`` to serve synthetic files.
+    """
+    is_dir = False
+
+    def __init__(self, name, data=b'', perm=0o644, uid="none"):
+        self.name = name
+        self.parent = None
+        self.perm = perm
+        self.uid = uid
+        self.version = 0
+        self.path = next(_next_qid_path)
+        self.mtime = int(time.time())
+        self.data = bytearray(data)
+
+    def qid(self):
+        return {
+            "type": messages.QTDIR if self.is_dir else messages.QTFILE,
+            "version": self.version,
+            "path": self.path,
+        }
+
+    def stat(self):
+        mode = self.perm | (messages.DMDIR if self.is_dir else 0)
+        return {
+            "size": 0, "type": 0, "dev": 0,
+            "qid": self.qid(),
+            "mode": mode,
+            "atime": self.mtime, "mtime": self.mtime,
+            "length": 0 if self.is_dir else len(self.data),
+            "name": self.name,
+            "uid": self.uid, "gid": self.uid, "muid": self.uid,
+        }
+
+    def modified(self):
+        self.version = (self.version + 1) & 0xffffffff
+        self.mtime = int(time.time())
+
+    def read(self, offset, count, cancelled):
+        return bytes(self.data[offset:offset + count])
+
+    def write(self, offset, data, cancelled):
+        if offset > len(self.data):
+            self.data.extend(bytes(offset - len(self.data)))
+        self.data[offset:offset + len(data)] = data
+        self.modified()
+        return len(data)
+
+    def truncate(self, length=0):
+        if length < len(self.data):
+            del self.data[length:]
+        else:
+            self.data.extend(bytes(length - len(self.data)))
+        self.modified()
+
+
+class MemoryDirectory(MemoryFile):
+    is_dir = True
+
+    def __init__(self, name, perm=0o755, uid="none"):
+        super(MemoryDirectory, self).__init__(name, perm=perm, uid=uid)
+        self.children = {}
+
+    def add(self, node):
+        if node.name in self.children:
+            raise ServerError("file exists")
+        node.parent = self
+        self.children[node.name] = node
+        self.modified()
+        return node
+
+
+class MemoryFS(Backend):
+    """ Backend serving a tree of ``MemoryFile`` and ``MemoryDirectory``
+    nodes
+    """
+    def __init__(self, root=None):
+        self.root = root if root is not None else MemoryDirectory("/")
+        self._lock = Lock()
+
+    def lookup(self, path):
+        node = self.root
+        for name in path.split('/'):
+            if name:
+                node = self.walk(node, name)
+        return node
+
+    def add(self, path, node):
+        """ Add ``node`` to the directory at ``path``
+        """
+        with self._lock:
+            return self.lookup(path).add(node)
+
+    def attach(self, uname, aname):
+        return self.root
+
+    def walk(self, node, name):
+        if not node.is_dir:
+            raise ServerError("not a directory")
+        if name == "..":
+            return node.parent if node.parent is not None else node
+        try:
+            return node.children[name]
+        except KeyError:
+            raise ServerError("file does not exist")
+
+    def qid(self, node):
+        return node.qid()
+
+    def stat(self, node):
+        return node.stat()
+
+    def listdir(self, node):
+        with self._lock:
+            children = list(node.children.values())
+        return [child.stat() for child in children]
+
+    def open(self, node, mode):
+        if node.is_dir:
+            if mode & 0x03 != messages.OREAD or mode & messages.OTRUNC:
+                raise ServerError("is a directory")
+        elif mode & messages.OTRUNC:
+            node.truncate()
+        return node
+
+    def create(self, node, name, perm, mode):
+        if not node.is_dir:
+            raise ServerError("not a directory")
+        if perm & messages.DMDIR:
+            child = MemoryDirectory(name, perm=perm & 0o777, uid=node.uid)
+        else:
+            child = MemoryFile(name, perm=perm & 0o777, uid=node.uid)
+        with self._lock:
+            node.add(child)
+        return child, child
+
+    def read(self, handle, offset, count, cancelled):
+        return handle.read(offset, count, cancelled)
+
+    def write(self, handle, offset, data, cancelled):
+        if handle.is_dir:
+            raise ServerError("is a directory")
+        return handle.write(offset, data, cancelled)
+
+    def remove(self, node):
+        with self._lock:
+            if node.parent is None:
+                raise ServerError("permission denied")
+            if node.is_dir and node.children:
+                raise ServerError("directory not empty")
+            if node.parent.children.get(node.name) is node:
+                del node.parent.children[node.name]
+                node.parent.modified()
+
+    def wstat(self, node, stat):
+        with self._lock:
+            if stat["name"] and stat["name"] != node.name:
+                if node.parent is None:
+                    raise ServerError("permission denied")
+                if stat["name"] in node.parent.children:
+                    raise ServerError("file exists")
+                del node.parent.children[node.name]
+                node.name = stat["name"]
+                node.parent.children[node.name] = node
+            if stat["length"] != _DONTTOUCH64:
+                if node.is_dir:
+                    raise ServerError("is a directory")
+                node.truncate(stat["length"])
+            if stat["mode"] != _DONTTOUCH32:
+                node.perm = stat["mode"] & 0o777
+            if stat["mtime"] != _DONTTOUCH32:
+                node.mtime = stat["mtime"]
+
+
+@contextlib.contextmanager
+def _translate_errors():
+    try:
+        yield
+    except OSError as error:
+        raise ServerError(error.strerror or str(error), error.errno)
+
+
+def _owner_names(st):
+    try:
+        import pwd
+        uid = pwd.getpwuid(st.st_uid).pw_name
+    except (ImportError, KeyError):
+        uid = str(st.st_uid)
+    try:
+        import grp
+        gid = grp.getgrgid(st.st_gid).gr_name
+    except (ImportError, KeyError):
+        gid = str(st.st_gid)
+    return uid, gid
+
+
+class LocalFS(Backend):
+    """ Backend exporting a directory of the local filesystem.  Nodes are
+    paths.  Symbolic links that point outside of the exported directory can
+    not be followed.
+    """
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+
+    def _check(self, path):
+        real = os.path.realpath(path)
+        if real != self.root and not real.startswith(self.root + os.sep):
+            raise ServerError("permission denied")
+
+    def attach(self, uname, aname):
+        return self.root
+
+    def walk(self, node, name):
+        if name == "..":
+            return node if node == self.root else os.path.dirname(node)
+        if name in ("", ".") or os.sep in name:
+            raise ServerError("invalid file name")
+        path = os.path.join(node, name)
+        with _translate_errors():
+            os.lstat(path)
+        self._check(path)
+        return path
+
+    def _qid(self, st):
+        if stat_module.S_ISDIR(st.st_mode):
+            type_ = messages.QTDIR
+        else:
+            type_ = messages.QTFILE
+        return {
+            "type": type_,
+            "version": (st.st_mtime_ns ^ st.st_size) & 0xffffffff,
+            "path": st.st_ino,
+        }
+
+    def qid(self, node):
+        with _translate_errors():
+            return self._qid(os.stat(node))
+
+    def _stat(self, path, st):
+        mode = stat_module.S_IMODE(st.st_mode) & 0o777
+        if stat_module.S_ISDIR(st.st_mode):
+            mode |= messages.DMDIR
+        uid, gid = _owner_names(st)
+        return {
+            "size": 0, "type": 0, "dev": st.st_dev & 0xffffffff,
+            "qid": self._qid(st),
+            "mode": mode,
+            "atime": int(st.st_atime) & 0xffffffff,
+            "mtime": int(st.st_mtime) & 0xffffffff,
+            "length": 0 if stat_module.S_ISDIR(st.st_mode) else st.st_size,
+            "name": "/" if path == self.root else os.path.basename(path),
+            "uid": uid, "gid": gid, "muid": uid,
+        }
+
+    def stat(self, node):
+        with _translate_errors():
+            return self._stat(node, os.stat(node))
+
+    def listdir(self, node):
+        with _translate_errors():
+            names = sorted(os.listdir(node))
+        entries = []
+        for name in names:
+            path = os.path.join(node, name)
+            try:
+                entries.append(self._stat(path, os.stat(path)))
+            except OSError:
+                # broken links and files removed while listing
+                continue
+        return entries
+
+    def _flags(self, mode):
+        flags = [os.O_RDONLY, os.O_WRONLY, os.O_RDWR, os.O_RDONLY][mode & 0x03]
+        if mode & messages.OTRUNC:
+            flags |= os.O_TRUNC
+        return flags
+
+    def open(self, node, mode):
+        with _translate_errors():
+            if os.path.isdir(node):
+                if mode & 0x03 != messages.OREAD:
+                    raise ServerError("is a directory")
+                return None
+            return os.open(node, self._flags(mode))
+
+    def create(self, node, name, perm, mode):
+        if name in ("", ".", "..") or os.sep in name:
+            raise ServerError("invalid file name")
+        path = os.path.join(node, name)
+        with _translate_errors():
+            if perm & messages.DMDIR:
+                os.mkdir(path, perm & 0o777)
+                return path, None
+            fd = os.open(path, self._flags(mode) | os.O_CREAT | os.O_EXCL,
+                         perm & 0o777)
+            return path, fd
+
+    def read(self, handle, offset, count, cancelled):
+        if handle is None:
+            raise ServerError("is a directory")
+        with _translate_errors():
+            return os.pread(handle, count, offset)
+
+    def write(self, handle, offset, data, cancelled):
+        if handle is None:
+            raise ServerError("is a directory")
+        with _translate_errors():
+            return os.pwrite(handle, data, offset)
+
+    def clunk(self, node, handle):
+        if handle is not None:
+            os.close(handle)
+
+    def remove(self, node):
+        if node == self.root:
+            raise ServerError("permission denied")
+        with _translate_errors():
+            if os.path.isdir(node) and not os.path.islink(node):
+                os.rmdir(node)
+            else:
+                os.unlink(node)
+
+    def wstat(self, node, stat):
+        with _translate_errors():
+            if stat["length"] != _DONTTOUCH64:
+                os.truncate(node, stat["length"])
+            if stat["mode"] != _DONTTOUCH32:
+                os.chmod(node, stat["mode"] & 0o777)
+            if stat["mtime"] != _DONTTOUCH32:
+                st = os.stat(node)
+                os.utime(node, (st.st_atime, stat["mtime"]))
+            if stat["name"] and stat["name"] != os.path.basename(node):
+                if node == self.root or os.sep in stat["name"]:
+                    raise ServerError("permission denied")
+                os.rename(node, os.path.join(os.path.dirname(node),
+                                             stat["name"]))
+
+
+class _Fid(object):
+    __slots__ = ('node', 'qid', 'handle', 'mode', 'opened',
+                 'dir_entries', 'dir_offset', 'listing')
+
+    def __init__(self, node, qid):
+        self.node = node
+        self.qid = qid
+        self.handle = None
+        self.mode = None
+        self.opened = False
+        self.dir_entries = None
+        self.dir_offset = 0
+        # stat dictionaries of the entries listed by TReadDir
+        self.listing = None
+
+
+class _Cancelled(Event):
+    """ Event set when a running request is flushed, which remembers whether
+    the handler ever saw it set.  A handler that didn't may have completed
+    its side effects, so its response still has to be sent.
+    """
+
+    def __init__(self):
+        super(_Cancelled, self).__init__()
+        self.observed = False
+
+    def is_set(self):
+        if super(_Cancelled, self).is_set():
+            self.observed = True
+            return True
+        return False
+
+    def wait(self, timeout=None):
+        if super(_Cancelled, self).wait(timeout):
+            self.observed = True
+            return True
+        return False
+
+
+class _Task(object):
+    __slots__ = ('tag', 'handler', 'message', 'keys',
+                 'started', 'responding', 'cancelled', 'flush_tags')
+
+    def __init__(self, tag, handler, message, keys):
+        self.tag = tag
+        self.handler = handler
+        self.message = message
+
+        # map from the fids used by the request to a boolean indicating if the
+        # request needs exclusive access to them
+        self.keys = keys
+
+        self.started = False
+
+        # set once the handler has returned and its response is being sent.
+        # The client may reuse the tag as soon as the response arrives
+        self.responding = False
+
+        self.cancelled = _Cancelled()
+        self.flush_tags = []
+
+
+def _exclusive(message):
+    return {message.fid: True}
+
+
+def _shared(message):
+    return {message.fid: False}
+
+
+def _walk_keys(message):
+    if message.fid == message.newfid:
+        return {message.fid: True}
+    return {message.fid: False, message.newfid: True}
+
+
+class Session(object):
+    """ Protocol state for a single connection, independent of how messages
+    are received and how handlers are run.
+
+    Decoded requests are dispatched to the backend concurrently, except that
+    requests that change what a fid refers to (attach, walk to a new fid, open,
+    create, clunk and remove) are ordered with respect to every other request
+    using the same fid.  Clients can therefore pipeline chains of requests on a
+    fid without waiting for each response.
+
+    :param send: called with each encoded response frame.  May be called from
+        any thread.
+
+    :param run: called with a function of no arguments that should be run,
+        typically on a thread pool.
+
+    :param versions: versions of the dialects of 9P2000 that are accepted.
+        Clients asking for any other version are answered with plain 9P2000.
+    """
+
+    def __init__(self, backend, send, run,
+                 max_message_size=DEFAULT_MESSAGE_SIZE,
+                 versions=DIALECT_VERSIONS):
+        self.backend = backend
+        self.versions = versions
+
+        # the configured limit, which every TVersion is negotiated against,
+        # and the size agreed by the last one
+        self._message_size_limit = max_message_size
+        self.max_message_size = max_message_size
+        self._send = send
+        self._run = run
+
+        self._lock = Lock()
+        self._fids = {}
+
+        # map from tag to outstanding task
+        self._tasks = {}
+
+        # map from fid to the tasks that use it in the order they arrived
+        self._queues = {}
+
+        self._handlers = {
+            messages.TAuth.type_id: (messages.TAuth, self._auth, None),
+            messages.TAttach.type_id:
+                (messages.TAttach, self._attach, _exclusive),
+            messages.TWalk.type_id: (messages.TWalk, self._walk, _walk_keys),
+            messages.TOpen.type_id: (messages.TOpen, self._open, _exclusive),
+            messages.TCreate.type_id:
+                (messages.TCreate, self._create, _exclusive),
+            messages.TRead.type_id: (messages.TRead, self._read, _shared),
+            messages.TWrite.type_id: (messages.TWrite, self._write, _shared),
+            messages.TClunk.type_id:
+                (messages.TClunk, self._clunk, _exclusive),
+            messages.TRemove.type_id:
+                (messages.TRemove, self._remove, _exclusive),
+            messages.TStat.type_id: (messages.TStat, self._stat, _shared),
+            messages.TWStat.type_id: (messages.TWStat, self._wstat, _shared),
+        }
+        self._base_handlers = self._handlers
+
+        # 9P2000.u adds numeric ids to attach messages and extends stat
+        # records
+        self._unix_handlers = dict(self._handlers)
+        self._unix_handlers.update({
+            dialects.TAuthU.type_id: (dialects.TAuthU, self._auth, None),
+            dialects.TAttachU.type_id:
+                (dialects.TAttachU, self._attach, _exclusive),
+            dialects.TCreateU.type_id:
+                (dialects.TCreateU, self._create_u, _exclusive),
+            messages.TStat.type_id: (messages.TStat, self._stat_u, _shared),
+            dialects.TWStatU.type_id:
+                (dialects.TWStatU, self._wstat, _shared),
+        })
+
+        # 9P2000.L replaces the attach message and adds its own for opening,
+        # creating, examining and listing files
+        self._linux_handlers = dict(self._handlers)
+        self._linux_handlers.update({
+            dialects.TAttachU.type_id:
+                (dialects.TAttachU, self._attach, _exclusive),
+            dialects.TLOpen.type_id:
+                (dialects.TLOpen, self._lopen, _exclusive),
+            dialects.TLCreate.type_id:
+                (dialects.TLCreate, self._lcreate, _exclusive),
+            dialects.TGetAttr.type_id:
+                (dialects.TGetAttr, self._getattr, _shared),
+            dialects.TReadDir.type_id:
+                (dialects.TReadDir, self._readdir, _shared),
+            dialects.TMkDir.type_id:
+                (dialects.TMkDir, self._mkdir,
+                 lambda message: {message.dfid: False}),
+        })
+        self._unix = False
+        self._linux = False
+
+    def _respond(self, tag, response):
+        data = response.pack()
+        try:
+            self._send(_header.pack(len(data) + _header.size,
+                                    response.type_id, tag) + data)
+        except OSError:
+            log.info("failed to send response", exc_info=True)
+
+    def _error(self, ename, ecode=None):
+        if self._linux:
+            return dialects.RLError(ecode or _ERRNOS.get(ename, errno.EIO))
+        if self._unix:
+            return dialects.RErrorU(
+                ename, ecode or _ERRNOS.get(ename, errno.EIO))
+        return messages.RError(ename)
+
+    def _unpack(self, tag, message_type, body):
+        try:
+            return message_type.unpack(body)
+        except Exception:
+            log.info("invalid message", exc_info=True)
+            self._respond(tag, self._error("invalid message"))
+            return None
+
+    def receive(self, type_id, tag, body):
+        """ Handle a single T-message
+        """
+        if type_id == messages.TVersion.type_id:
+            message = self._unpack(tag, messages.TVersion, body)
+            if message is not None:
+                self._respond(tag, self._version(message))
+            return
+
+        if type_id == messages.TFlush.type_id:
+            message = self._unpack(tag, messages.TFlush, body)
+            if message is not None:
+                self._flush(tag, message.oldtag)
+            return
+
+        try:
+            message_type, handler, keys = self._handlers[type_id]
+        except KeyError:
+            self._respond(tag, self._error("unsupported message"))
+            return
+
+        message = self._unpack(tag, message_type, body)
+        if message is None:
+            return
+
+        task = _Task(tag, handler, message,
+                     keys(message) if keys is not None else {})
+        with self._lock:
+            if tag in self._tasks and not self._tasks[tag].responding:
+                error = True
+            else:
+                error = False
+                self._tasks[tag] = task
+                ready = self._enqueue(task)
+        if error:
+            self._respond(tag, self._error("tag in use"))
+        elif ready:
+            self._run(partial(self._execute, task))
+
+    def _ready(self, task):
+        # must be called with the lock held
+        for fid, exclusive in task.keys.items():
+            for other in self._queues[fid]:
+                if other is task:
+                    break
+                if exclusive or other.keys[fid]:
+                    return False
+        return True
+
+    def _enqueue(self, task):
+        # must be called with the lock held.  Returns true if the task can be
+        # started immediately
+        for fid in task.keys:
+            self._queues.setdefault(fid, []).append(task)
+        task.started = self._ready(task)
+        return task.started
+
+    def _dequeue(self, task):
+        # must be called with the lock held.  Returns the tasks that were
+        # waiting for ``task`` and can now be started
+        woken = []
+        for fid in task.keys:
+            queue = self._queues[fid]
+            queue.remove(task)
+            if not queue:
+                del self._queues[fid]
+                continue
+            for other in queue:
+                if not other.started and self._ready(other):
+                    other.started = True
+                    woken.append(other)
+        return woken
+
+    def _execute(self, task):
+        try:
+            response = task.handler(task.message, task.cancelled)
+        except ServerError as error:
+            response = self._error(error.ename, error.errno)
+        except Exception as error:
+            log.exception("error handling request")
+            response = self._error(str(error) or "internal error")
+
+        # the task stays in ``_tasks`` until its response has been sent, so
+        # that a TFlush arriving meanwhile is answered after the response.
+        # The response to a flushed request is only dropped if the handler
+        # gave up because of the flush.  Otherwise the request has taken
+        # effect, and the client must see its response before the RFlush
+        with self._lock:
+            task.responding = True
+            dropped = bool(task.flush_tags) and task.cancelled.observed
+        if not dropped:
+            self._respond(task.tag, response)
+
+        with self._lock:
+            if self._tasks.get(task.tag) is task:
+                del self._tasks[task.tag]
+            flush_tags = task.flush_tags
+            woken = self._dequeue(task)
+
+        for flush_tag in flush_tags:
+            self._respond(flush_tag, messages.RFlush())
+
+        for other in woken:
+            self._run(partial(self._execute, other))
+
+    def _flush(self, tag, oldtag):
+        with self._lock:
+            task = self._tasks.get(oldtag)
+            if task is not None and task.started:
+                # the responses are sent once the running handler returns
+                task.flush_tags.append(tag)
+                task.cancelled.set()
+                return
+            woken = []
+            if task is not None:
+                del self._tasks[oldtag]
+                woken = self._dequeue(task)
+
+        self._respond(tag, messages.RFlush())
+        for other in woken:
+            self._run(partial(self._execute, other))
+
+    def _get_fid(self, fid):
+        try:
+            return self._fids[fid]
+        except KeyError:
+            raise ServerError("unknown fid")
+
+    def _release(self, fid):
+        if fid.opened:
+            self.backend.clunk(fid.node, fid.handle)
+            if fid.mode & messages.ORCLOSE:
+                self.backend.remove(fid.node)
+
+    def close(self):
+        """ Release all fids.  Should be called once the connection is closed
+        """
+        with self._lock:
+            fids, self._fids = list(self._fids.values()), {}
+        for fid in fids:
+            try:
+                self._release(fid)
+            except Exception:
+                log.exception("error releasing fid")
+
+    def _version(self, message):
+        self.close()
+        self.max_message_size = min(message.msize, self._message_size_limit)
+        accepted = message.version in self.versions
+        self._unix = accepted and message.version == dialects.UNIX.version
+        self._linux = accepted and message.version == dialects.LINUX.version
+        if self._unix:
+            version = dialects.UNIX.version
+            self._handlers = self._unix_handlers
+        elif self._linux:
+            version = dialects.LINUX.version
+            self._handlers = self._linux_handlers
+        elif message.version.startswith(VERSION):
+            version = VERSION
+            self._handlers = self._base_handlers
+        else:
+            version = "unknown"
+        return messages.RVersion(self.max_message_size, version)
+
+    @property
+    def iounit(self):
+        """ the most data that fits in a single read or write at the
+        negotiated message size, reported to clients as the iounit of opened
+        fids
+        """
+        return self.max_message_size - messages.IOHDRSZ
+
+    def _auth(self, message, cancelled):
+        raise ServerError("authentication not required")
+
+    def _attach(self, message, cancelled):
+        if message.fid in self._fids:
+            raise ServerError("fid in use")
+        node = self.backend.attach(message.uname, message.aname)
+        qid = self.backend.qid(node)
+        self._fids[message.fid] = _Fid(node, qid)
+        return messages.RAttach(qid)
+
+    def _walk(self, message, cancelled):
+        fid = self._get_fid(message.fid)
+        if fid.opened:
+            raise ServerError("cannot walk an open fid")
+        if message.newfid != message.fid and message.newfid in self._fids:
+            raise ServerError("fid in use")
+        if len(message.path) > messages.MAXWELEM:
+            raise ServerError("too many path elements")
+
+        node, qid = fid.node, fid.qid
+        qids = []
+        for name in message.path:
+            try:
+                node = self.backend.walk(node, name)
+            except ServerError:
+                if not qids:
+                    raise
+                break
+            qid = self.backend.qid(node)
+            qids.append(qid)
+
+        if len(qids) == len(message.path):
+            self._fids[message.newfid] = _Fid(node, qid)
+        return messages.RWalk(qids)
+
+    def _open(self, message, cancelled):
+        fid = self._get_fid(message.fid)
+        if fid.opened:
+            raise ServerError("fid already open")
+        fid.handle = self.backend.open(fid.node, message.mode)
+        fid.mode = message.mode
+        fid.opened = True
+        fid.qid = self.backend.qid(fid.node)
+        return messages.ROpen(fid.qid, self.iounit)
+
+    def _lopen(self, message, cancelled):
+        fid = self._get_fid(message.fid)
+        if fid.opened:
+            raise ServerError("fid already open")
+        mode = _mode_from_flags(message.flags)
+        fid.handle = self.backend.open(fid.node, mode)
+        fid.mode = mode
+        fid.opened = True
+        fid.qid = self.backend.qid(fid.node)
+        return dialects.RLOpen(fid.qid, self.iounit)
+
+    def _create(self, message, cancelled):
+        fid = self._get_fid(message.fid)
+        if fid.opened:
+            raise ServerError("fid already open")
+        node, handle = self.backend.create(
+            fid.node, message.name, message.perm, message.mode)
+        fid.node, fid.handle = node, handle
+        fid.mode = message.mode
+        fid.opened = True
+        fid.qid = self.backend.qid(node)
+        return messages.RCreate(fid.qid, self.iounit)
+
+    def _create_u(self, message, cancelled):
+        if message.extension:
+            # symlinks, devices and other special files
+            raise ServerError("permission denied")
+        return self._create(message, cancelled)
+
+    def _lcreate(self, message, cancelled):
+        fid = self._get_fid(message.fid)
+        if fid.opened:
+            raise ServerError("fid already open")
+        mode = _mode_from_flags(message.flags)
+        node, handle = self.backend.create(
+            fid.node, message.name, message.mode & 0o777, mode)
+        fid.node, fid.handle = node, handle
+        fid.mode = mode
+        fid.opened = True
+        fid.qid = self.backend.qid(node)
+        return dialects.RLCreate(fid.qid, self.iounit)
+
+    def _mkdir(self, message, cancelled):
+        fid = self._get_fid(message.dfid)
+        node, handle = self.backend.create(
+            fid.node, message.name, message.mode & 0o777 | messages.DMDIR,
+            messages.OREAD)
+        self.backend.clunk(node, handle)
+        return dialects.RMkDir(self.backend.qid(node))
+
+    def _read(self, message, cancelled):
+        fid = self._get_fid(message.fid)
+        if not fid.opened or fid.mode & 0x03 == messages.OWRITE:
+            raise ServerError("fid not open for reading")
+        count = min(message.count, self.iounit)
+
+        if fid.qid["type"] & messages.QTDIR:
+            return messages.RRead(self._read_dir(fid, message.offset, count))
+
+        return messages.RRead(self.backend.read(
+            fid.handle, message.offset, count, cancelled))
+
+    def _read_dir(self, fid, offset, count):
+        if offset == 0:
+            if self._unix:
+                entries = (dialects.stat_u.pack(_stat_u_record(entry))
+                           for entry in self.backend.listdir(fid.node))
+            else:
+                entries = (messages.stat.pack(_stat_record(entry))
+                           for entry in self.backend.listdir(fid.node))
+            fid.dir_entries = deque(entries)
+            fid.dir_offset = 0
+        elif offset != fid.dir_offset:
+            raise ServerError("bad offset in directory read")
+
+        # directory reads must only return whole entries
+        chunks = []
+        size = 0
+        while fid.dir_entries and size + len(fid.dir_entries[0]) <= count:
+            entry = fid.dir_entries.popleft()
+            chunks.append(entry)
+            size += len(entry)
+        if not chunks and fid.dir_entries:
+            # an empty read would look like the end of the directory
+            raise ServerError("directory entry too large for read")
+        fid.dir_offset += size
+        return b''.join(chunks)
+
+    def _readdir(self, message, cancelled):
+        fid = self._get_fid(message.fid)
+        if not fid.opened or not fid.qid["type"] & messages.QTDIR:
+            raise ServerError("not a directory")
+        count = min(message.count, self.iounit)
+
+        # the offset of an entry is its index in the listing taken when the
+        # directory was read from the start
+        if message.offset == 0 or fid.listing is None:
+            fid.listing = self.backend.listdir(fid.node)
+        chunks = []
+        size = 0
+        for index in range(message.offset, len(fid.listing)):
+            entry = fid.listing[index]
+            data = dialects.dirent.pack({
+                "qid": entry["qid"],
+                "offset": index + 1,
+                "type": _DT_DIR if entry["qid"]["type"] & messages.QTDIR
+                else _DT_REG,
+                "name": entry["name"],
+            })
+            if size + len(data) > count:
+                if not chunks:
+                    raise ServerError("directory entry too large for read",
+                                      errno.EINVAL)
+                break
+            chunks.append(data)
+            size += len(data)
+        return dialects.RReadDir(b''.join(chunks))
+
+    def _write(self, message, cancelled):
+        fid = self._get_fid(message.fid)
+        if not fid.opened or fid.mode & 0x03 not in (messages.OWRITE,
+                                                     messages.ORDWR):
+            raise ServerError("fid not open for writing")
+        return messages.RWrite(self.backend.write(
+            fid.handle, message.offset, message.data, cancelled))
+
+    def _clunk(self, message, cancelled):
+        fid = self._fids.pop(message.fid, None)
+        if fid is None:
+            raise ServerError("unknown fid")
+        self._release(fid)
+        return messages.RClunk()
+
+    def _remove(self, message, cancelled):
+        fid = self._fids.pop(message.fid, None)
+        if fid is None:
+            raise ServerError("unknown fid")
+        try:
+            self.backend.remove(fid.node)
+        finally:
+            if fid.opened:
+                self.backend.clunk(fid.node, fid.handle)
+        return messages.RRemove()
+
+    def _stat(self, message, cancelled):
+        fid = self._get_fid(message.fid)
+        return messages.RStat(_stat_record(self.backend.stat(fid.node)))
+
+    def _stat_u(self, message, cancelled):
+        fid = self._get_fid(message.fid)
+        return dialects.RStatU(_stat_u_record(self.backend.stat(fid.node)))
+
+    def _getattr(self, message, cancelled):
+        fid = self._get_fid(message.fid)
+        stat = self.backend.stat(fid.node)
+        if stat["mode"] & messages.DMDIR:
+            mode = stat_module.S_IFDIR
+        else:
+            mode = stat_module.S_IFREG
+        return dialects.RGetAttr(
+            valid=dialects.GETATTR_BASIC, qid=stat["qid"],
+            mode=mode | stat["mode"] & 0o777,
+            uid=_numeric_id(stat["uid"]), gid=_numeric_id(stat["gid"]),
+            nlink=1, rdev=0, size=stat["length"], blksize=4096,
+            blocks=(stat["length"] + 511) // 512,
+            atime_sec=stat["atime"], atime_nsec=0,
+            mtime_sec=stat["mtime"], mtime_nsec=0,
+            ctime_sec=stat["mtime"], ctime_nsec=0,
+            btime_sec=0, btime_nsec=0, gen=0, data_version=0)
+
+    def _wstat(self, message, cancelled):
+        fid = self._get_fid(message.fid)
+        self.backend.wstat(fid.node, message.stat)
+        return messages.RWStat()
+
+
+# dirent types
+_DT_DIR = 4
+_DT_REG = 8
+
+
+def _mode_from_flags(flags):
+    """ Convert the linux flags of a TLOpen or TLCreate to a 9P open mode
+    """
+    mode = {
+        dialects.L_O_RDONLY: messages.OREAD,
+        dialects.L_O_WRONLY: messages.OWRITE,
+        dialects.L_O_RDWR: messages.ORDWR,
+    }.get(flags & 0x03, messages.OREAD)
+    if flags & dialects.L_O_TRUNC:
+        mode |= messages.OTRUNC
+    return mode
+
+
+def _numeric_id(name):
+    return int(name) if name.isdigit() else dialects.NONUNAME
+
+
+class Server(object):
+    """ Serves each connection from its own receive thread, with requests
+    dispatched to a shared thread pool
+    """
+
+    def __init__(self, backend, max_workers=16,
+                 max_message_size=DEFAULT_MESSAGE_SIZE, shared_memory=True,
+                 versions=DIALECT_VERSIONS):
+        """
+        :param shared_memory: accept offers of a shared memory transport from
+            clients connected over unix sockets.  See ``pyixp.shm``.
+
+        :param versions: see ``Session``.
+        """
+        self.backend = backend
+        self.max_message_size = max_message_size
+        self.shared_memory = shared_memory
+        self.versions = versions
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._listener = None
+
+        # map from the thread serving each connection to its socket
+        self._lock = Lock()
+        self._connections = {}
+        self._closing = False
+
+    def serve_connection(self, sock):
+        """ Start serving ``sock`` on a new daemon thread
+        """
+        thread = Thread(target=self._serve_connection, args=(sock,),
+                        daemon=True)
+        with self._lock:
+            if self._closing:
+                # the thread exits as soon as it tries to read
+                sock.close()
+            else:
+                self._connections[thread] = sock
+        thread.start()
+        return thread
+
+    def _serve_connection(self, sock):
+        lock = Lock()
+        # the connection is replaced if the client switches to a shared memory
+        # transport
+        connection = [sock]
+
+        def send(data):
+            with lock:
+                connection[0].sendall(data)
+
+        session = Session(self.backend, send, self._executor.submit,
+                          self.max_message_size, self.versions)
+        unix = self.shared_memory and \
+            getattr(sock, 'family', None) == getattr(socket, 'AF_UNIX', None)
+        try:
+            while True:
+                fds = []
+                if unix and connection[0] is sock:
+                    header = recvall_fds(sock, _header.size, fds)
+                else:
+                    header = recvall(connection[0], _header.size)
+                length, type_id, tag = _header.unpack(header)
+                if not _header.size <= length <= session.max_message_size:
+                    close_fds(fds)
+                    log.warning("invalid frame length: %i", length)
+                    return
+                if unix and connection[0] is sock:
+                    body = recvall_fds(sock, length - _header.size, fds)
+                else:
+                    body = recvall(connection[0], length - _header.size)
+
+                if shm.is_offer(type_id, body):
+                    # offers are answered here, as handling them as a
+                    # TVersion would reset the session
+                    with lock:
+                        if unix and connection[0] is sock:
+                            transport = shm.accept(sock, type_id, body, fds)
+                            if transport is not None:
+                                connection[0] = transport
+                        else:
+                            close_fds(fds)
+                            connection[0].sendall(shm.refusal())
+                    continue
+
+                close_fds(fds)
+                session.receive(type_id, tag, body)
+        except (EOFError, OSError):
+            return
+        finally:
+            session.close()
+            connection[0].close()
+            with self._lock:
+                self._connections.pop(current_thread(), None)
+
+    def serve_forever(self, listener):
+        """ Accept and serve connections from a listening socket until
+        ``shutdown`` is called
+        """
+        self._listener = listener
+        while True:
+            try:
+                sock, address = listener.accept()
+            except OSError:
+                if self._listener is None:
+                    return
+                raise
+            self.serve_connection(sock)
+
+    def shutdown(self):
+        """ Stop accepting connections, close those that are open and wait for
+        their threads to exit
+        """
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+
+        with self._lock:
+            self._closing = True
+            connections = list(self._connections.items())
+        for thread, sock in connections:
+            # shutting down rather than closing wakes the thread if it is
+            # blocked in a read.  Shared memory transports watch the socket
+            # they were set up on, so they are woken as well
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for thread, _ in connections:
+            if thread is not current_thread():
+                thread.join()
+
+        # requests already running are left to finish in the background, as
+        # backend handlers are allowed to block indefinitely
+        self._executor.shutdown(wait=False)
+
+
+class AsyncServer(object):
+    """ Serves connections from an asyncio event loop.  Backend methods are
+    synchronous, so requests are run on a thread pool while the loop handles
+    all of the socket IO.
+    """
+
+    def __init__(self, backend, executor=None,
+                 max_message_size=DEFAULT_MESSAGE_SIZE,
+                 versions=DIALECT_VERSIONS):
+        self.backend = backend
+        self.max_message_size = max_message_size
+        self.versions = versions
+        if executor is None:
+            executor = ThreadPoolExecutor()
+        self._executor = executor
+
+    async def serve_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+
+        def send(data):
+            loop.call_soon_threadsafe(writer.write, data)
+
+        session = Session(self.backend, send, self._executor.submit,
+                          self.max_message_size, self.versions)
+        try:
+            while True:
+                length, type_id, tag = _header.unpack(
+                    await reader.readexactly(_header.size))
+                if not _header.size <= length <= session.max_message_size:
+                    log.warning("invalid frame length: %i", length)
+                    return
+                body = await reader.readexactly(length - _header.size)
+                if shm.is_offer(type_id, body):
+                    # streams drop the descriptors a shared memory transport
+                    # needs, and handling the offer as a TVersion would reset
+                    # the session
+                    send(shm.refusal())
+                    continue
+                session.receive(type_id, tag, body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        finally:
+            session.close()
+            writer.close()
+
+    async def start_server(self, *args, **kwargs):
+        """ Wrapper around ``asyncio.start_server``
+        """
+        return await asyncio.start_server(self.serve_connection,
+                                          *args, **kwargs)
+
+    async def start_unix_server(self, *args, **kwargs):
+        """ Wrapper around ``asyncio.start_unix_server``
+        """
+        return await asyncio.start_unix_server(self.serve_connection,
+                                               *args, **kwargs)
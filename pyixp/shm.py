@@ -0,0 +1,346 @@
+import logging
+import mmap
+import os
+import select
+import socket
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from pyixp import messages
+from pyixp.marshall import recvall_fds, close_fds
+from pyixp.messages import header as _header
+
+__all__ = ('ShmTransport', 'connect', 'is_offer', 'accept', 'refusal',
+           'SHM_VERSION')
+
+log = logging.getLogger(__name__)
+
+# version string of the TVersion message used to offer a shared memory
+# transport.  Servers that do not recognise it reply with a different version
+# and the client carries on using the socket
+SHM_VERSION = "9P2000.shm"
+
+DEFAULT_RING_SIZE = 0x00100000
+
+# seals the shared segment must carry so that neither side can resize it and
+# fault the other with SIGBUS
+_SEALS = getattr(fcntl, 'F_SEAL_SHRINK', 0) | getattr(fcntl, 'F_SEAL_GROW', 0)
+
+# layout of the header at the start of each ring, in 8 byte words.  The
+# consumer and producer indices are kept on separate cache lines
+_HEAD = 0
+_TAIL = 8
+_CLOSED = 16
+_HEADER_SIZE = 192
+
+
+def _available():
+    return hasattr(os, 'memfd_create') and hasattr(os, 'eventfd') and \
+        hasattr(os, 'MFD_ALLOW_SEALING') and \
+        hasattr(fcntl, 'F_ADD_SEALS') and hasattr(socket, 'send_fds')
+
+
+def _sealed(fd, size):
+    """ :returns: true if the segment ``fd`` is ``size`` bytes long and can't
+        be resized
+    """
+    try:
+        seals = fcntl.fcntl(fd, fcntl.F_GET_SEALS)
+        return seals & _SEALS == _SEALS and os.fstat(fd).st_size == size
+    except OSError:
+        return False
+
+
+class Ring(object):
+    """ Single producer, single consumer byte queue in shared memory.
+
+    Indices are free running 64 bit counters, published with aligned 8 byte
+    stores.  Each side spins for ``spin`` iterations before it sleeps on an
+    eventfd, ``data_fd`` for the consumer and ``space_fd`` for the producer.
+    Every update of an index is followed by a write to the other side's
+    eventfd.  Skipping the write when the other side isn't waiting would need
+    a store to load memory barrier, which Python doesn't provide, and without
+    one a wakeup can be lost.
+
+    If ``hangup_fd`` is given, the ring is treated as closed once that file
+    descriptor reports a hangup, so that a peer which exits without closing
+    the ring doesn't leave the other side waiting forever.
+    """
+
+    def __init__(self, buffer, data_fd, space_fd, spin=1000, hangup_fd=None):
+        self._buffer = buffer
+        self._words = buffer[:_HEADER_SIZE].cast('Q')
+        self._data = buffer[_HEADER_SIZE:]
+        self._capacity = len(self._data)
+        self._data_fd = data_fd
+        self._space_fd = space_fd
+        self._hangup_fd = hangup_fd
+        self.spin = spin
+
+    @property
+    def closed(self):
+        return bool(self._words[_CLOSED])
+
+    def close(self):
+        self._words[_CLOSED] = 1
+        for fd in (self._data_fd, self._space_fd):
+            try:
+                os.eventfd_write(fd, 1)
+            except OSError:
+                pass
+
+    def release(self):
+        self._words.release()
+        self._data.release()
+        self._buffer.release()
+
+    def _used(self):
+        """ :returns: the number of bytes in the ring.  A peer that publishes
+            indices further apart than the ring allows is treated as having
+            closed it.
+        """
+        used = self._words[_TAIL] - self._words[_HEAD]
+        if not 0 <= used <= self._capacity and not self._words[_CLOSED]:
+            log.warning("invalid shared memory ring indices")
+            self._words[_CLOSED] = 1
+        return used
+
+    def _wait(self, fd, ready):
+        for _ in range(self.spin):
+            if ready():
+                return
+        poll = select.poll()
+        poll.register(fd, select.POLLIN)
+        if self._hangup_fd is not None:
+            # hangups and errors are reported even with an empty mask
+            poll.register(self._hangup_fd, 0)
+        # the eventfd may still count wakeups that arrived while spinning, in
+        # which case the ring is simply checked again
+        while not ready():
+            for ready_fd, event in poll.poll():
+                if ready_fd == fd:
+                    os.eventfd_read(fd)
+                else:
+                    # the peer has gone without closing the ring
+                    self._words[_CLOSED] = 1
+
+    def write(self, data):
+        """ Copy all of ``data`` into the ring, blocking while it is full
+        """
+        data = memoryview(data).cast('B')
+        words = self._words
+        while len(data):
+            self._wait(
+                self._space_fd,
+                lambda: self._used() < self._capacity or words[_CLOSED])
+            used = self._used()
+            if words[_CLOSED]:
+                raise BrokenPipeError("ring closed")
+
+            tail = words[_TAIL]
+            free = self._capacity - used
+            start = tail % self._capacity
+            count = min(free, len(data), self._capacity - start)
+            self._data[start:start + count] = data[:count]
+            words[_TAIL] = tail + count
+            data = data[count:]
+            os.eventfd_write(self._data_fd, 1)
+
+    def read_into(self, buffer):
+        """ Copy at least one byte from the ring into ``buffer``, blocking
+        while it is empty.
+
+        :returns: the number of bytes copied, or zero if the ring has been
+            closed.
+        """
+        buffer = memoryview(buffer).cast('B')
+        words = self._words
+        self._wait(self._data_fd,
+                   lambda: self._used() != 0 or words[_CLOSED])
+
+        head = words[_HEAD]
+        available = self._used()
+        if not 0 < available <= self._capacity:
+            return 0
+        start = head % self._capacity
+        count = min(available, len(buffer), self._capacity - start)
+        buffer[:count] = self._data[start:start + count]
+        words[_HEAD] = head + count
+        os.eventfd_write(self._space_fd, 1)
+        return count
+
+
+class ShmTransport(object):
+    """ Pair of rings that can be used in place of a socket by the
+    ``Marshall`` and the server.
+
+    The unix socket used to set up the transport is kept open for as long as
+    the transport is in use, and is watched so that the transport closes if
+    the peer goes away.
+    """
+
+    def __init__(self, sock, memfd, eventfds, ring_size, server, spin=1000):
+        self._socket = sock
+        self._fds = [memfd] + list(eventfds)
+        self._mmap = mmap.mmap(memfd, 2 * ring_size)
+        self._view = memoryview(self._mmap)
+
+        to_server = Ring(self._view[:ring_size],
+                         eventfds[0], eventfds[1], spin, sock.fileno())
+        to_client = Ring(self._view[ring_size:],
+                         eventfds[2], eventfds[3], spin, sock.fileno())
+        if server:
+            self._send_ring, self._recv_ring = to_client, to_server
+        else:
+            self._send_ring, self._recv_ring = to_server, to_client
+        self._closed = False
+
+    def sendall(self, data):
+        if self._closed:
+            raise OSError("transport closed")
+        self._send_ring.write(data)
+
+    def recv_into(self, buffer, nbytes=0):
+        if self._closed:
+            return 0
+        if nbytes:
+            buffer = memoryview(buffer)[:nbytes]
+        return self._recv_ring.read_into(buffer)
+
+    def shutdown(self, how=socket.SHUT_RDWR):
+        self._send_ring.close()
+        self._recv_ring.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.shutdown()
+        self._socket.close()
+        # the mapping can only be released once nothing is blocked reading
+        # from it, so it is left to the garbage collector if still in use
+        try:
+            self._send_ring.release()
+            self._recv_ring.release()
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            log.debug("shared memory still in use")
+            return
+        close_fds(self._fds)
+
+
+def connect(sock, ring_size=DEFAULT_RING_SIZE, spin=1000):
+    """ Offer a shared memory transport to the server at the other end of the
+    unix socket ``sock``.
+
+    :returns: a ``ShmTransport`` if the server accepted it, otherwise ``sock``
+        so that the caller can carry on using the socket.
+    """
+    if not _available() or sock.family != socket.AF_UNIX:
+        return sock
+
+    fds = []
+    try:
+        memfd = os.memfd_create(
+            "pyixp-shm", getattr(os, 'MFD_CLOEXEC', 0) | os.MFD_ALLOW_SEALING)
+        fds.append(memfd)
+        os.ftruncate(memfd, 2 * ring_size)
+        fcntl.fcntl(memfd, fcntl.F_ADD_SEALS, _SEALS)
+        for _ in range(4):
+            fds.append(os.eventfd(0, getattr(os, 'EFD_CLOEXEC', 0)))
+
+        # the msize field of the offer carries the size of the shared segment
+        body = messages.TVersion(2 * ring_size, SHM_VERSION).pack()
+        frame = _header.pack(len(body) + _header.size,
+                             messages.TVersion.type_id, messages.NOTAG) + body
+        socket.send_fds(sock, [frame], fds)
+
+        received = []
+        length, type_id, tag = _header.unpack(
+            recvall_fds(sock, _header.size, received))
+        response = recvall_fds(sock, length - _header.size, received)
+        close_fds(received)
+    except OSError:
+        log.info("shared memory transport unavailable", exc_info=True)
+        close_fds(fds)
+        return sock
+
+    if type_id != messages.RVersion.type_id or \
+            messages.RVersion.unpack(response).version != SHM_VERSION:
+        log.info("server refused shared memory transport")
+        close_fds(fds)
+        return sock
+
+    return ShmTransport(sock, fds[0], fds[1:], ring_size, False, spin)
+
+
+def _offer(type_id, body):
+    """ :returns: the TVersion message of a frame offering a shared memory
+        transport, or None for any other frame
+    """
+    if type_id != messages.TVersion.type_id:
+        return None
+    try:
+        request = messages.TVersion.unpack(body)
+    except Exception:
+        return None
+    if request.version != SHM_VERSION:
+        return None
+    return request
+
+
+def is_offer(type_id, body):
+    """ :returns: true if a frame offers a shared memory transport.  Offers
+        must be answered by ``accept`` or with ``refusal`` rather than handled
+        as a TVersion, which would reset the session.
+    """
+    return _offer(type_id, body) is not None
+
+
+def _reply(msize, version):
+    response = messages.RVersion(msize, version).pack()
+    return _header.pack(len(response) + _header.size,
+                        messages.RVersion.type_id, messages.NOTAG) + response
+
+
+def refusal():
+    """ :returns: the frame answering an offer of a shared memory transport
+        that is refused, after which the client carries on using the socket
+    """
+    return _reply(0, "unknown")
+
+
+def accept(sock, type_id, body, fds, spin=1000):
+    """ Server side of ``connect``.  Answers the offer of a shared memory
+    transport received on ``sock``, accepting it if it is valid.
+
+    :returns: a ``ShmTransport``, or None if the offer was refused.
+        Ownership of ``fds`` passes to this function.
+    """
+    request = _offer(type_id, body)
+    if request is None or len(fds) != 5 or request.msize % 2 \
+            or request.msize // 2 <= _HEADER_SIZE:
+        close_fds(fds)
+        sock.sendall(refusal())
+        return None
+    if not _available() or not _sealed(fds[0], request.msize):
+        log.warning("refused shared memory segment that can be resized")
+        close_fds(fds)
+        sock.sendall(refusal())
+        return None
+
+    try:
+        transport = ShmTransport(sock, fds[0], fds[1:], request.msize // 2,
+                                 True, spin)
+    except (OSError, ValueError):
+        log.info("failed to map shared memory", exc_info=True)
+        close_fds(fds)
+        sock.sendall(refusal())
+        return None
+
+    sock.sendall(_reply(request.msize, SHM_VERSION))
+    return transport
@@ -0,0 +1,51 @@
+import io
+import re
+import unittest
+
+from pyixp import bench
+
+
+class BenchTest(unittest.TestCase):
+    def run_bench(self, *args):
+        out = io.StringIO()
+        bench.main([
+            "--fake", "--ops", "5", "--files", "10", "--bulk-size", "100000",
+        ] + list(args), out=out)
+        return out.getvalue()
+
+    def test_workloads(self):
+        for workload in sorted(bench.WORKLOADS):
+            output = self.run_bench("--workload", workload)
+            self.assertIn("ops/s", output)
+
+    def test_sweep(self):
+        output = self.run_bench("--workload", "stat=1,bulk-read=1",
+                                "--concurrency", "1,2", "--depth", "1,4")
+        self.assertEqual(output.count("concurrency="), 4)
+        self.assertIn("TWalk", output)
+        self.assertIn("bulk-read", output)
+
+    def test_msize(self):
+        output = self.run_bench("--workload", "bulk",
+                                "--msize", "8192,262144")
+        self.assertIn("negotiated msize=8192", output)
+        self.assertIn("negotiated msize=262144", output)
+
+    def test_throughput(self):
+        # downloads read straight into the mapped file, which must still be
+        # counted
+        output = self.run_bench("--workload", "bulk-read",
+                                "--msize", "8192,1048576")
+        rates = re.findall(r"([\d.]+) ops/s, ([\d.]+) MB/s", output)
+        self.assertEqual(len(rates), 2)
+        for ops_rate, mb_rate in rates:
+            per_op = float(mb_rate) * 1e6 / float(ops_rate)
+            self.assertGreater(per_op, 0.9 * 100000)
+            self.assertLess(per_op, 1.2 * 100000)
+
+    def test_percentile(self):
+        values = list(range(1, 1001))
+        self.assertEqual(bench.percentile(values, 0.5), 500)
+        self.assertEqual(bench.percentile(values, 0.99), 990)
+        self.assertEqual(bench.percentile(values, 0.999), 999)
+        self.assertEqual(bench.percentile([], 0.5), 0.0)
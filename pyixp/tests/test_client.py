@@ -0,0 +1,692 @@
+import array
+import io
+import mmap
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from pyixp import messages, requests
+from pyixp.cache import PageCache
+from pyixp.client import Client
+from pyixp.marshall import recvall
+from pyixp.messages import header as _header
+from pyixp.requests import ServerError
+
+
+class Node(object):
+    _next_path = 0
+
+    def __init__(self, name, data=None, children=None):
+        Node._next_path += 1
+        self.qid_path = Node._next_path
+        self.version = 1
+        self.name = name
+        self.data = data
+        self.children = children
+
+    @property
+    def qid(self):
+        qtype = messages.QTDIR if self.children is not None else 0
+        return {"type": qtype, "version": self.version, "path": self.qid_path}
+
+    def stat(self):
+        mode = 0o755 | messages.DMDIR if self.children is not None else 0o644
+        value = {
+            "size": 0, "type": 0, "dev": 0, "qid": self.qid, "mode": mode,
+            "atime": 0, "mtime": 0, "length": len(self.data or b''),
+            "name": self.name, "uid": "test", "gid": "test", "muid": "test",
+        }
+        value["size"] = len(messages.stat.pack(value)) - 2
+        return value
+
+
+class FakeServer(object):
+    """ Minimal single connection server for an in-memory tree of nodes
+    """
+    def __init__(self, sock, root):
+        self._socket = sock
+        self._root = root
+        self._fids = {}
+        self.received = []
+        self.handlers = {
+            messages.TVersion.type_id: self._version,
+            messages.TAttach.type_id: self._attach,
+            messages.TWalk.type_id: self._walk,
+            messages.TOpen.type_id: self._open,
+            messages.TRead.type_id: self._read,
+            messages.TCreate.type_id: self._create,
+            messages.TWrite.type_id: self._write,
+            messages.TClunk.type_id: self._clunk,
+            messages.TRemove.type_id: self._remove,
+            messages.TStat.type_id: self._stat,
+            messages.TOpenFD.type_id: self._openfd,
+        }
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        try:
+            while True:
+                length, type_, tag = _header.unpack(
+                    recvall(self._socket, _header.size))
+                body = recvall(self._socket, length - _header.size)
+                self.received.append(type_)
+                fds = []
+                try:
+                    response = self.handlers[type_](body)
+                    if isinstance(response, tuple) and \
+                            not isinstance(response, messages.Message):
+                        response, fds = response
+                except Exception as e:
+                    response = messages.RError(str(e))
+                data = response.pack()
+                frame = _header.pack(
+                    len(data) + _header.size, response.type_id, tag) + data
+                if fds:
+                    socket.send_fds(self._socket, [frame], fds)
+                    for fd in fds:
+                        os.close(fd)
+                else:
+                    self._socket.sendall(frame)
+        except (EOFError, OSError):
+            return
+
+    def _version(self, body):
+        request = messages.TVersion.unpack(body)
+        return messages.RVersion(request.msize, request.version)
+
+    def _attach(self, body):
+        request = messages.TAttach.unpack(body)
+        self._fids[request.fid] = self._root
+        return messages.RAttach(self._root.qid)
+
+    def _walk(self, body):
+        request = messages.TWalk.unpack(body)
+        node = self._fids[request.fid]
+        qids = []
+        for name in request.path:
+            if node.children is None or name not in node.children:
+                break
+            node = node.children[name]
+            qids.append(node.qid)
+        if not qids and request.path:
+            raise Exception("file does not exist")
+        if len(qids) == len(request.path):
+            self._fids[request.newfid] = node
+        return messages.RWalk(qids)
+
+    def _open(self, body):
+        request = messages.TOpen.unpack(body)
+        node = self._fids[request.fid]
+        if request.mode & messages.OTRUNC:
+            node.data = b''
+            node.version += 1
+        return messages.ROpen(node.qid, 0)
+
+    def _create(self, body):
+        request = messages.TCreate.unpack(body)
+        node = Node(request.name, data=b'')
+        self._fids[request.fid].children[request.name] = node
+        self._fids[request.fid] = node
+        return messages.RCreate(node.qid, 0)
+
+    def _read(self, body):
+        request = messages.TRead.unpack(body)
+        node = self._fids[request.fid]
+        if node.children is not None:
+            # deliberately ignores record boundaries so that the client has
+            # to reassemble entries split between reads
+            data = b''.join(messages.stat.pack(child.stat())
+                            for child in node.children.values())
+        else:
+            data = node.data
+        return messages.RRead(
+            data[request.offset:request.offset + request.count])
+
+    def _write(self, body):
+        request = messages.TWrite.unpack(body)
+        node = self._fids[request.fid]
+        data = node.data.ljust(request.offset, b'\0')
+        node.data = data[:request.offset] + request.data + \
+            data[request.offset + len(request.data):]
+        node.version += 1
+        return messages.RWrite(len(request.data))
+
+    def _clunk(self, body):
+        request = messages.TClunk.unpack(body)
+        del self._fids[request.fid]
+        return messages.RClunk()
+
+    def _remove(self, body):
+        request = messages.TRemove.unpack(body)
+        node = self._fids.pop(request.fid)
+        parents = [self._root]
+        while parents:
+            parent = parents.pop()
+            if parent.children.get(node.name) is node:
+                del parent.children[node.name]
+                return messages.RRemove()
+            parents.extend(child for child in parent.children.values()
+                           if child.children is not None)
+        raise Exception("permission denied")
+
+    def _stat(self, body):
+        request = messages.TStat.unpack(body)
+        return messages.RStat(self._fids[request.fid].stat())
+
+    def _openfd(self, body):
+        request = messages.TOpenFD.unpack(body)
+        node = self._fids[request.fid]
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, node.data)
+        os.close(write_fd)
+        return messages.ROpenFD(node.qid, 0, read_fd), [read_fd]
+
+
+def make_tree(spec, name=''):
+    if isinstance(spec, dict):
+        return Node(name, children={
+            key: make_tree(value, key) for key, value in spec.items()
+        })
+    return Node(name, data=spec)
+
+
+class ClientTestCase(unittest.TestCase):
+    tree = {}
+    max_message_size = 0xffff
+
+    def make_page_cache(self):
+        return None
+
+    def setUp(self):
+        client_socket, server_socket = socket.socketpair()
+        self.server = FakeServer(server_socket, make_tree(self.tree))
+        self.page_cache = self.make_page_cache()
+        self.client = Client(client_socket, self.max_message_size,
+                             uname="test", page_cache=self.page_cache)
+
+    def tearDown(self):
+        self.client.close()
+
+
+class NegotiationTest(unittest.TestCase):
+    def connect(self, msize, iounit=0):
+        """ :returns: client connected to a server that answers with
+            ``msize`` and limits reads and writes to ``iounit``
+        """
+        client_socket, server_socket = socket.socketpair()
+        self.server = FakeServer(server_socket, make_tree({
+            "file": bytes(range(256)) * 40,
+        }))
+        open_, read = self.server._open, self.server._read
+        write = self.server._write
+
+        def limited_open(body):
+            return open_(body)._replace(iounit=iounit)
+
+        def limited_read(body):
+            request = messages.TRead.unpack(body)
+            return read(request._replace(
+                count=min(request.count, iounit or request.count)).pack())
+
+        def limited_write(body):
+            request = messages.TWrite.unpack(body)
+            return write(request._replace(
+                data=request.data[:iounit or len(request.data)]).pack())
+
+        self.server.handlers.update({
+            messages.TVersion.type_id:
+                lambda body: messages.RVersion(msize, "9P2000"),
+            messages.TOpen.type_id: limited_open,
+            messages.TRead.type_id: limited_read,
+            messages.TWrite.type_id: limited_write,
+        })
+        client = Client(client_socket, 0x10000, uname="test")
+        self.addCleanup(client.close)
+        return client
+
+    def test_smaller(self):
+        client = self.connect(4096)
+        self.assertEqual(client.max_message_size, 4096)
+        self.assertEqual(client._marshall.max_message_size, 4096)
+        self.assertEqual(client.read_file("file"), bytes(range(256)) * 40)
+        # three reads of data then one at the end of the file
+        self.assertEqual(
+            self.server.received.count(messages.TRead.type_id), 4)
+
+    def test_larger(self):
+        with self.assertRaises(Exception):
+            self.connect(0x20000)
+
+    def test_too_small(self):
+        with self.assertRaises(Exception):
+            self.connect(messages.IOHDRSZ)
+
+    def test_iounit(self):
+        client = self.connect(0x10000, iounit=1000)
+        self.assertEqual(client.read_file("file"), bytes(range(256)) * 40)
+        with client.open_file("file") as f:
+            self.assertEqual(len(f.read()), 10240)
+
+    def test_write_iounit(self):
+        client = self.connect(0x10000, iounit=1000)
+        data = os.urandom(5000)
+        self.assertEqual(client.write_file("file", data), 5000)
+        self.assertEqual(client.read_file("file"), data)
+
+
+class ListdirTest(ClientTestCase):
+    # small enough that stat records will be split between reads
+    max_message_size = 100
+
+    tree = {
+        "dir": {"file%03i" % i: b"data" for i in range(50)},
+        "empty": {},
+        "file": b"contents",
+    }
+
+    def test_listdir(self):
+        names = [entry["name"] for entry in self.client.listdir("dir")]
+        self.assertEqual(names, ["file%03i" % i for i in range(50)])
+
+    def test_listdir_root(self):
+        names = {entry["name"] for entry in self.client.listdir()}
+        self.assertEqual(names, {"dir", "empty", "file"})
+
+    def test_listdir_empty(self):
+        self.assertEqual(list(self.client.listdir("empty")), [])
+
+    def test_listdir_missing(self):
+        with self.assertRaises(ServerError):
+            list(self.client.listdir("missing"))
+
+    def test_fids_recycled(self):
+        list(self.client.listdir("dir"))
+        list(self.client.listdir("dir"))
+        self.assertEqual(len(self.server._fids), 1)
+
+
+class IterStatsTest(unittest.TestCase):
+    def test_split_records(self):
+        stats = [make_tree(b"", "name%i" % i).stat() for i in range(10)]
+        data = b''.join(messages.stat.pack(value) for value in stats)
+        for chunk_size in (1, 7, 50, len(data)):
+            chunks = (data[i:i + chunk_size]
+                      for i in range(0, len(data), chunk_size))
+            self.assertEqual(list(messages.iter_stats(chunks)), stats)
+
+    def test_truncated(self):
+        data = messages.stat.pack(make_tree(b"", "name").stat())
+        with self.assertRaises(Exception):
+            list(messages.iter_stats([data[:-1]]))
+
+
+class WalkTreeTest(ClientTestCase):
+    tree = {
+        "a": {
+            "a1": {"file": b""},
+            "a2": {},
+            "file": b"",
+        },
+        "b": {
+            "b1": {"b11": {}},
+        },
+        "file": b"",
+    }
+
+    def test_walk_tree(self):
+        result = {
+            dirpath: (sorted(dirnames), sorted(filenames))
+            for dirpath, dirnames, filenames in self.client.walk_tree()
+        }
+        self.assertEqual(result, {
+            "": (["a", "b"], ["file"]),
+            "a": (["a1", "a2"], ["file"]),
+            "a/a1": ([], ["file"]),
+            "a/a2": ([], []),
+            "b": (["b1"], []),
+            "b/b1": (["b11"], []),
+            "b/b1/b11": ([], []),
+        })
+
+    def test_subtree(self):
+        dirpaths = {dirpath for dirpath, _, _ in self.client.walk_tree("b")}
+        self.assertEqual(dirpaths, {"b", "b/b1", "b/b1/b11"})
+
+    def test_maxdepth(self):
+        dirpaths = {dirpath for dirpath, _, _
+                    in self.client.walk_tree(maxdepth=1)}
+        self.assertEqual(dirpaths, {"", "a", "b"})
+
+    def test_filter(self):
+        dirpaths = {
+            dirpath for dirpath, _, _ in self.client.walk_tree(
+                filter_dirs=lambda dirpath, stat: stat["name"] != "b")
+        }
+        self.assertEqual(dirpaths, {"", "a", "a/a1", "a/a2"})
+
+    def test_prune(self):
+        dirpaths = set()
+        for dirpath, dirnames, filenames in self.client.walk_tree():
+            dirpaths.add(dirpath)
+            if "a" in dirnames:
+                dirnames.remove("a")
+        self.assertEqual(dirpaths, {"", "b", "b/b1", "b/b1/b11"})
+
+    def test_order(self):
+        def order(**kwargs):
+            return [dirpath for dirpath, dirnames, filenames
+                    in self.client.walk_tree(concurrency=1, **kwargs)
+                    if not dirnames.sort()]
+
+        self.assertEqual(order(breadth_first=True), [
+            "", "a", "b", "a/a1", "a/a2", "b/b1", "b/b1/b11"
+        ])
+        self.assertEqual(order(breadth_first=False), [
+            "", "a", "a/a1", "a/a2", "b", "b/b1", "b/b1/b11"
+        ])
+
+    def test_missing(self):
+        errors = []
+        self.assertEqual(
+            list(self.client.walk_tree("missing", onerror=errors.append)), [])
+        self.assertEqual(len(errors), 1)
+
+    def test_fids_recycled(self):
+        list(self.client.walk_tree())
+        # fids are clunked asynchronously.  A synchronous request makes sure
+        # that the server has processed everything that came before it
+        self.client.stat(self.client._root)
+        self.assertEqual(len(self.server._fids), 1)
+
+
+class FileTest(ClientTestCase):
+    tree = {
+        "file": b"Hello World",
+    }
+
+    def test_read(self):
+        with self.client.open_file("file") as f:
+            self.assertEqual(f.read(), b"Hello World")
+            f.seek(6)
+            self.assertEqual(f.read(3), b"Wor")
+            self.assertEqual(f.seek(0, io.SEEK_END), 11)
+
+    def test_write(self):
+        with self.client.open_file("file", messages.ORDWR) as f:
+            f.seek(6)
+            self.assertEqual(f.write(b"There"), 5)
+            f.seek(0)
+            self.assertEqual(f.read(), b"Hello There")
+
+
+class ReadIntoTest(ClientTestCase):
+    tree = {
+        "file": b"Hello World",
+    }
+
+    def setUp(self):
+        super(ReadIntoTest, self).setUp()
+        self.fid = self.client._walk("file")
+        self.client.open(self.fid, messages.OREAD)
+
+    def read_into(self, buffer, offset=0, count=11):
+        return requests.ReadRequest(self.fid, offset, count).submit_into(
+            self.client._marshall, buffer)
+
+    def test_bytearray(self):
+        buffer = bytearray(16)
+        self.assertEqual(self.read_into(buffer, 6, 16), 5)
+        self.assertEqual(buffer[:5], b"World")
+
+    def test_mmap(self):
+        with mmap.mmap(-1, 11) as buffer:
+            self.assertEqual(self.read_into(buffer), 11)
+            self.assertEqual(buffer[:], b"Hello World")
+
+    def test_typed_array(self):
+        buffer = array.array('I', bytes(12))
+        self.assertEqual(self.read_into(buffer), 11)
+        self.assertEqual(buffer.tobytes()[:11], b"Hello World")
+
+    def test_buffer_too_small(self):
+        with self.assertRaises(Exception):
+            self.read_into(bytearray(4))
+        # the connection is still usable
+        self.assertEqual(self.read_into(bytearray(11)), 11)
+
+    def test_error(self):
+        with self.assertRaises(ServerError):
+            requests.ReadRequest(12345, 0, 11).submit_into(
+                self.client._marshall, bytearray(11))
+
+
+class PageCacheTest(ClientTestCase):
+    max_message_size = 100
+
+    tree = {
+        "file": bytes(range(256)) * 2,
+        "big": bytes(range(256)) * 4,
+        "synthetic": b"event",
+    }
+
+    def make_page_cache(self):
+        return PageCache(max_bytes=512, page_size=128)
+
+    def read_count(self):
+        return self.server.received.count(messages.TRead.type_id)
+
+    def test_cached(self):
+        with self.client.open_file("file") as f:
+            self.assertEqual(f.read(), bytes(range(256)) * 2)
+        reads = self.read_count()
+
+        with self.client.open_file("file") as f:
+            f.seek(200)
+            self.assertEqual(f.read(100), bytes(range(200, 256)))
+        self.assertEqual(self.read_count(), reads)
+        self.assertGreater(self.page_cache.hits, 0)
+
+    def test_evictions(self):
+        with self.client.open_file("big") as f:
+            f.read()
+        self.assertGreater(self.page_cache.evictions, 0)
+        self.assertLessEqual(self.page_cache.size, 512)
+
+    def test_version_zero_not_cached(self):
+        self.server._root.children["synthetic"].version = 0
+        for i in range(2):
+            with self.client.open_file("synthetic") as f:
+                self.assertEqual(f.read(), b"event")
+        self.assertEqual(self.page_cache.stats()["pages"], 0)
+
+    def test_write_invalidates(self):
+        with self.client.open_file("file", messages.ORDWR) as f:
+            self.assertEqual(f.read(4), b"\x00\x01\x02\x03")
+            f.seek(0)
+            f.write(b"abcd")
+            f.seek(0)
+            self.assertEqual(f.read(4), b"abcd")
+
+    def test_version_change(self):
+        with self.client.open_file("file") as f:
+            f.read()
+        self.server._root.children["file"].data = b"new"
+        self.server._root.children["file"].version += 1
+        with self.client.open_file("file") as f:
+            self.assertEqual(f.read(), b"new")
+
+
+class OpenFDTest(ClientTestCase):
+    tree = {
+        "file": b"Hello World",
+    }
+
+    def test_fdopen(self):
+        with self.client.fdopen("file") as f:
+            self.assertEqual(f.read(), b"Hello World")
+            # the fid is kept open for as long as the file is in use
+            self.assertEqual(len(self.server._fids), 2)
+        self.assertEqual(len(self.server._fids), 1)
+
+    def test_fdopen_unbuffered(self):
+        with self.client.fdopen("file", buffering=0) as f:
+            self.assertEqual(f.read(5), b"Hello")
+
+    def test_fdopen_invalid_buffering(self):
+        # the descriptor is closed and the fid clunked
+        with self.assertRaises(TypeError):
+            self.client.fdopen("file", buffering="large")
+        self.assertEqual(len(self.server._fids), 1)
+
+    def test_openfd_receives_descriptor(self):
+        fid = self.client._walk("file")
+        resp = self.client.openfd(fid, messages.OREAD)
+        try:
+            self.assertEqual(os.read(resp.unixfd, 5), b"Hello")
+        finally:
+            os.close(resp.unixfd)
+            self.client._clunk(fid)
+
+
+class TransferTest(ClientTestCase):
+    max_message_size = 1024
+
+    tree = {
+        "file": os.urandom(100000),
+        "empty": b"",
+        "dir": {},
+    }
+
+    def setUp(self):
+        super(TransferTest, self).setUp()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.local_path = os.path.join(self.tempdir.name, "file")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super(TransferTest, self).tearDown()
+
+    def check_download(self, **kwargs):
+        progress = []
+        count = self.client.download(
+            "file", self.local_path,
+            progress=lambda *args: progress.append(args), **kwargs)
+        self.assertEqual(count, 100000)
+        with open(self.local_path, 'rb') as f:
+            self.assertEqual(f.read(), self.tree["file"])
+        self.assertEqual(progress[-1][:2], (100000, 100000))
+
+    def test_download_mmap(self):
+        self.check_download(use_mmap=True)
+
+    def test_download_pwrite(self):
+        self.check_download(use_mmap=False, depth=3)
+
+    def test_download_empty(self):
+        self.assertEqual(self.client.download("empty", self.local_path), 0)
+        self.assertEqual(os.path.getsize(self.local_path), 0)
+
+    def test_upload(self):
+        data = os.urandom(50000)
+        with open(self.local_path, 'wb') as f:
+            f.write(data)
+        self.assertEqual(self.client.upload(self.local_path, "file"), 50000)
+        self.assertEqual(self.server._root.children["file"].data, data)
+
+        self.assertEqual(
+            self.client.upload(self.local_path, "dir/new"), 50000)
+        self.assertEqual(
+            self.server._root.children["dir"].children["new"].data, data)
+
+
+class CompoundTest(ClientTestCase):
+    max_message_size = 1024
+
+    tree = {
+        "small": b"Hello World",
+        "large": os.urandom(5000),
+        "dir": {"file": b""},
+    }
+
+    deep_tree = {}
+    tree["deep"] = deep_tree
+    for i in range(20):
+        deep_tree["d"] = deep_tree = {}
+    deep_tree["file"] = b"deep"
+
+    def test_read_file(self):
+        self.assertEqual(self.client.read_file("small"), b"Hello World")
+        self.assertEqual(self.server.received[-4:], [
+            messages.TWalk.type_id, messages.TOpen.type_id,
+            messages.TRead.type_id, messages.TClunk.type_id,
+        ])
+
+    def test_read_large_file(self):
+        self.assertEqual(self.client.read_file("large"), self.tree["large"])
+
+    def test_read_deep_file(self):
+        path = "deep/" + "d/" * 20 + "file"
+        self.assertEqual(self.client.read_file(path), b"deep")
+
+    def test_missing(self):
+        with self.assertRaises(ServerError) as cm:
+            self.client.read_file("missing")
+        self.assertEqual(cm.exception.ename, "file does not exist")
+
+    def test_open_fails(self):
+        def fail(body):
+            raise Exception("permission denied")
+
+        self.server.handlers[messages.TOpen.type_id] = fail
+        with self.assertRaises(ServerError) as cm:
+            self.client.read_file("small")
+        self.assertEqual(cm.exception.ename, "permission denied")
+
+    def test_write_file(self):
+        data = os.urandom(3000)
+        self.assertEqual(self.client.write_file("small", data), 3000)
+        self.assertEqual(self.server._root.children["small"].data, data)
+
+    def test_stat_path(self):
+        stat = self.client.stat_path("small")
+        self.assertEqual(stat["name"], "small")
+        self.assertEqual(stat["length"], 11)
+
+    def test_remove_path(self):
+        self.client.remove_path("dir/file")
+        self.assertEqual(self.server._root.children["dir"].children, {})
+
+    def test_fids_recycled(self):
+        self.client.read_file("small")
+        with self.assertRaises(ServerError):
+            self.client.read_file("missing")
+        self.assertEqual(len(self.server._fids), 1)
+        self.assertEqual(len(self.client._fids._free), 1)
+
+    def test_submit_fails(self):
+        # the connection goes away part of the way through sending the chain
+        request_async = self.client._marshall.request_async
+        sent = []
+
+        def failing(*args, **kwargs):
+            if len(sent) == 2 and args[0] != messages.TClunk.type_id:
+                raise Exception("marshall closed")
+            sent.append(args[0])
+            return request_async(*args, **kwargs)
+        self.client._marshall.request_async = failing
+
+        with self.assertRaises(Exception) as cm:
+            self.client.read_file("small")
+        self.assertEqual(str(cm.exception), "marshall closed")
+        # the fid was bound by the walk, so it is still clunked
+        self.assertEqual(self.server.received[-1], messages.TClunk.type_id)
+        self.assertEqual(len(self.server._fids), 1)
+        self.assertEqual(len(self.client._fids._free), 1)
+
+    def test_connection_lost(self):
+        self.server._socket.shutdown(socket.SHUT_RDWR)
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                self.client.read_file("small")
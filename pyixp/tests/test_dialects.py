@@ -0,0 +1,219 @@
+import errno
+import socket
+import struct
+import unittest
+
+from pyixp import dialects, messages, requests, server
+from pyixp.client import Client
+from pyixp.requests import ServerError
+from pyixp.server import MemoryDirectory, MemoryFile, MemoryFS
+
+
+class MessageTest(unittest.TestCase):
+    qid = {"type": messages.QTDIR, "version": 0, "path": 7}
+
+    def test_dirents(self):
+        entries = [
+            {"qid": self.qid, "offset": 1, "type": 4, "name": "dir"},
+            {"qid": self.qid, "offset": 2, "type": 8, "name": "file"},
+        ]
+        data = b"".join(dialects.dirent.pack(entry) for entry in entries)
+        self.assertEqual(list(dialects.iter_dirents(data)), entries)
+
+    def test_stat_from_attr(self):
+        attr = dialects.RGetAttr(
+            dialects.GETATTR_BASIC, self.qid, 0o40755, 1000, 100, 2, 0, 4096,
+            4096, 8, 10, 0, 20, 0, 20, 0, 0, 0, 0, 0)
+        attr = dialects.RGetAttr.unpack(attr.pack())
+        stat = dialects.stat_from_attr(attr, "dir")
+        self.assertEqual(stat["mode"], messages.DMDIR | 0o755)
+        self.assertEqual(stat["mtime"], 20)
+        self.assertEqual(stat["uid"], "1000")
+        self.assertEqual(stat["name"], "dir")
+
+    def test_linux_flags(self):
+        self.assertEqual(
+            dialects.linux_flags(messages.ORDWR | messages.OTRUNC),
+            dialects.L_O_RDWR | dialects.L_O_TRUNC)
+
+    def test_unix_error(self):
+        body = messages.RError("no such file").pack() + \
+            struct.pack("<I", errno.ENOENT)
+        error = requests._parse_error(messages.RError.type_id, body)
+        self.assertEqual(error.ename, "no such file")
+        self.assertEqual(error.errno, errno.ENOENT)
+
+    def test_linux_error(self):
+        error = requests._parse_error(
+            dialects.RLError.type_id, dialects.RLError(errno.EACCES).pack())
+        self.assertEqual(error.errno, errno.EACCES)
+        self.assertEqual(error.ename, "Permission denied")
+
+
+class Ancient(dialects.Dialect):
+    version = "9P1"
+
+
+class DialectTestCase(unittest.TestCase):
+    dialects = (dialects.LINUX, dialects.BASE)
+
+    # dialects accepted by the server
+    versions = server.DIALECT_VERSIONS
+
+    def setUp(self):
+        fs = MemoryFS()
+        fs.add("", MemoryFile("file", b"Hello World", uid="1000"))
+        fs.add("", MemoryDirectory("dir"))
+        for i in range(50):
+            fs.add("dir", MemoryFile("file%02i" % i, b"%i" % i))
+        self.server = server.Server(fs, versions=self.versions)
+        client_socket, server_socket = socket.socketpair()
+        self.server.serve_connection(server_socket)
+        self.client = Client(client_socket, dialects=self.dialects)
+
+        # record the type and body of every request after version
+        # negotiation
+        self.sent = []
+        self.bodies = []
+        request_async = self.client._marshall.request_async
+
+        def record(request_type, request, *args, **kwargs):
+            self.sent.append(request_type)
+            self.bodies.append(request)
+            return request_async(request_type, request, *args, **kwargs)
+        self.client._marshall.request_async = record
+        self.client.attach_root("test", "")
+
+    def requests_of(self, message_type):
+        """ :returns: the decoded requests of type ``message_type`` sent by
+            the client
+        """
+        return [message_type.unpack(body)
+                for type_id, body in zip(self.sent, self.bodies)
+                if type_id == message_type.type_id]
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+
+
+class LinuxDialectTest(DialectTestCase):
+    def test_negotiated(self):
+        self.assertIs(self.client.dialect, dialects.LINUX)
+
+    def test_read_file(self):
+        self.assertEqual(self.client.read_file("file"), b"Hello World")
+        self.assertIn(dialects.TLOpen.type_id, self.sent)
+        self.assertNotIn(messages.TOpen.type_id, self.sent)
+
+    def test_write_file(self):
+        self.client.write_file("file", b"Bye")
+        self.assertEqual(self.client.read_file("file"), b"Bye")
+
+    def test_stat_path(self):
+        stat = self.client.stat_path("dir/file07")
+        self.assertEqual((stat["name"], stat["length"]), ("file07", 1))
+        self.assertTrue(self.client.stat_path("dir")["mode"] &
+                        messages.DMDIR)
+        self.assertIn(dialects.TGetAttr.type_id, self.sent)
+
+    def test_listdir(self):
+        names = sorted(entry["name"] for entry in self.client.listdir("dir"))
+        self.assertEqual(names, ["file%02i" % i for i in range(50)])
+        self.assertIn(dialects.TReadDir.type_id, self.sent)
+        self.assertNotIn(messages.TRead.type_id, self.sent)
+
+    def test_listdir_small_messages(self):
+        # entries are split across several TReadDir responses
+        count = self.client._io_size
+        self.client._io_size = lambda iounit=0: 100
+        try:
+            names = [entry["name"] for entry in self.client.listdir("dir")]
+        finally:
+            self.client._io_size = count
+        self.assertEqual(len(names), 50)
+        self.assertGreater(self.sent.count(dialects.TReadDir.type_id), 2)
+
+    def test_walk_tree(self):
+        tree = list(self.client.walk_tree())
+        self.assertEqual([dirpath for dirpath, _, _ in tree], ["", "dir"])
+        self.assertEqual(tree[0][1:], (["dir"], ["file"]))
+
+    def test_create(self):
+        self.client.mkdir("new")
+        self.client.create_file("new/file", b"data")
+        self.assertEqual(self.client.read_file("new/file"), b"data")
+        self.assertIn(dialects.TMkDir.type_id, self.sent)
+        self.assertIn(dialects.TLCreate.type_id, self.sent)
+        self.client.remove_path("new/file")
+        self.client.remove_path("new")
+
+    def test_open_file(self):
+        with self.client.open_file("file") as f:
+            f.seek(6)
+            self.assertEqual(f.read(), b"World")
+            self.assertEqual(f.seek(0, 2), 11)
+
+    def test_error(self):
+        with self.assertRaises(ServerError) as context:
+            self.client.read_file("dir/missing")
+        self.assertEqual(context.exception.errno, errno.ENOENT)
+
+
+class UnixDialectTest(DialectTestCase):
+    dialects = (dialects.UNIX, dialects.BASE)
+
+    def test_attach(self):
+        self.assertIs(self.client.dialect, dialects.UNIX)
+        attach, = self.requests_of(dialects.TAttachU)
+        self.assertEqual(attach.uname, "test")
+        self.assertEqual(attach.n_uname, dialects.NONUNAME)
+
+    def test_stat(self):
+        stat = self.client.stat_path("file")
+        self.assertEqual((stat["name"], stat["length"]), ("file", 11))
+        self.assertEqual(stat["n_uid"], 1000)
+
+    def test_listdir(self):
+        entries = {entry["name"]: entry for entry in self.client.listdir()}
+        self.assertEqual(set(entries), {"file", "dir"})
+        self.assertEqual(entries["dir"]["extension"], "")
+        self.assertTrue(entries["dir"]["mode"] & messages.DMDIR)
+
+    def test_create(self):
+        self.client.mkdir("dir/new")
+        self.client.create_file("dir/new/file")
+        mkdir, create = self.requests_of(dialects.TCreateU)
+        self.assertEqual((mkdir.name, mkdir.extension), ("new", ""))
+        self.assertTrue(mkdir.perm & messages.DMDIR)
+        self.assertEqual((create.name, create.extension), ("file", ""))
+        self.assertFalse(create.perm & messages.DMDIR)
+        self.assertEqual(
+            [entry["name"] for entry in self.client.listdir("dir/new")],
+            ["file"])
+
+    def test_error(self):
+        with self.assertRaises(ServerError) as context:
+            self.client.read_file("dir/missing")
+        self.assertEqual(context.exception.errno, errno.ENOENT)
+
+
+class FallbackTest(DialectTestCase):
+    versions = (dialects.LINUX.version,)
+    dialects = (Ancient(), dialects.UNIX, dialects.BASE)
+
+    def test_fallback(self):
+        # the server doesn't know 9P1 at all and answers 9P2000.u with the
+        # version it does support
+        self.assertIs(self.client.dialect, dialects.BASE)
+        self.assertEqual(self.client.read_file("file"), b"Hello World")
+
+
+class ImplicitFallbackTest(DialectTestCase):
+    # 9P2000 isn't offered but is still accepted from the server
+    versions = (dialects.LINUX.version,)
+    dialects = (dialects.UNIX,)
+
+    def test_fallback(self):
+        self.assertIs(self.client.dialect, dialects.BASE)
+        self.assertEqual(self.client.read_file("file"), b"Hello World")
@@ -0,0 +1,126 @@
+import asyncio
+import queue
+import socket
+import threading
+import unittest
+
+from pyixp.client import Client
+from pyixp.reactor import Reactor
+from pyixp.server import MemoryFile, MemoryFS, Server
+
+
+class EventFile(MemoryFile):
+    """ File whose reads block until an event is posted
+    """
+    def __init__(self, name):
+        super(EventFile, self).__init__(name)
+        self.events = queue.Queue()
+        self.cancelled = 0
+        self.readers = 0
+        self.cond = threading.Condition()
+
+    def post(self, data):
+        self.events.put(data)
+
+    def read(self, offset, count, cancelled):
+        with self.cond:
+            self.readers += 1
+            self.cond.notify_all()
+        try:
+            while not cancelled.is_set():
+                try:
+                    return self.events.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+            with self.cond:
+                self.cancelled += 1
+            return b''
+        finally:
+            with self.cond:
+                self.readers -= 1
+
+    def wait_for_readers(self, n):
+        with self.cond:
+            self.cond.wait_for(lambda: self.readers >= n, 5)
+
+
+class EventStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.event_file = EventFile("event")
+        fs = MemoryFS()
+        fs.add("", self.event_file)
+        self.server = Server(fs)
+        client_socket, server_socket = socket.socketpair()
+        self.server.serve_connection(server_socket)
+        self.client = Client(self.connect(client_socket), uname="test")
+
+    def connect(self, sock):
+        return sock
+
+    def tearDown(self):
+        # a round trip ensures that the server has received the clunk sent
+        # when the stream finished
+        self.client.stat_path("event")
+        self.client.close()
+        self.server.shutdown()
+
+    def test_iterator(self):
+        with self.client.events("event") as events:
+            self.event_file.post(b"CreateTag 1\nFocusTag")
+            self.assertEqual(next(events), b"CreateTag 1")
+            self.event_file.post(b" 1\n")
+            self.assertEqual(next(events), b"FocusTag 1")
+
+    def test_callback(self):
+        received = queue.Queue()
+        with self.client.events("event", callback=received.put):
+            for i in range(20):
+                self.event_file.post(b"event %i\n" % i)
+                self.assertEqual(received.get(timeout=5), b"event %i" % i)
+
+    def test_raw_chunks(self):
+        with self.client.events("event", separator=None) as events:
+            self.event_file.post(b"a\nb")
+            self.assertEqual(next(events), b"a\nb")
+
+    def test_close_flushes(self):
+        events = self.client.events("event", depth=4)
+        self.event_file.wait_for_readers(4)
+        events.close()
+        self.assertTrue(events.closed)
+        self.assertEqual(self.event_file.cancelled, 4)
+        self.assertEqual(list(events), [])
+        # the connection is still usable and the fid has been released
+        self.assertEqual(self.client.stat_path("event")["name"], "event")
+
+    def test_end_of_file(self):
+        with self.client.events("event", depth=2) as events:
+            # the server may answer outstanding reads in any order, so the
+            # end of file is only posted once the data has been received
+            self.event_file.post(b"one\nlast")
+            self.assertEqual(next(events), b"one")
+            self.event_file.post(b"")
+            self.assertEqual(list(events), [b"last"])
+
+    def test_async_iterator(self):
+        async def read(events):
+            received = []
+            async for event in events:
+                received.append(event)
+                if len(received) == 2:
+                    break
+            return received
+
+        with self.client.events("event") as events:
+            self.event_file.post(b"one\ntwo\n")
+            self.assertEqual(asyncio.run(read(events)), [b"one", b"two"])
+
+
+class ReactorEventStreamTest(EventStreamTest):
+    def connect(self, sock):
+        self.reactor = Reactor().start()
+        return self.reactor.connect(sock)
+
+    def tearDown(self):
+        super(ReactorEventStreamTest, self).tearDown()
+        self.reactor.close()
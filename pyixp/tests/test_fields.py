@@ -1,4 +1,5 @@
 import unittest
+import struct
 import logging
 from pyixp import fields
 
@@ -63,3 +64,79 @@ class IdentityTest(unittest.TestCase):
             ("bar", fields.String(),),
             ("baz", fields.uint32,))
         self.pack_and_unpack(struct, {"foo": 5, "bar": "test", "baz": 9})
+
+    def test_sized(self):
+        sized = fields.Sized(fields.uint16, fields.String())
+        self.pack_and_unpack(sized, "test string")
+        self.assertEqual(sized.pack("abc")[:2], fields.uint16.pack(5))
+
+
+class ColumnsTest(unittest.TestCase):
+    record = fields.Struct(
+        ("type", fields.uint8),
+        ("version", fields.uint32l),
+        ("path", fields.uint64l))
+
+    def test_fixed_format(self):
+        self.assertEqual(fields.uint64l.fixed_format, "Q")
+        self.assertEqual(fields.uint8.fixed_format, "B")
+        self.assertIsNone(fields.uint32.fixed_format)
+        self.assertIsNone(fields.int8.fixed_format)
+        self.assertEqual(self.record.fixed_format, "BIQ")
+        self.assertIsNone(fields.Struct(
+            ("name", fields.String()), ("size", fields.uint32l)).fixed_format)
+
+    def test_unpack(self):
+        values = [{"type": i & 0xff, "version": i, "path": i << 40}
+                  for i in range(300)]
+        array = fields.Array(fields.uint16l, self.record)
+        packed = array.pack(values)
+        unpacked, size = array.unpack(b'xx' + packed, 2)
+
+        self.assertEqual(size, len(packed))
+        self.assertIsInstance(unpacked, fields.Columns)
+        self.assertEqual(unpacked, values)
+        self.assertEqual(len(unpacked), 300)
+        self.assertEqual(unpacked[-1], values[-1])
+        self.assertEqual(unpacked[10:12], values[10:12])
+        self.assertEqual(list(unpacked.columns["path"]),
+                         [value["path"] for value in values])
+        with self.assertRaises(IndexError):
+            unpacked[300]
+
+    def test_threshold(self):
+        array = fields.Array(fields.uint16l, self.record)
+        for count in (1, fields.COLUMN_THRESHOLD - 1):
+            values = [{"type": 1, "version": 2, "path": i}
+                      for i in range(count)]
+            unpacked, size = array.unpack(array.pack(values))
+            self.assertIs(type(unpacked), list)
+            self.assertEqual(unpacked, values)
+        values.append({"type": 3, "version": 4, "path": 5})
+        unpacked, size = array.unpack(array.pack(values))
+        self.assertIsInstance(unpacked, fields.Columns)
+        self.assertEqual(unpacked, values)
+
+    def test_signed(self):
+        record = fields.Struct(("a", fields.int16l), ("b", fields.int64l))
+        values = [{"a": -i, "b": -(i << 40)}
+                  for i in range(fields.COLUMN_THRESHOLD)]
+        array = fields.Array(fields.uint16l, record)
+        unpacked, size = array.unpack(array.pack(values))
+        self.assertEqual(unpacked, values)
+
+    def test_empty(self):
+        array = fields.Array(fields.uint16l, self.record)
+        unpacked, size = array.unpack(array.pack([]))
+        self.assertEqual((unpacked, size), ([], 2))
+
+    def test_scalar(self):
+        array = fields.Array(fields.uint16l, fields.uint32l)
+        unpacked, size = array.unpack(array.pack([1, 2, 3]))
+        self.assertEqual((unpacked, size), ([1, 2, 3], 14))
+
+    def test_truncated(self):
+        array = fields.Array(fields.uint16l, self.record)
+        packed = array.pack([{"type": 0, "version": 0, "path": 0}] * 2)
+        with self.assertRaises(struct.error):
+            array.unpack(packed[:-1])
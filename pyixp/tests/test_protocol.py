@@ -0,0 +1,164 @@
+import os
+import struct
+import unittest
+
+from pyixp.messages import header as _header
+from pyixp.protocol import FlushedError, Protocol, NOTAG
+
+
+def unframe(frame):
+    length, type_, tag = _header.unpack_from(frame)
+    assert length == len(frame)
+    return type_, tag, frame[_header.size:]
+
+
+class ProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = Protocol(maxrequests=3)
+        self.responses = []
+        self.errors = []
+
+    def request(self, body, **kwargs):
+        self.protocol.request(
+            100, body,
+            lambda type_, response: self.responses.append((type_, response)),
+            self.errors.append, **kwargs)
+
+    def test_framing(self):
+        self.request(b"hello")
+        [frame] = self.protocol.frames_to_send()
+        type_, tag, body = unframe(frame)
+        self.assertEqual((type_, body), (100, b"hello"))
+
+        self.protocol.receive_data(_header.pack(10, 101, tag) + b"bye")
+        self.assertEqual(self.responses, [(101, b"bye")])
+
+    def test_partial_frames(self):
+        self.request(b"a")
+        self.request(b"b")
+        tags = [unframe(frame)[1] for frame in self.protocol.frames_to_send()]
+        data = b"".join(_header.pack(9, 101, tag) + b"r%i" % i
+                        for i, tag in enumerate(reversed(tags)))
+        for i in range(len(data)):
+            self.protocol.receive_data(data[i:i + 1])
+        self.assertEqual(self.responses, [(101, b"r0"), (101, b"r1")])
+
+    def test_waits_for_tag(self):
+        for body in (b"a", b"b", b"c"):
+            self.request(body)
+        frames = self.protocol.frames_to_send()
+        # one tag is kept in reserve, as with the marshall
+        self.assertEqual(len(frames), 2)
+        self.assertFalse(self.protocol.pending)
+
+        self.protocol.receive_frame(101, unframe(frames[0])[1], b"")
+        [frame] = self.protocol.frames_to_send()
+        self.assertEqual(unframe(frame)[2], b"c")
+
+    def test_sequential(self):
+        self.request(b"a", sequential=True)
+        self.request(b"b", sequential=True)
+        for frame in self.protocol.frames_to_send():
+            self.assertEqual(unframe(frame)[1], NOTAG)
+        self.protocol.receive_frame(101, NOTAG, b"1")
+        self.protocol.receive_frame(101, NOTAG, b"2")
+        self.assertEqual(self.responses, [(101, b"1"), (101, b"2")])
+
+    def test_unexpected_tag(self):
+        with self.assertRaises(Exception):
+            self.protocol.receive_frame(101, 7, b"")
+
+    def test_message_size(self):
+        self.protocol.max_message_size = 16
+        with self.assertRaises(Exception):
+            self.request(b"x" * 16)
+
+    def test_response_too_large(self):
+        self.request(b"a")
+        [frame] = self.protocol.frames_to_send()
+        self.protocol.max_message_size = 16
+        with self.assertRaises(Exception):
+            self.protocol.receive_data(
+                _header.pack(17, 101, unframe(frame)[1]) + b"x" * 10)
+
+    def test_closes_unwanted_fds(self):
+        self.request(b"a")
+        [frame] = self.protocol.frames_to_send()
+        read_fd, write_fd = os.pipe()
+        os.close(write_fd)
+        self.protocol.receive_frame(101, unframe(frame)[1], b"", [read_fd])
+        with self.assertRaises(OSError):
+            os.fstat(read_fd)
+
+    def test_connection_lost(self):
+        for body in (b"a", b"b", b"c"):
+            self.request(body)
+        self.request(b"d", sequential=True)
+        error = Exception("lost")
+        self.protocol.connection_lost(error)
+        self.assertEqual(self.errors, [error] * 4)
+        self.assertFalse(self.protocol.pending)
+
+    def test_copy_into_buffer(self):
+        buffer = bytearray(8)
+        self.request(b"a", buffer=buffer)
+        [frame] = self.protocol.frames_to_send()
+        tag = unframe(frame)[1]
+        self.assertIs(self.protocol.response_buffer(117, tag), buffer)
+        self.assertIsNone(self.protocol.response_buffer(107, tag))
+
+        body = struct.pack("<I", 5) + b"hello"
+        self.protocol.receive_data(
+            _header.pack(_header.size + len(body), 117, tag) + body)
+        self.assertEqual(self.responses, [(117, struct.pack("<I", 5))])
+        self.assertEqual(buffer[:5], b"hello")
+
+    def test_flush(self):
+        handle = self.protocol.request(
+            100, b"a", self.responses.append, self.errors.append)
+        [frame] = self.protocol.frames_to_send()
+        tag = unframe(frame)[1]
+
+        self.protocol.flush(handle)
+        [frame] = self.protocol.frames_to_send()
+        type_, flush_tag, body = unframe(frame)
+        self.assertEqual((type_, body), (108, struct.pack("<H", tag)))
+        self.assertEqual(self.errors, [])
+
+        self.protocol.receive_frame(109, flush_tag, b"")
+        self.assertEqual(len(self.errors), 1)
+        self.assertIsInstance(self.errors[0], FlushedError)
+        self.assertEqual(self.responses, [])
+        # both tags are free again
+        self.assertEqual(len(self.protocol._tags), 2)
+
+    def test_flush_after_response(self):
+        handle = self.protocol.request(
+            100, b"a", lambda *args: self.responses.append(args),
+            self.errors.append)
+        tag = unframe(self.protocol.frames_to_send()[0])[1]
+        self.protocol.flush(handle)
+        flush_tag = unframe(self.protocol.frames_to_send()[0])[1]
+
+        self.protocol.receive_frame(101, tag, b"late")
+        self.assertEqual(self.responses, [(101, b"late")])
+        # the tag stays reserved until the flush is acknowledged
+        self.assertNotIn(tag, self.protocol._tags)
+        self.request(b"b")
+        self.assertEqual(self.protocol.frames_to_send(), [])
+
+        self.protocol.receive_frame(109, flush_tag, b"")
+        self.assertEqual(self.errors, [])
+        [frame] = self.protocol.frames_to_send()
+        self.assertEqual(unframe(frame)[2], b"b")
+        self.assertIn(tag, self.protocol._tags + [unframe(frame)[1]])
+
+    def test_flush_waiting(self):
+        for body in (b"a", b"b"):
+            self.request(body)
+        handle = self.protocol.request(
+            100, b"c", self.responses.append, self.errors.append)
+        self.protocol.frames_to_send()
+        self.protocol.flush(handle)
+        self.assertFalse(self.protocol.pending)
+        self.assertIsInstance(self.errors[0], FlushedError)
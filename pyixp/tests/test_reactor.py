@@ -0,0 +1,71 @@
+import socket
+import threading
+import unittest
+
+from pyixp.client import Client
+from pyixp.reactor import Reactor
+from pyixp.requests import ServerError
+from pyixp.server import MemoryFile, MemoryFS, Server
+
+
+class ReactorTest(unittest.TestCase):
+    def setUp(self):
+        fs = MemoryFS()
+        fs.add("", MemoryFile("file", b"Hello World"))
+        self.server = Server(fs)
+        self.reactor = Reactor().start()
+
+    def tearDown(self):
+        self.reactor.close()
+        self.server.shutdown()
+
+    def connect(self):
+        client_socket, server_socket = socket.socketpair()
+        self.server.serve_connection(server_socket)
+        return Client(self.reactor.connect(client_socket), uname="test")
+
+    def test_many_clients(self):
+        before = set(threading.enumerate())
+        clients = [self.connect() for _ in range(20)]
+        # connections share the reactor thread instead of starting their own
+        names = [thread.name for thread in threading.enumerate()
+                 if thread not in before]
+        self.assertFalse([name for name in names if "_loop" in name])
+
+        for i, client in enumerate(clients):
+            client.write_file("file", b"%i" % i)
+            self.assertEqual(client.read_file("file"), b"%i" % i)
+        for client in clients:
+            client.close()
+
+    def test_concurrent_requests(self):
+        client = self.connect()
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(20):
+                    self.assertEqual(client.stat_path("file")["name"], "file")
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        client.close()
+
+    def test_error(self):
+        client = self.connect()
+        with self.assertRaises(ServerError):
+            client.read_file("missing")
+        client.close()
+
+    def test_connection_lost(self):
+        client_socket, server_socket = socket.socketpair()
+        connection = self.reactor.connect(client_socket)
+        server_socket.close()
+        with self.assertRaises(Exception):
+            connection.request(100, b"")
@@ -0,0 +1,318 @@
+import asyncio
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from pyixp import messages
+from pyixp.client import Client
+from pyixp.messages import header as _header
+from pyixp.requests import ServerError
+from pyixp.server import (
+    AsyncServer, LocalFS, MemoryDirectory, MemoryFile, MemoryFS, Server,
+    Session,
+)
+
+
+class BlockingFile(MemoryFile):
+    """ File that blocks reads until they are flushed
+    """
+    def __init__(self, name):
+        super(BlockingFile, self).__init__(name)
+        self.started = threading.Event()
+
+    def read(self, offset, count, cancelled):
+        self.started.set()
+        cancelled.wait(5)
+        return b''
+
+
+class GatedFile(MemoryFile):
+    """ File that blocks writes until ``gate`` is set, ignoring flushes
+    """
+    def __init__(self, name):
+        super(GatedFile, self).__init__(name)
+        self.started = threading.Event()
+        self.gate = threading.Event()
+
+    def write(self, offset, data, cancelled):
+        self.started.set()
+        self.gate.wait(5)
+        return super(GatedFile, self).write(offset, data, cancelled)
+
+
+def make_memory_fs():
+    fs = MemoryFS()
+    fs.add("", MemoryFile("file", b"Hello World"))
+    fs.add("", MemoryDirectory("dir"))
+    for i in range(100):
+        fs.add("dir", MemoryFile("file%03i" % i, b"%i" % i))
+    fs.add("", BlockingFile("blocking"))
+    fs.add("", GatedFile("gated"))
+    return fs
+
+
+class ServerTestMixin(object):
+    def test_read_file(self):
+        self.assertEqual(self.client.read_file("file"), b"Hello World")
+
+    def test_write_file(self):
+        self.client.write_file("file", b"Goodbye")
+        self.assertEqual(self.client.read_file("file"), b"Goodbye")
+
+    def test_listdir(self):
+        names = sorted(entry["name"] for entry in self.client.listdir("dir"))
+        self.assertEqual(names, ["file%03i" % i for i in range(100)])
+
+    def test_walk_tree(self):
+        dirpaths = {dirpath for dirpath, _, _ in self.client.walk_tree()}
+        self.assertEqual(dirpaths, {"", "dir"})
+
+    def test_stat_path(self):
+        self.assertEqual(self.client.stat_path("dir/file007")["length"], 1)
+
+    def test_missing(self):
+        with self.assertRaises(ServerError):
+            self.client.read_file("missing")
+
+    def test_create_and_remove(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"uploaded")
+            f.flush()
+            self.client.upload(f.name, "dir/new")
+        self.assertEqual(self.client.read_file("dir/new"), b"uploaded")
+        self.client.remove_path("dir/new")
+        with self.assertRaises(ServerError):
+            self.client.stat_path("dir/new")
+
+
+class ThreadedServerTest(ServerTestMixin, unittest.TestCase):
+    def setUp(self):
+        client_socket, server_socket = socket.socketpair()
+        self.server = Server(make_memory_fs())
+        self.thread = self.server.serve_connection(server_socket)
+        self.client = Client(client_socket, uname="test")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+
+    def test_shutdown(self):
+        # open connections are closed rather than left to fail on their next
+        # request
+        self.client.stat_path("file")
+        self.server.shutdown()
+        self.assertFalse(self.thread.is_alive())
+
+
+class AsyncServerTest(ServerTestMixin, unittest.TestCase):
+    def setUp(self):
+        client_socket, server_socket = socket.socketpair()
+        self.server = AsyncServer(make_memory_fs())
+        self.loop = asyncio.new_event_loop()
+
+        async def serve():
+            reader, writer = await asyncio.open_unix_connection(
+                sock=server_socket)
+            await self.server.serve_connection(reader, writer)
+
+        self.thread = threading.Thread(
+            target=self.loop.run_until_complete, args=(serve(),),
+            daemon=True)
+        self.thread.start()
+        self.client = Client(client_socket, uname="test")
+
+    def tearDown(self):
+        self.client.close()
+        self.thread.join(5)
+        self.loop.close()
+
+
+class LocalFSTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.tempdir.name, "dir"))
+        with open(os.path.join(self.tempdir.name, "dir", "file"), 'wb') as f:
+            f.write(b"local")
+
+        client_socket, server_socket = socket.socketpair()
+        self.server = Server(LocalFS(self.tempdir.name))
+        self.server.serve_connection(server_socket)
+        self.client = Client(client_socket, uname="test")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.tempdir.cleanup()
+
+    def test_read(self):
+        self.assertEqual(self.client.read_file("dir/file"), b"local")
+
+    def test_listdir(self):
+        entries = list(self.client.listdir())
+        self.assertEqual([entry["name"] for entry in entries], ["dir"])
+        self.assertTrue(entries[0]["mode"] & messages.DMDIR)
+
+    def test_write(self):
+        self.client.write_file("dir/file", b"changed")
+        with open(os.path.join(self.tempdir.name, "dir", "file"), 'rb') as f:
+            self.assertEqual(f.read(), b"changed")
+
+    def test_no_escape(self):
+        with self.assertRaises(ServerError):
+            self.client.read_file("../../../etc/passwd")
+        os.symlink("/", os.path.join(self.tempdir.name, "link"))
+        with self.assertRaises(ServerError):
+            self.client.stat_path("link/etc")
+
+
+class SessionTest(unittest.TestCase):
+    """ Drive a session directly to check tag handling and ordering
+    """
+    def setUp(self):
+        self.fs = make_memory_fs()
+        self.responses = []
+        self.received = threading.Condition()
+        self.session = Session(self.fs, self.send, self.spawn)
+        self.threads = []
+
+    def send(self, frame):
+        length, type_id, tag = _header.unpack_from(frame)
+        with self.received:
+            self.responses.append((tag, type_id, frame[_header.size:]))
+            self.received.notify_all()
+
+    def spawn(self, function):
+        thread = threading.Thread(target=function, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def request(self, tag, message):
+        self.session.receive(message.type_id, tag, message.pack())
+
+    def wait_for(self, count):
+        with self.received:
+            self.assertTrue(self.received.wait_for(
+                lambda: len(self.responses) >= count, 5))
+        return self.responses[:count]
+
+    def test_version_msize(self):
+        # each TVersion is negotiated against the configured limit, not the
+        # size agreed by the previous one
+        self.session = Session(self.fs, self.send, self.spawn, 0x10000)
+        for tag, msize, expected in [(1, 4096, 4096),
+                                     (2, 0x100000, 0x10000),
+                                     (3, 8192, 8192)]:
+            self.request(tag, messages.TVersion(msize, "9P2000"))
+            tag, type_id, body = self.wait_for(tag)[-1]
+            self.assertEqual(messages.RVersion.unpack(body).msize, expected)
+
+    def test_pipelined_chain(self):
+        self.request(1, messages.TAttach(0, messages.NOFID, "test", ""))
+        self.request(2, messages.TWalk(0, 1, ["file"]))
+        self.request(3, messages.TOpen(1, messages.OREAD))
+        self.request(4, messages.TRead(1, 0, 100))
+        self.request(5, messages.TClunk(1))
+        responses = dict((tag, (type_id, body))
+                         for tag, type_id, body in self.wait_for(5))
+        for tag in range(1, 6):
+            self.assertNotEqual(responses[tag][0], messages.RError.type_id)
+        self.assertEqual(
+            messages.RRead.unpack(responses[4][1]).data, b"Hello World")
+
+    def test_flush_running(self):
+        self.request(1, messages.TAttach(0, messages.NOFID, "test", ""))
+        self.request(2, messages.TWalk(0, 1, ["blocking"]))
+        self.request(3, messages.TOpen(1, messages.OREAD))
+        self.wait_for(3)
+        self.request(4, messages.TRead(1, 0, 100))
+        self.fs.root.children["blocking"].started.wait(5)
+        self.request(5, messages.TFlush(4))
+        tag, type_id, body = self.wait_for(4)[3]
+        self.assertEqual((tag, type_id), (5, messages.RFlush.type_id))
+        self.assertEqual(len(self.responses), 4)
+
+    def test_flush_completed(self):
+        # a handler that finishes without noticing the flush has taken effect,
+        # so its response is sent ahead of the RFlush
+        gated = self.fs.root.children["gated"]
+        self.request(1, messages.TAttach(0, messages.NOFID, "test", ""))
+        self.request(2, messages.TWalk(0, 1, ["gated"]))
+        self.request(3, messages.TOpen(1, messages.OWRITE))
+        self.wait_for(3)
+        self.request(4, messages.TWrite(1, 0, b"written"))
+        gated.started.wait(5)
+        self.request(5, messages.TFlush(4))
+        gated.gate.set()
+        responses = [(tag, type_id) for tag, type_id, body
+                     in self.wait_for(5)[3:]]
+        self.assertEqual(responses, [
+            (4, messages.RWrite.type_id), (5, messages.RFlush.type_id)])
+        self.assertEqual(bytes(gated.data), b"written")
+
+    def test_flush_responding(self):
+        # a TFlush that arrives while the response to its request is being
+        # sent is answered after that response
+        sending = threading.Event()
+        release = threading.Event()
+
+        def send(frame):
+            if _header.unpack_from(frame)[2] == 4:
+                sending.set()
+                release.wait(5)
+            self.send(frame)
+
+        self.session = Session(self.fs, send, self.spawn)
+        self.request(1, messages.TAttach(0, messages.NOFID, "test", ""))
+        self.request(2, messages.TWalk(0, 1, ["file"]))
+        self.request(3, messages.TOpen(1, messages.OREAD))
+        self.wait_for(3)
+        self.request(4, messages.TRead(1, 0, 100))
+        self.assertTrue(sending.wait(5))
+        self.request(5, messages.TFlush(4))
+        release.set()
+        responses = [(tag, type_id) for tag, type_id, body
+                     in self.wait_for(5)[3:]]
+        self.assertEqual(responses, [
+            (4, messages.RRead.type_id), (5, messages.RFlush.type_id)])
+
+    def test_flush_queued(self):
+        self.request(1, messages.TAttach(0, messages.NOFID, "test", ""))
+        self.request(2, messages.TWalk(0, 1, ["blocking"]))
+        self.request(3, messages.TOpen(1, messages.OREAD))
+        self.wait_for(3)
+        self.request(4, messages.TRead(1, 0, 100))
+        self.fs.root.children["blocking"].started.wait(5)
+        # queued behind the blocking read, so flushing it should respond
+        # immediately without it ever running
+        self.request(5, messages.TClunk(1))
+        self.request(6, messages.TFlush(5))
+        tag, type_id, body = self.wait_for(4)[3]
+        self.assertEqual((tag, type_id), (6, messages.RFlush.type_id))
+        self.request(7, messages.TFlush(4))
+        tags = [tag for tag, type_id, body in self.wait_for(5)]
+        self.assertNotIn(5, tags)
+
+    def test_dir_entry_too_large(self):
+        self.request(1, messages.TAttach(0, messages.NOFID, "test", ""))
+        self.request(2, messages.TWalk(0, 1, ["dir"]))
+        self.request(3, messages.TOpen(1, messages.OREAD))
+        self.wait_for(3)
+        # too small for a single stat record
+        self.request(4, messages.TRead(1, 0, 20))
+        tag, type_id, body = self.wait_for(4)[3]
+        self.assertEqual((tag, type_id), (4, messages.RError.type_id))
+
+    def test_tag_in_use(self):
+        self.request(1, messages.TAttach(0, messages.NOFID, "test", ""))
+        self.request(2, messages.TWalk(0, 1, ["blocking"]))
+        self.request(3, messages.TOpen(1, messages.OREAD))
+        self.wait_for(3)
+        self.request(4, messages.TRead(1, 0, 100))
+        self.fs.root.children["blocking"].started.wait(5)
+        self.request(4, messages.TStat(0))
+        tag, type_id, body = self.wait_for(4)[3]
+        self.assertEqual((tag, type_id), (4, messages.RError.type_id))
+        self.request(5, messages.TFlush(4))
+        self.wait_for(5)
@@ -0,0 +1,164 @@
+import os
+import socket
+import threading
+import unittest
+
+from pyixp import messages, shm
+from pyixp.client import Client
+from pyixp.marshall import recvall
+from pyixp.messages import header as _header
+from pyixp.server import MemoryFile, MemoryFS, Server
+
+
+@unittest.skipUnless(shm._available(), "shared memory transport unavailable")
+class RingTest(unittest.TestCase):
+    def test_wrap_around(self):
+        buffer = memoryview(bytearray(shm._HEADER_SIZE + 64))
+        data_fd, space_fd = os.eventfd(0), os.eventfd(0)
+        self.addCleanup(os.close, data_fd)
+        self.addCleanup(os.close, space_fd)
+        writer = shm.Ring(buffer, data_fd, space_fd, spin=10)
+        reader = shm.Ring(buffer, data_fd, space_fd, spin=10)
+
+        payload = os.urandom(10000)
+        thread = threading.Thread(target=writer.write, args=(payload,))
+        thread.start()
+
+        received = bytearray()
+        chunk = bytearray(50)
+        while len(received) < len(payload):
+            count = reader.read_into(chunk)
+            received += chunk[:count]
+        thread.join()
+        self.assertEqual(bytes(received), payload)
+
+        writer.close()
+        self.assertEqual(reader.read_into(chunk), 0)
+
+    def test_invalid_indices(self):
+        # indices further apart than the ring allows close it
+        buffer = memoryview(bytearray(shm._HEADER_SIZE + 64))
+        data_fd, space_fd = os.eventfd(0), os.eventfd(0)
+        self.addCleanup(os.close, data_fd)
+        self.addCleanup(os.close, space_fd)
+        writer = shm.Ring(buffer, data_fd, space_fd, spin=10)
+        reader = shm.Ring(buffer, data_fd, space_fd, spin=10)
+
+        buffer[:shm._HEADER_SIZE].cast('Q')[shm._TAIL] = 65
+        self.assertEqual(reader.read_into(bytearray(10)), 0)
+        self.assertTrue(writer.closed)
+        with self.assertRaises(BrokenPipeError):
+            writer.write(b"data")
+
+    def test_wakeup(self):
+        # with no spinning, every exchange depends on the eventfd wakeups
+        rings = []
+        for _ in range(2):
+            buffer = memoryview(bytearray(shm._HEADER_SIZE + 64))
+            data_fd, space_fd = os.eventfd(0), os.eventfd(0)
+            self.addCleanup(os.close, data_fd)
+            self.addCleanup(os.close, space_fd)
+            rings.append((shm.Ring(buffer, data_fd, space_fd, spin=0),
+                          shm.Ring(buffer, data_fd, space_fd, spin=0)))
+        (ping_writer, ping_reader), (pong_writer, pong_reader) = rings
+
+        def echo():
+            chunk = bytearray(1)
+            for _ in range(200):
+                ping_reader.read_into(chunk)
+                pong_writer.write(chunk)
+
+        thread = threading.Thread(target=echo, daemon=True)
+        thread.start()
+        chunk = bytearray(1)
+        for i in range(200):
+            ping_writer.write(bytes([i]))
+            pong_reader.read_into(chunk)
+            self.assertEqual(chunk[0], i)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+
+@unittest.skipUnless(shm._available(), "shared memory transport unavailable")
+class TransportTest(unittest.TestCase):
+    def connect(self, **kwargs):
+        fs = MemoryFS()
+        fs.add("", MemoryFile("file", os.urandom(300000)))
+        self.data = fs.root.children["file"].data
+
+        client_socket, server_socket = socket.socketpair()
+        self.server = Server(fs, **kwargs)
+        self.server.serve_connection(server_socket)
+        self.addCleanup(self.server.shutdown)
+
+        transport = shm.connect(client_socket, ring_size=0x10000)
+        client = Client(transport, uname="test")
+        self.addCleanup(client.close)
+        return transport, client
+
+    def test_shared_memory(self):
+        transport, client = self.connect()
+        self.assertIsInstance(transport, shm.ShmTransport)
+        self.assertEqual(client.read_file("file"), self.data)
+        client.write_file("file", b"small")
+        self.assertEqual(client.read_file("file"), b"small")
+
+    def test_peer_hangup(self):
+        client_socket, server_socket = socket.socketpair()
+        server = Server(MemoryFS())
+        self.addCleanup(server.shutdown)
+        thread = server.serve_connection(server_socket)
+        transport = shm.connect(client_socket, ring_size=0x10000)
+        self.assertIsInstance(transport, shm.ShmTransport)
+
+        # the client goes away without closing the rings
+        client_socket.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        transport.close()
+
+    def test_unsealed(self):
+        # a segment that could be shrunk under the server is refused
+        client_socket, server_socket = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        self.addCleanup(server_socket.close)
+        fds = [os.memfd_create("unsealed")]
+        os.ftruncate(fds[0], 0x20000)
+        fds.extend(os.eventfd(0) for _ in range(4))
+        body = messages.TVersion(0x20000, shm.SHM_VERSION).pack()
+        self.assertIsNone(shm.accept(
+            server_socket, messages.TVersion.type_id, body, fds))
+        length, type_id, tag = _header.unpack(
+            recvall(client_socket, _header.size))
+        response = messages.RVersion.unpack(
+            recvall(client_socket, length - _header.size))
+        self.assertEqual(response.version, "unknown")
+
+    def test_refused(self):
+        # a refused offer is answered without resetting the session
+        client_socket, server_socket = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        server = Server(MemoryFS(), shared_memory=False)
+        self.addCleanup(server.shutdown)
+        server.serve_connection(server_socket)
+
+        def request(message):
+            body = message.pack()
+            client_socket.sendall(_header.pack(
+                len(body) + _header.size, message.type_id, 1) + body)
+            length, type_id, tag = _header.unpack(
+                recvall(client_socket, _header.size))
+            return type_id, recvall(client_socket, length - _header.size)
+
+        type_id, body = request(messages.TVersion(0x10000, "9P2000"))
+        self.assertEqual(messages.RVersion.unpack(body).msize, 0x10000)
+        request(messages.TAttach(0, messages.NOFID, "test", ""))
+        self.assertIs(shm.connect(client_socket, ring_size=0x1000),
+                      client_socket)
+        type_id, body = request(messages.TStat(0))
+        self.assertEqual(type_id, messages.RStat.type_id)
+
+    def test_fallback(self):
+        transport, client = self.connect(shared_memory=False)
+        self.assertIsInstance(transport, socket.socket)
+        self.assertEqual(client.read_file("file"), self.data)
@@ -10,5 +10,6 @@ setup(
     author_email='bwhmather@bwhmather.com',
     url='http://github.org/bwhmather/pyixp',
     packages=['pyixp'],
+    scripts=['bin/pyixp-bench'],
     license='MIT',
 )